@@ -7,12 +7,17 @@
 @Version : Python3.10
 @comment : ···
 """
+import sqlite3
+
 from .hard_link import HardLink
 from .micro_msg import MicroMsg
 from .media_msg import MediaMsg
 from .misc import Misc
 from .msg import Msg
 from .msg import MsgType
+from .pool import set_encrypted_sources
+from app.config import DB_DIR
+from app.log import logger
 
 misc_db = Misc()
 msg_db = Msg()
@@ -37,4 +42,31 @@ def init_db():
     media_msg_db.init_database()
 
 
-__all__ = ['misc_db', 'micro_msg_db', 'msg_db', 'hard_link_db', 'MsgType', "media_msg_db", "close_db"]
+def init_encrypted_db(key, msg_dir) -> bool:
+    """
+    不解密出明文副本，直接打开微信Msg文件夹下的加密数据库（只读，需要安装apsw）
+    @param key: 密钥
+    @param msg_dir: 微信数据文件夹下的Msg文件夹
+    @return: 是否成功打开，失败时（密钥错误、分库太多）恢复读取解密后的数据库
+    """
+    try:
+        from app.decrypt import encrypted_vfs
+    except ImportError:
+        logger.error('没有安装apsw，不能直接读取加密数据库')
+        return False
+    close_db()
+    try:
+        encrypted_vfs.enable(key)
+        set_encrypted_sources(encrypted_vfs.collect_sources(msg_dir, DB_DIR))
+        init_db()
+    except (ValueError, sqlite3.DatabaseError):
+        logger.error(f'直接读取加密数据库失败 {msg_dir}', exc_info=True)
+        close_db()
+        set_encrypted_sources({})
+        init_db()
+        return False
+    return True
+
+
+__all__ = ['misc_db', 'micro_msg_db', 'msg_db', 'hard_link_db', 'MsgType', "media_msg_db", "close_db",
+           "init_encrypted_db"]
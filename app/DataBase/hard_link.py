@@ -1,15 +1,13 @@
 import binascii
 import os.path
 import sqlite3
-import threading
 import traceback
 import xml.etree.ElementTree as ET
 
+from app.DataBase.pool import ConnectionPool, database_exists
 from app.log import log, logger
-from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+from app.util.protocbuf.bytes_extra import decode_bytes_extra, THUMB, ORIGINAL
 
-image_db_lock = threading.Lock()
-video_db_lock = threading.Lock()
 image_db_path = "./app/Database/Msg/HardLinkImage.db"
 video_db_path = "./app/Database/Msg/HardLinkVideo.db"
 root_path = "FileStorage/MsgAttach/"
@@ -105,29 +103,19 @@ def singleton(cls):
 @singleton
 class HardLink:
     def __init__(self):
-        self.imageDB = None
-        self.videoDB = None
-        self.image_cursor = None
-        self.video_cursor = None
+        self.image_pool: ConnectionPool = None
+        self.video_pool: ConnectionPool = None
         self.open_flag = False
         self.init_database()
 
     def init_database(self):
         if not self.open_flag:
-            if os.path.exists(image_db_path):
-                self.imageDB = sqlite3.connect(image_db_path, check_same_thread=False)
-                # '''创建游标'''
-                self.image_cursor = self.imageDB.cursor()
+            if database_exists(image_db_path):
+                self.image_pool = ConnectionPool(image_db_path)
                 self.open_flag = True
-                if image_db_lock.locked():
-                    image_db_lock.release()
-            if os.path.exists(video_db_path):
-                self.videoDB = sqlite3.connect(video_db_path, check_same_thread=False)
-                # '''创建游标'''
-                self.video_cursor = self.videoDB.cursor()
+            if database_exists(video_db_path):
+                self.video_pool = ConnectionPool(video_db_path)
                 self.open_flag = True
-                if video_db_lock.locked():
-                    video_db_lock.release()
 
     def get_image_by_md5(self, md5: bytes):
         if not md5:
@@ -141,17 +129,12 @@ class HardLink:
             join HardLinkImageID as HardLinkImageID2 on HardLinkImageAttribute.DirID2 = HardLinkImageID2.DirID
             where MD5 = ?;
             """
-        try:
-            image_db_lock.acquire(True)
-            try:
-                self.image_cursor.execute(sql, [md5])
-            except AttributeError:
-                self.init_database()
-                self.image_cursor.execute(sql, [md5])
-            result = self.image_cursor.fetchone()
-            return result
-        finally:
-            image_db_lock.release()
+        if self.image_pool is None:
+            return None
+        with self.image_pool.cursor() as cursor:
+            cursor.execute(sql, [md5])
+            result = cursor.fetchone()
+        return result
 
     def get_video_by_md5(self, md5: bytes):
         if not md5:
@@ -164,28 +147,22 @@ class HardLink:
             join HardLinkVideoID as HardLinkVideoID2 on HardLinkVideoAttribute.DirID2 = HardLinkVideoID2.DirID
             where MD5 = ?;
             """
-        try:
-            video_db_lock.acquire(True)
+        if self.video_pool is None:
+            return None
+        with self.video_pool.cursor() as cursor:
             try:
-                self.video_cursor.execute(sql, [md5])
+                cursor.execute(sql, [md5])
             except sqlite3.OperationalError:
                 return None
-            except AttributeError:
-                self.init_database()
-                self.video_cursor.execute(sql, [md5])
-            result = self.video_cursor.fetchone()
-            return result
-        finally:
-            video_db_lock.release()
+            result = cursor.fetchone()
+        return result
 
-    def get_image_original(self, content, bytesExtra) -> str:
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
+    def get_image_original(self, content, bytesExtra, fields=None) -> str:
+        if fields is None:
+            fields = decode_bytes_extra(bytesExtra, (THUMB, ORIGINAL))
         result = ''
-        for tmp in msg_bytes.message2:
-            if tmp.field1 != 4:
-                continue
-            pathh = tmp.field2  # wxid\FileStorage\...
+        if ORIGINAL in fields:
+            pathh = fields[ORIGINAL]  # wxid\FileStorage\...
             pathh = "\\".join(pathh.split("\\")[1:])
             return pathh
         md5 = get_md5_from_xml(content)
@@ -202,14 +179,12 @@ class HardLink:
                 result = dat_image
         return result
 
-    def get_image_thumb(self, content, bytesExtra) -> str:
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
+    def get_image_thumb(self, content, bytesExtra, fields=None) -> str:
+        if fields is None:
+            fields = decode_bytes_extra(bytesExtra, (THUMB, ORIGINAL))
         result = ''
-        for tmp in msg_bytes.message2:
-            if tmp.field1 != 3:
-                continue
-            pathh = tmp.field2  # wxid\FileStorage\...
+        if THUMB in fields:
+            pathh = fields[THUMB]  # wxid\FileStorage\...
             pathh = "\\".join(pathh.split("\\")[1:])
             return pathh
         md5 = get_md5_from_xml(content)
@@ -227,23 +202,21 @@ class HardLink:
         return result
 
     def get_image(self, content, bytesExtra, up_dir="", thumb=False) -> str:
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
+        # 原图和缩略图都可能用到，只解析一次
+        fields = decode_bytes_extra(bytesExtra, (THUMB, ORIGINAL))
         if thumb:
-            result = self.get_image_thumb(content, bytesExtra)
+            result = self.get_image_thumb(content, bytesExtra, fields)
         else:
-            result = self.get_image_original(content, bytesExtra)
+            result = self.get_image_original(content, bytesExtra, fields)
             if not (result and os.path.exists(os.path.join(up_dir, result))):
-                result = self.get_image_thumb(content, bytesExtra)
+                result = self.get_image_thumb(content, bytesExtra, fields)
         return result
 
     def get_video(self, content, bytesExtra, thumb=False):
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
-        for tmp in msg_bytes.message2:
-            if tmp.field1 != (3 if thumb else 4):
-                continue
-            pathh = tmp.field2  # wxid\FileStorage\...
+        field = THUMB if thumb else ORIGINAL
+        fields = decode_bytes_extra(bytesExtra, (field,))
+        if field in fields:
+            pathh = fields[field]  # wxid\FileStorage\...
             pathh = "\\".join(pathh.split("\\")[1:])
             return pathh
         md5 = get_md5_from_xml(content, type_="video")
@@ -261,15 +234,13 @@ class HardLink:
 
     def close(self):
         if self.open_flag:
-            try:
-                image_db_lock.acquire(True)
-                video_db_lock.acquire(True)
-                self.open_flag = False
-                self.imageDB.close()
-                self.videoDB.close()
-            finally:
-                image_db_lock.release()
-                video_db_lock.release()
+            self.open_flag = False
+            if self.image_pool:
+                self.image_pool.close()
+                self.image_pool = None
+            if self.video_pool:
+                self.video_pool.close()
+                self.video_pool = None
 
     def __del__(self):
         self.close()
@@ -1,16 +1,17 @@
+import hashlib
 import os.path
 import subprocess
 import sys
 import traceback
 from os import system
-import sqlite3
-import threading
 import xml.etree.ElementTree as ET
 from pilk import decode
 
+from app.DataBase.msg_index import ensure_media_index
+from app.DataBase.pool import ConnectionPool, database_exists
 from app.log import logger
+from app.util import media_store
 
-lock = threading.Lock()
 db_path = "./app/Database/Msg/MediaMSG.db"
 
 
@@ -38,20 +39,17 @@ def singleton(cls):
 @singleton
 class MediaMsg:
     def __init__(self):
-        self.DB = None
-        self.cursor: sqlite3.Cursor = None
+        self.pool: ConnectionPool = None
         self.open_flag = False
         self.init_database()
 
     def init_database(self):
         if not self.open_flag:
-            if os.path.exists(db_path):
-                self.DB = sqlite3.connect(db_path, check_same_thread=False)
-                # '''创建游标'''
-                self.cursor = self.DB.cursor()
+            if database_exists(db_path):
+                self.pool = ConnectionPool(db_path)
+                if not self.pool.encrypted_paths:
+                    ensure_media_index(db_path)
                 self.open_flag = True
-                if lock.locked():
-                    lock.release()
 
     def get_media_buffer(self, reserved0):
         sql = '''
@@ -59,24 +57,29 @@ class MediaMsg:
             from Media
             where Reserved0 = ?
         '''
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [reserved0])
-            result = self.cursor.fetchone()
-
-        finally:
-            lock.release()
+        if not self.open_flag:
+            return None
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql, [reserved0])
+            result = cursor.fetchone()
         return result[0] if result else None
 
     def get_audio(self, reserved0, output_path):
         buf = self.get_media_buffer(reserved0)
         if not buf:
             return ''
-        silk_path = f"{output_path}/{reserved0}.silk"
-        pcm_path = f"{output_path}/{reserved0}.pcm"
         mp3_path = f"{output_path}/{reserved0}.mp3"
         if os.path.exists(mp3_path):
             return mp3_path
+        # 同一条语音转换过一次之后从媒体库链接过来，不用再调用ffmpeg
+        key = f'voice:{hashlib.md5(buf).hexdigest()}'
+        media_store.fetch(key, mp3_path, lambda path: self._convert_audio(buf, reserved0, output_path))
+        return mp3_path
+
+    def _convert_audio(self, buf, reserved0, output_path):
+        silk_path = f"{output_path}/{reserved0}.silk"
+        pcm_path = f"{output_path}/{reserved0}.pcm"
+        mp3_path = f"{output_path}/{reserved0}.mp3"
         with open(silk_path, "wb") as f:
             f.write(buf)
         # open(silk_path, "wb").write()
@@ -109,7 +112,6 @@ class MediaMsg:
             subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         finally:
             print(mp3_path)
-        return mp3_path
 
     def get_audio_path(self, reserved0, output_path):
         mp3_path = f"{output_path}\\{reserved0}.mp3"
@@ -126,12 +128,8 @@ class MediaMsg:
 
     def close(self):
         if self.open_flag:
-            try:
-                lock.acquire(True)
-                self.open_flag = False
-                self.DB.close()
-            finally:
-                lock.release()
+            self.open_flag = False
+            self.pool.close()
 
     def __del__(self):
         self.close()
@@ -1,103 +1,375 @@
 import os
 import sqlite3
+import time
 import traceback
 
+from app.DataBase import msg_fts, msg_rollup
+from app.DataBase.msg_index import ensure_msg_indexes, ensure_media_index
+from app.DataBase.msg_rollup import ensure_msg_rollup
+from app.DataBase.pool import read_only_uri
 from app.log import logger
 
+MERGE_CACHE_SIZE_KB = 128 * 1024  # 合并时目标库的页缓存
+MERGE_STATE_TABLE = 'MSG_MERGE_STATE'  # 每个分库已经合并到的位置
 
-def merge_MediaMSG_databases(source_paths, target_path):
-    # 创建目标数据库连接
-    target_conn = sqlite3.connect(target_path)
-    target_cursor = target_conn.cursor()
+
+def _drop_secondary_indexes(conn: sqlite3.Connection, table) -> list:
+    """
+    删除表上的非唯一索引，批量插入完再重建比逐行维护索引快
+    唯一索引保留，否则重复数据会在重建时才报错
+    @return: 被删除索引的建表语句
+    """
+    dropped = []
+    for _, name, unique, *_ in conn.execute(f'PRAGMA main.index_list({table})').fetchall():
+        if unique:
+            continue
+        row = conn.execute("SELECT sql FROM main.sqlite_master WHERE type='index' AND name=?", [name]).fetchone()
+        if not row or not row[0]:
+            continue
+        conn.execute(f'DROP INDEX main."{name}"')
+        dropped.append(row[0])
+    return dropped
+
+
+def _missing_secondary_indexes(conn: sqlite3.Connection, template_path, table) -> list:
+    """
+    分库上有、目标库上没有的索引（上次全量合并中途被杀掉，删掉的索引没来得及重建）
+    @return: 建索引语句
+    """
+    template = sqlite3.connect(read_only_uri(template_path), uri=True)
+    try:
+        rows = template.execute(
+            "SELECT name,sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", [table]
+        ).fetchall()
+    finally:
+        template.close()
+    existing = {row[0] for row in conn.execute("SELECT name FROM main.sqlite_master WHERE type='index'")}
+    return [sql for name, sql in rows if name not in existing]
+
+
+def _has_merge_state(db_path) -> bool:
+    if not os.path.exists(db_path):
+        return False
+    conn = sqlite3.connect(db_path)
     try:
-        # 开始事务
-        target_conn.execute("BEGIN;")
-        for i, source_path in enumerate(source_paths):
-            if not os.path.exists(source_path):
-                continue
-            db = sqlite3.connect(source_path)
-            db.text_factory = str
-            cursor = db.cursor()
-            # 附加源数据库
-            try:
-                sql = '''SELECT Key,Reserved0,Buf,Reserved1,Reserved2 FROM Media;'''
-                cursor.execute(sql)
-                result = cursor.fetchall()
-                target_cursor.executemany(
-                    "INSERT INTO Media (Key,Reserved0,Buf,Reserved1,Reserved2)"
-                    "VALUES(?,?,?,?,?)",
-                    result)
-            except sqlite3.IntegrityError:
-                print("有重复key", "跳过")
-            except sqlite3.OperationalError:
-                print("no such table: Media", "跳过")
-            cursor.close()
-            db.close()
-        # 提交事务
-        target_conn.execute("COMMIT;")
-
-    except Exception as e:
-        # 发生异常时回滚事务
-        target_conn.execute("ROLLBACK;")
-        raise e
+        cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", [MERGE_STATE_TABLE])
+        return cursor.fetchone() is not None
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        conn.close()
+
 
+def _create_target(template_path, target_path, unique_indexes=()):
+    """
+    按分库的表结构新建空的目标库（只建表和索引，不拷贝数据），再建去重用的唯一索引和合并进度表
+    @param unique_indexes: 去重用的建索引语句
+    """
+    if os.path.exists(target_path):
+        os.remove(target_path)
+    template = sqlite3.connect(read_only_uri(template_path), uri=True)
+    try:
+        schema = template.execute(
+            "SELECT type,sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'"
+        ).fetchall()
+    finally:
+        template.close()
+    conn = sqlite3.connect(target_path)
+    try:
+        # 先建表再建索引
+        for _, sql in sorted(schema, key=lambda item: item[0] != 'table'):
+            conn.execute(sql)
+        for sql in unique_indexes:
+            conn.execute(sql)
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {MERGE_STATE_TABLE}(
+                Source TEXT PRIMARY KEY,
+                MaxRowid INTEGER,
+                MaxCreateTime INTEGER,
+                MaxMsgSvrID INTEGER
+            )
+        ''')
+        conn.commit()
     finally:
-        # 关闭目标数据库连接
-        target_conn.close()
+        conn.close()
+
+
+def _table_columns(conn: sqlite3.Connection, schema, table) -> list:
+    return [row[1] for row in conn.execute(f'PRAGMA {schema}.table_info({table})').fetchall()]
+
+
+class ShardMerger:
+    """
+    把各个分库里的同一张表增量合并到目标库，分库可以按任意顺序逐个交给merge_shard，方便解密完一个就合并一个：
+        merger = MsgMerger(target_path)
+        merger.merge_shard(path)
+        ...
+        merger.close()
+    每个分库已经拷贝到的rowid记在MSG_MERGE_STATE表里，之后只拷贝rowid更大的新行；
+    目标表上有去重用的唯一索引，重复执行不会产生重复数据
+    目标库不存在（或者是旧版本整库拷贝出来的，没有合并进度表）时按第一个分库的表结构新建，然后全量合并
+    用ATTACH把分库挂到目标库上，INSERT OR IGNORE ... SELECT在SQLite内部完成拷贝，不经过Python，内存占用和分库大小无关；
+    全量合并时先删掉非唯一索引，全部插入后（包括出错中止时）在close里重建，进程被杀掉没来得及重建的下次打开时补上；
+    始终保留回滚日志，出错可以回滚（新建的库新增的页不进日志，全量合并写日志的开销很小），只关闭同步
+    sqlite3连接不能跨线程，所有方法要在同一个线程里调用
+    """
+    table = ''
+    rowid_column = 'rowid'  # 按这一列增量拷贝
+    unique_indexes = ()  # 新建目标库时创建的去重索引
+
+    def __init__(self, target_path):
+        self.target_path = target_path
+        self.conn: sqlite3.Connection = None
+        self.rebuild = False
+        self.dropped_indexes = []
+        self.target_columns = []
+        self.stats = []  # [(分库路径, 新增行数, 耗时秒)]
+
+    def _open(self, template_path):
+        self.rebuild = not _has_merge_state(self.target_path)
+        if self.rebuild:
+            _create_target(template_path, self.target_path, self.unique_indexes)
+        # isolation_level=None：事务由下面的BEGIN/COMMIT控制，ATTACH/DETACH不能在事务里执行
+        self.conn = sqlite3.connect(self.target_path, isolation_level=None, uri=True)
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute(f'PRAGMA cache_size=-{MERGE_CACHE_SIZE_KB}')
+        self.conn.execute('PRAGMA temp_store=MEMORY')
+        if self.rebuild:
+            self.dropped_indexes = _drop_secondary_indexes(self.conn, self.table)
+        else:
+            self._upgrade_target()
+            # 合并完再建，和全量合并一样不用逐行维护
+            self.dropped_indexes = _missing_secondary_indexes(self.conn, template_path, self.table)
+        self.target_columns = _table_columns(self.conn, 'main', self.table)
+
+    def _upgrade_target(self):
+        """
+        旧版本合并出来的目标库补上后来新增的去重索引
+        """
+        for sql in self.unique_indexes:
+            self.conn.execute(sql)
+
+    def _copy_columns(self, shard_columns) -> list:
+        """
+        要拷贝的列：目标表和分库都有的列
+        """
+        return [column for column in self.target_columns if column in shard_columns]
+
+    def _new_state(self, last_rowid, max_rowid, state) -> tuple:
+        """
+        @param state: 合并进度表里原来的(MaxRowid, MaxCreateTime, MaxMsgSvrID)
+        @return: 拷贝(last_rowid, max_rowid]之后的(MaxCreateTime, MaxMsgSvrID)
+        """
+        return state[1], state[2]
+
+    def merge_shard(self, source_path):
+        """
+        合并一个分库的新数据，出错只记日志
+        @return: (分库路径, 新增行数, 耗时秒)，没有新数据或出错时返回None
+        """
+        if not os.path.exists(source_path):
+            return None
+        if self.conn is None:
+            self._open(source_path)
+        target_conn = self.conn
+        table = self.table
+        rowid = self.rowid_column
+        start = time.time()
+        source = os.path.basename(source_path)
+        target_conn.execute('ATTACH DATABASE ? AS shard', [read_only_uri(source_path)])
+        try:
+            columns = ','.join(self._copy_columns(set(_table_columns(target_conn, 'shard', table))))
+            if not columns:
+                logger.error(f'{source_path}没有{table}表，跳过')
+                return None
+            state = target_conn.execute(
+                f'SELECT MaxRowid,MaxCreateTime,MaxMsgSvrID FROM {MERGE_STATE_TABLE} WHERE Source=?', [source]
+            ).fetchone() or (0, None, None)
+            last_rowid = state[0]
+            max_rowid = target_conn.execute(f'SELECT MAX({rowid}) FROM shard.{table}').fetchone()[0] or 0
+            if max_rowid < last_rowid:
+                # 分库被重建过，从头拷贝，靠唯一索引去重
+                last_rowid = 0
+                state = (0, None, None)
+            if max_rowid == last_rowid:
+                return None
+            new_state = self._new_state(last_rowid, max_rowid, state)
+            target_conn.execute('BEGIN')
+            cursor = target_conn.execute(f'''
+                INSERT OR IGNORE INTO main.{table} ({columns})
+                SELECT {columns} FROM shard.{table}
+                WHERE {rowid}>? AND {rowid}<=?
+                ORDER BY {rowid}
+            ''', [last_rowid, max_rowid])
+            rows = cursor.rowcount
+            target_conn.execute(
+                f'INSERT OR REPLACE INTO {MERGE_STATE_TABLE}(Source,MaxRowid,MaxCreateTime,MaxMsgSvrID) '
+                f'VALUES (?,?,?,?)',
+                [source, max_rowid, *new_state]
+            )
+            target_conn.execute('COMMIT')
+            seconds = time.time() - start
+            stat = (source_path, rows, seconds)
+            self.stats.append(stat)
+            logger.info(f'合并{source_path} 新增{rows}条 耗时 {seconds:.2f}s {rows / max(seconds, 1e-6):.0f}条/s')
+            return stat
+        except sqlite3.DatabaseError:
+            if target_conn.in_transaction:
+                target_conn.execute('ROLLBACK')
+            logger.error(f'{source_path}数据库合并错误:\n{traceback.format_exc()}')
+            return None
+        finally:
+            target_conn.execute('DETACH DATABASE shard')
+
+    def _finalize(self):
+        """
+        合并完、连接关闭后执行的收尾工作
+        """
+
+    def close(self, finalize=True):
+        """
+        重建合并前删掉的索引，然后执行_finalize
+        @param finalize: False时不执行_finalize（出错中止时用），索引仍然重建
+        @return: [(分库路径, 新增行数, 耗时秒)]
+        """
+        if self.conn is None:
+            return self.stats
+        try:
+            start = time.time()
+            if self.conn.in_transaction:
+                self.conn.execute('ROLLBACK')
+            for sql in self.dropped_indexes:
+                self.conn.execute(sql)
+            if self.dropped_indexes:
+                logger.info(f'重建{len(self.dropped_indexes)}个索引 耗时 {time.time() - start:.2f}s')
+            self.dropped_indexes = []
+        except sqlite3.DatabaseError:
+            # 没建成的索引下次打开时补上
+            logger.error(f'{self.target_path}重建索引错误:\n{traceback.format_exc()}')
+        finally:
+            # 关闭目标数据库连接
+            self.conn.close()
+            self.conn = None
+        if finalize:
+            self._finalize()
+        return self.stats
+
+
+class MsgMerger(ShardMerger):
+    """
+    合并MSGn.db（包括MSG0.db）的消息，localId由目标库重新分配；
+    合并进度表里同时记下已经拷贝到的CreateTime、MsgSvrID
+    """
+    table = 'MSG'
+    rowid_column = 'localId'
+    # 同一条消息只保留一份；MsgSvrID为0或NULL的本地消息按(StrTalker,CreateTime,Type,Sequence)去重，
+    # 这几列有NULL的本地消息仍然不去重
+    unique_indexes = (
+        'CREATE UNIQUE INDEX IF NOT EXISTS IDX_MSG_SVRID_UNIQUE ON MSG(MsgSvrID) WHERE MsgSvrID<>0',
+        'CREATE UNIQUE INDEX IF NOT EXISTS IDX_MSG_LOCAL_UNIQUE ON MSG(StrTalker,CreateTime,Type,Sequence) '
+        'WHERE MsgSvrID IS NULL OR MsgSvrID=0',
+    )
+
+    def _upgrade_target(self):
+        """
+        旧版本的目标库没有本地消息的去重索引，分库重建过时本地消息会重复插入：
+        先删掉重复的（保留localId最小的），再建索引；删了数据时汇总表和全文索引要从头重建
+        """
+        exists = self.conn.execute(
+            "SELECT 1 FROM main.sqlite_master WHERE type='index' AND name='IDX_MSG_LOCAL_UNIQUE'"
+        ).fetchone()
+        if exists:
+            return
+        self.conn.execute('BEGIN')
+        cursor = self.conn.execute('''
+            DELETE FROM main.MSG
+            WHERE (MsgSvrID IS NULL OR MsgSvrID=0)
+                AND StrTalker IS NOT NULL AND CreateTime IS NOT NULL AND Type IS NOT NULL AND Sequence IS NOT NULL
+                AND localId NOT IN (
+                    SELECT min(localId) FROM main.MSG
+                    WHERE MsgSvrID IS NULL OR MsgSvrID=0
+                    GROUP BY StrTalker,CreateTime,Type,Sequence
+                )
+        ''')
+        if cursor.rowcount > 0:
+            logger.info(f'{self.target_path}删除重复的本地消息{cursor.rowcount}条')
+            for state_table in (msg_rollup.STATE_TABLE, msg_fts.STATE_TABLE):
+                exists = self.conn.execute(
+                    "SELECT 1 FROM main.sqlite_master WHERE type='table' AND name=?", [state_table]
+                ).fetchone()
+                if exists:
+                    self.conn.execute(f"DELETE FROM main.{state_table} WHERE Name='max_local_id'")
+        super()._upgrade_target()
+        self.conn.execute('COMMIT')
+
+    def _copy_columns(self, shard_columns) -> list:
+        return [column for column in super()._copy_columns(shard_columns) if column != 'localId']
+
+    def _new_state(self, last_rowid, max_rowid, state) -> tuple:
+        max_create_time, max_svr_id = self.conn.execute(
+            'SELECT max(CreateTime),max(MsgSvrID) FROM shard.MSG WHERE localId>? AND localId<=?',
+            [last_rowid, max_rowid]
+        ).fetchone()
+        max_create_time = max(value for value in (state[1], max_create_time, 0) if value is not None)
+        max_svr_id = max(value for value in (state[2], max_svr_id, 0) if value is not None)
+        return max_create_time, max_svr_id
+
+    def _finalize(self):
+        # 补齐查询用的索引，统计汇总表按localId增量更新；全文索引在打开数据库后由后台线程更新，见msg_fts
+        ensure_msg_indexes(self.target_path)
+        ensure_msg_rollup(self.target_path)
+
+
+class MediaMsgMerger(ShardMerger):
+    """
+    合并MediaMSGn.db的语音消息，按Key去重，Buf直接在SQLite里拷贝，不读进内存
+    """
+    table = 'Media'
+    unique_indexes = ('CREATE UNIQUE INDEX IF NOT EXISTS IDX_MEDIA_KEY_UNIQUE ON Media(Key)',)
+
+    def _finalize(self):
+        ensure_media_index(self.target_path)
 
 
 def merge_databases(source_paths, target_path):
-    # 创建目标数据库连接
-    target_conn = sqlite3.connect(target_path)
-    target_cursor = target_conn.cursor()
+    """
+    把各个MSGn.db（包括MSG0.db）的消息增量合并到target_path，见MsgMerger
+    @param source_paths: 分库路径列表，不存在的跳过
+    @param target_path: 目标MSG.db
+    @return: [(分库路径, 新增行数, 耗时秒)]
+    """
+    merger = MsgMerger(target_path)
     try:
-        # 开始事务
-        target_conn.execute("BEGIN;")
-        for i, source_path in enumerate(source_paths):
-            if not os.path.exists(source_path):
-                continue
-            db = sqlite3.connect(source_path)
-            db.text_factory = str
-            cursor = db.cursor()
-            try:
-                sql = '''
-                    SELECT TalkerId,MsgsvrID,Type,SubType,IsSender,CreateTime,Sequence,StrTalker,StrContent,DisplayContent,BytesExtra,CompressContent
-                    FROM MSG;
-                '''
-                cursor.execute(sql)
-                result = cursor.fetchall()
-                # 附加源数据库
-                target_cursor.executemany(
-                    "INSERT INTO MSG "
-                    "(TalkerId,MsgsvrID,Type,SubType,IsSender,CreateTime,Sequence,StrTalker,StrContent,DisplayContent,"
-                    "BytesExtra,CompressContent)"
-                    "VALUES(?,?,?,?,?,?,?,?,?,?,?,?)",
-                    result)
-            except:
-                logger.error(f'{source_path}数据库合并错误:\n{traceback.format_exc()}')
-            cursor.close()
-            db.close()
-        # 提交事务
-        target_conn.execute("COMMIT;")
-
-    except Exception as e:
-        # 发生异常时回滚事务
-        target_conn.execute("ROLLBACK;")
-        raise e
+        for source_path in source_paths:
+            merger.merge_shard(source_path)
+    except BaseException:
+        merger.close(finalize=False)
+        raise
+    return merger.close()
 
-    finally:
-        # 关闭目标数据库连接
-        target_conn.close()
+
+def merge_MediaMSG_databases(source_paths, target_path):
+    """
+    把各个MediaMSGn.db的语音消息增量合并到target_path，见MediaMsgMerger
+    @param source_paths: 分库路径列表，不存在的跳过
+    @param target_path: 目标MediaMSG.db
+    @return: [(分库路径, 新增行数, 耗时秒)]
+    """
+    merger = MediaMsgMerger(target_path)
+    try:
+        for source_path in source_paths:
+            merger.merge_shard(source_path)
+    except BaseException:
+        merger.close(finalize=False)
+        raise
+    return merger.close()
 
 
 if __name__ == "__main__":
     # 源数据库文件列表
-    source_databases = ["Msg/MSG1.db", "Msg/MSG2.db", "Msg/MSG3.db"]
+    source_databases = ["Msg/MSG0.db", "Msg/MSG1.db", "Msg/MSG2.db", "Msg/MSG3.db"]
 
     # 目标数据库文件
     target_database = "Msg/MSG.db"
-    import shutil
-
-    shutil.copy('Msg/MSG0.db', target_database)  # 使用一个数据库文件作为模板
-    # 合并数据库
+    # 合并数据库，重复执行只拷贝新消息
     merge_databases(source_databases, target_database)
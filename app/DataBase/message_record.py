@@ -0,0 +1,102 @@
+"""
+聊天记录的行对象
+兼容原来的元组下标访问（message[0]~message[13]），blob字段在第一次用到时才解析
+"""
+from app.util.protocbuf.bytes_extra import get_sender_wxid
+
+# 和msg.py里查询的列顺序一致，第13列是群聊消息的发送人
+FIELDS = (
+    'local_id',  # 0 localId
+    'talker_id',  # 1 TalkerId
+    'type',  # 2 Type
+    'sub_type',  # 3 SubType
+    'is_sender',  # 4 IsSender
+    'create_time',  # 5 CreateTime
+    'status',  # 6 Status
+    'str_content',  # 7 StrContent
+    'str_time',  # 8 StrTime
+    'msg_svr_id',  # 9 MsgSvrID
+    'bytes_extra',  # 10 BytesExtra
+    'compress_content',  # 11 CompressContent
+    'display_content',  # 12 DisplayContent
+    'sender',  # 13 msg_sender（ContactPC 或 ContactDefault），只有群聊消息才有
+)
+_COLUMN_NUM = len(FIELDS) - 1
+_UNSET = object()
+
+
+class MessageRecord:
+    __slots__ = FIELDS + ('_sender_wxid', '_content')
+
+    def __init__(self, local_id, talker_id, type_, sub_type, is_sender, create_time, status, str_content,
+                 str_time, msg_svr_id, bytes_extra, compress_content, display_content, sender=_UNSET):
+        self.local_id = local_id
+        self.talker_id = talker_id
+        self.type = type_
+        self.sub_type = sub_type
+        self.is_sender = is_sender
+        self.create_time = create_time
+        self.status = status
+        self.str_content = str_content
+        self.str_time = str_time
+        self.msg_svr_id = msg_svr_id
+        self.bytes_extra = bytes_extra
+        self.compress_content = compress_content
+        self.display_content = display_content
+        self.sender = sender
+        self._sender_wxid = None
+        self._content = None
+
+    @staticmethod
+    def row_factory(cursor, row):
+        """
+        给sqlite3游标用的row_factory，直接把查询结果构造成MessageRecord
+        """
+        return MessageRecord(*row)
+
+    def __len__(self):
+        return _COLUMN_NUM if self.sender is _UNSET else _COLUMN_NUM + 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError('MessageRecord index out of range')
+        return getattr(self, FIELDS[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield getattr(self, FIELDS[index])
+
+    def __eq__(self, other):
+        if isinstance(other, (MessageRecord, tuple)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return f'MessageRecord{tuple(self)!r}'
+
+    @property
+    def sender_wxid(self) -> str:
+        """
+        群聊消息发送人的wxid，从BytesExtra里解析，只解析一次
+        """
+        if self._sender_wxid is None:
+            self._sender_wxid = get_sender_wxid(self.bytes_extra)
+        return self._sender_wxid
+
+    @property
+    def content(self) -> str:
+        """
+        CompressContent解压后的xml，只解压一次
+        """
+        if self._content is None:
+            from app.util.compress_content import decompress_CompressContent
+            self._content = decompress_CompressContent(self.compress_content)
+        return self._content
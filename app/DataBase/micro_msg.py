@@ -1,9 +1,13 @@
 import os.path
 import sqlite3
 import threading
+import time
+
+from app.DataBase.pool import ConnectionPool, database_exists
+from app.log import logger
 
-lock = threading.Lock()
 db_path = "./app/Database/Msg/MicroMsg.db"
+CONTACT_REFRESH_INTERVAL = 5  # 检查MicroMsg.db是否变化的最短间隔（秒）
 
 
 def singleton(cls):
@@ -18,95 +22,135 @@ def singleton(cls):
 
 
 def is_database_exist():
-    return os.path.exists(db_path)
+    return database_exists(db_path)
 
 
 class MicroMsg:
     def __init__(self):
-        self.DB = None
-        self.cursor = None
+        self.pool: ConnectionPool = None
         self.open_flag = False
+        # 联系人目录：wxid -> get_contact_by_username的查询结果，首次使用时一次性加载
+        self.contacts = None
+        self.chatrooms = None  # ChatRoomName -> (ChatRoomName, RoomData)
+        self.directory_version = None  # 加载目录时MicroMsg.db的(mtime, size)
+        self.directory_checked = 0
+        self.directory_lock = threading.Lock()
         self.init_database()
 
     def init_database(self):
         if not self.open_flag:
-            if os.path.exists(db_path):
-                self.DB = sqlite3.connect(db_path, check_same_thread=False)
-                # '''创建游标'''
-                self.cursor = self.DB.cursor()
+            if database_exists(db_path):
+                self.pool = ConnectionPool(db_path)
                 self.open_flag = True
-                if lock.locked():
-                    lock.release()
+                self.clear_directory()
+
+    def clear_directory(self):
+        self.contacts = None
+        self.chatrooms = None
+        self.directory_version = None
+
+    def _db_version(self):
+        try:
+            stat = os.stat(db_path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def load_directory(self):
+        """
+        一次查询加载全部联系人（Contact + ContactHeadImgUrl + ContactLabel）和群聊，之后的查询都走内存
+        """
+        if not self.open_flag:
+            return
+        version = self._db_version()
+        start = time.time()
+        with self.pool.cursor() as cursor:
+            try:
+                sql = '''
+                       SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,ContactLabel.LabelName
+                       FROM Contact
+                       INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
+                       LEFT JOIN ContactLabel ON Contact.LabelIDList = ContactLabel.LabelId
+                    '''
+                cursor.execute(sql)
+                rows = cursor.fetchall()
+            except sqlite3.OperationalError:
+                # 解决ContactLabel表不存在的问题
+                sql = '''
+                       SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,"None"
+                       FROM Contact
+                       INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
+                '''
+                cursor.execute(sql)
+                rows = cursor.fetchall()
+            cursor.execute('''SELECT ChatRoomName, RoomData FROM ChatRoom''')
+            chatrooms = {row[0]: row for row in cursor.fetchall()}
+        contacts = {}
+        for row in rows:
+            # 和原来的fetchone一致，同一个wxid只保留第一行
+            contacts.setdefault(row[0], row)
+        # contacts最后赋值，其他线程看到contacts不为None时其余字段都已就绪
+        self.chatrooms = chatrooms
+        self.directory_version = version
+        self.directory_checked = time.monotonic()
+        self.contacts = contacts
+        logger.info(f'加载联系人目录 {len(contacts)}个联系人 {len(chatrooms)}个群聊 耗时 {time.time() - start:.2f}s')
+
+    def _ensure_directory(self):
+        if self.contacts is not None:
+            now = time.monotonic()
+            if now - self.directory_checked < CONTACT_REFRESH_INTERVAL:
+                return
+            self.directory_checked = now
+            if self._db_version() == self.directory_version:
+                return
+        with self.directory_lock:
+            if self.contacts is None or self._db_version() != self.directory_version:
+                self.load_directory()
 
     def get_contact(self):
         if not self.open_flag:
             return []
-        try:
-            lock.acquire(True)
-            sql = '''SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,COALESCE(ContactLabel.LabelName, 'None') AS labelName
-                    FROM Contact
-                    INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
-                    LEFT JOIN ContactLabel ON Contact.LabelIDList = ContactLabel.LabelId
-                    WHERE (Type!=4 AND VerifyFlag=0)
-                        AND NickName != ''
-                    ORDER BY 
-                        CASE
-                            WHEN RemarkPYInitial = '' THEN PYInitial
-                            ELSE RemarkPYInitial
-                        END ASC
-                  '''
-            self.cursor.execute(sql)
-            result = self.cursor.fetchall()
-        except sqlite3.OperationalError:
-            # lock.acquire(True)
-            sql = '''
-                   SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,"None"
-                   FROM Contact
-                   INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
-                   WHERE (Type!=4 AND VerifyFlag=0)
-                        AND NickName != ''
-                    ORDER BY 
-                        CASE
-                            WHEN RemarkPYInitial = '' THEN PYInitial
-                            ELSE RemarkPYInitial
-                        END ASC
-            '''
-            self.cursor.execute(sql)
-            result = self.cursor.fetchall()
-        finally:
-            lock.release()
+        with self.pool.cursor() as cursor:
+            try:
+                sql = '''SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,COALESCE(ContactLabel.LabelName, 'None') AS labelName
+                        FROM Contact
+                        INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
+                        LEFT JOIN ContactLabel ON Contact.LabelIDList = ContactLabel.LabelId
+                        WHERE (Type!=4 AND VerifyFlag=0)
+                            AND NickName != ''
+                        ORDER BY 
+                            CASE
+                                WHEN RemarkPYInitial = '' THEN PYInitial
+                                ELSE RemarkPYInitial
+                            END ASC
+                      '''
+                cursor.execute(sql)
+                result = cursor.fetchall()
+            except sqlite3.OperationalError:
+                sql = '''
+                       SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,"None"
+                       FROM Contact
+                       INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
+                       WHERE (Type!=4 AND VerifyFlag=0)
+                            AND NickName != ''
+                        ORDER BY 
+                            CASE
+                                WHEN RemarkPYInitial = '' THEN PYInitial
+                                ELSE RemarkPYInitial
+                            END ASC
+                '''
+                cursor.execute(sql)
+                result = cursor.fetchall()
         from app.DataBase import msg_db
         return msg_db.get_contact(result)
 
     def get_contact_by_username(self, username):
         if not self.open_flag:
             return None
-        try:
-            lock.acquire(True)
-            sql = '''
-                   SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,ContactLabel.LabelName
-                   FROM Contact
-                   INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
-                   LEFT JOIN ContactLabel ON Contact.LabelIDList = ContactLabel.LabelId
-                   WHERE UserName = ?
-                '''
-            self.cursor.execute(sql, [username])
-            result = self.cursor.fetchone()
-        except sqlite3.OperationalError:
-            # 解决ContactLabel表不存在的问题
-            # lock.acquire(True)
-            sql = '''
-                   SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,"None"
-                   FROM Contact
-                   INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
-                   WHERE UserName = ?
-            '''
-            self.cursor.execute(sql, [username])
-            result = self.cursor.fetchone()
-        finally:
-            lock.release()
-
-        return result
+        self._ensure_directory()
+        contacts = self.contacts  # close()可能在其他线程里清空目录
+        return contacts.get(username) if contacts else None
 
     def get_chatroom_info(self, chatroomname):
         '''
@@ -114,23 +158,15 @@ class MicroMsg:
         '''
         if not self.open_flag:
             return None
-        try:
-            lock.acquire(True)
-            sql = '''SELECT ChatRoomName, RoomData FROM ChatRoom WHERE ChatRoomName = ?'''
-            self.cursor.execute(sql, [chatroomname])
-            result = self.cursor.fetchone()
-        finally:
-            lock.release()
-        return result
+        self._ensure_directory()
+        chatrooms = self.chatrooms
+        return chatrooms.get(chatroomname) if chatrooms else None
 
     def close(self):
         if self.open_flag:
-            try:
-                lock.acquire(True)
-                self.open_flag = False
-                self.DB.close()
-            finally:
-                lock.release()
+            self.open_flag = False
+            self.pool.close()
+            self.clear_directory()
 
     def __del__(self):
         self.close()
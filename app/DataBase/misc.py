@@ -1,10 +1,7 @@
 import os.path
-import sqlite3
-import threading
 
-lock = threading.Lock()
-DB = None
-cursor = None
+from app.DataBase.pool import ConnectionPool, database_exists
+
 db_path = "./app/Database/Msg/Misc.db"
 
 
@@ -25,20 +22,15 @@ def singleton(cls):
 @singleton
 class Misc:
     def __init__(self):
-        self.DB = None
-        self.cursor = None
+        self.pool: ConnectionPool = None
         self.open_flag = False
         self.init_database()
 
     def init_database(self):
         if not self.open_flag:
-            if os.path.exists(db_path):
-                self.DB = sqlite3.connect(db_path, check_same_thread=False)
-                # '''创建游标'''
-                self.cursor = self.DB.cursor()
+            if database_exists(db_path):
+                self.pool = ConnectionPool(db_path)
                 self.open_flag = True
-                if lock.locked():
-                    lock.release()
 
     def get_avatar_buffer(self, userName):
         if not self.open_flag:
@@ -48,26 +40,17 @@ class Misc:
             from ContactHeadImg1
             where usrName=?;
         '''
-        if not self.open_flag:
-            self.init_database()
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [userName])
-            result = self.cursor.fetchall()
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql, [userName])
+            result = cursor.fetchall()
             if result:
                 return result[0][0]
-        finally:
-            lock.release()
         return None
 
     def close(self):
         if self.open_flag:
-            try:
-                lock.acquire(True)
-                self.open_flag = False
-                self.DB.close()
-            finally:
-                lock.release()
+            self.open_flag = False
+            self.pool.close()
 
     def __del__(self):
         self.close()
@@ -4,59 +4,41 @@ import sqlite3
 import threading
 import traceback
 from collections import defaultdict
-from datetime import datetime, date
+from datetime import date
 from typing import Tuple
 
+from app.DataBase.message_record import MessageRecord
+from app.DataBase.msg_fts import (
+    FTS_TABLE, has_msg_fts, make_snippet, match_expression, message_text, start_msg_fts_build
+)
+from app.DataBase.msg_index import missing_msg_indexes, ensure_msg_indexes
+from app.DataBase.msg_rollup import RollupQuery, ensure_msg_rollup, rollup_is_current
+from app.DataBase.msg_query import MsgQuery, MESSAGE_COLUMNS, ALL_MESSAGE_COLUMNS, convert_to_timestamp, \
+    convert_to_timestamp_, encode_page_cursor, OLDER
+from app.DataBase.pool import ConnectionPool, database_exists
 from app.log import logger
 from app.util.compress_content import parser_reply
-from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+from app.util.protocbuf.bytes_extra import get_sender_wxid
 
 db_path = "./app/Database/Msg/MSG.db"
-lock = threading.Lock()
 
-
-def is_database_exist():
-    return os.path.exists(db_path)
+# iter_messages读取blob字段的方式
+BLOBS_ALL = 'all'  # 全部读取
+BLOBS_BY_TYPE = 'by_type'  # 只读取用得到该字段的消息类型
+BLOBS_NONE = 'none'  # 都不读取（群聊仍会读取对方消息的BytesExtra来解析发送人）
+# blob字段 -> 会用到它的消息类型（图片、视频、分享类、音视频通话）
+BLOB_COLUMN_TYPES = {
+    'BytesExtra': (3, 43, 49, 50),
+    'CompressContent': (49,),
+    'DisplayContent': (50,),
+}
 
 
-def convert_to_timestamp_(time_input) -> int:
-    if isinstance(time_input, (int, float)):
-        # 如果输入是时间戳，直接返回
-        return int(time_input)
-    elif isinstance(time_input, str):
-        # 如果输入是格式化的时间字符串，将其转换为时间戳
-        try:
-            dt_object = datetime.strptime(time_input, '%Y-%m-%d %H:%M:%S')
-            return int(dt_object.timestamp())
-        except ValueError:
-            # 如果转换失败，可能是其他格式的字符串，可以根据需要添加更多的处理逻辑
-            print("Error: Unsupported date format")
-            return -1
-    elif isinstance(time_input, date):
-        # 如果输入是datetime.date对象，将其转换为时间戳
-        dt_object = datetime.combine(time_input, datetime.min.time())
-        return int(dt_object.timestamp())
-    else:
-        print("Error: Unsupported input type")
-        return -1
-
-
-def convert_to_timestamp(time_range) -> Tuple[int, int]:
-    """
-    将时间转换成时间戳
-    @param time_range:
-    @return:
-    """
-    if not time_range:
-        return 0, 0
-    else:
-        return convert_to_timestamp_(time_range[0]), convert_to_timestamp_(time_range[1])
+def is_database_exist():
+    return database_exists(db_path)
 
 
 def parser_chatroom_message(messages):
-    from app.DataBase import micro_msg_db, misc_db
-    from app.util.protocbuf.msg_pb2 import MessageBytesExtra
-    from app.person import Contact, Me, ContactDefault
     '''
     获取一个群聊的聊天记录
     return list
@@ -75,35 +57,35 @@ def parser_chatroom_message(messages):
         a[12]: DisplayContent,
         a[13]: msg_sender, （ContactPC 或 ContactDefault 类型，这个才是群聊里的信息发送人，不是群聊或者自己是发送者没有这个字段）
     '''
-    updated_messages = []  # 用于存储修改后的消息列表
+    return [tuple(message) for message in iter_chatroom_message(messages)]
+
+
+def iter_chatroom_message(messages):
+    """
+    parser_chatroom_message的生成器版本，逐条给群聊消息设置发送人，字段含义同上
+    @param messages: 任意可迭代的消息（列表或者Msg.iter_messages返回的生成器）
+    @return: generator of MessageRecord
+    """
+    from app.DataBase import micro_msg_db, misc_db
+    from app.person import Contact, Me, ContactDefault
     for row in messages:
-        message = list(row)
-        if message[4] == 1:  # 自己发送的就没必要解析了
-            message.append(Me())
-            updated_messages.append(tuple(message))
+        message = row if isinstance(row, MessageRecord) else MessageRecord(*row)
+        if message.is_sender == 1:  # 自己发送的就没必要解析了
+            message.sender = Me()
+            yield message
             continue
-        if message[10] is None:  # BytesExtra是空的跳过
-            message.append(ContactDefault(wxid))
-            updated_messages.append(tuple(message))
-            continue
-        msgbytes = MessageBytesExtra()
-        msgbytes.ParseFromString(message[10])
-        wxid = ''
-        for tmp in msgbytes.message2:
-            if tmp.field1 != 1:
-                continue
-            wxid = tmp.field2
-        if wxid == "":  # 系统消息里面 wxid 不存在
-            message.append(ContactDefault(wxid))
-            updated_messages.append(tuple(message))
+        wxid = message.sender_wxid
+        if wxid == "":  # BytesExtra是空的或者系统消息里面 wxid 不存在
+            message.sender = ContactDefault(wxid)
+            yield message
             continue
         # todo 解析还是有问题，会出现这种带:的东西
         if ':' in wxid:  # wxid_ewi8gfgpp0eu22:25319:1
             wxid = wxid.split(':')[0]
         contact_info_list = micro_msg_db.get_contact_by_username(wxid)
         if contact_info_list is None:  # 群聊中已退群的联系人不会保存在数据库里
-            message.append(ContactDefault(wxid))
-            updated_messages.append(tuple(message))
+            message.sender = ContactDefault(wxid)
+            yield message
             continue
         contact_info = {
             'UserName': contact_info_list[0],
@@ -116,9 +98,32 @@ def parser_chatroom_message(messages):
         contact = Contact(contact_info)
         contact.smallHeadImgBLOG = misc_db.get_avatar_buffer(contact.wxid)
         contact.set_avatar(contact.smallHeadImgBLOG)
-        message.append(contact)
-        updated_messages.append(tuple(message))
-    return updated_messages
+        message.sender = contact
+        yield message
+
+
+def blob_columns(blobs=BLOBS_ALL, is_chatroom=False) -> str:
+    """
+    生成iter_messages查询里BytesExtra,CompressContent,DisplayContent三列的select表达式
+    @param blobs: BLOBS_ALL/BLOBS_BY_TYPE/BLOBS_NONE
+    @param is_chatroom: 群聊需要对方消息的BytesExtra来解析发送人
+    @return:
+    """
+    columns = []
+    for column, types in BLOB_COLUMN_TYPES.items():
+        if blobs == BLOBS_ALL:
+            columns.append(column)
+            continue
+        conditions = []
+        if blobs == BLOBS_BY_TYPE:
+            conditions.append(f'Type in ({",".join(map(str, types))})')
+        if is_chatroom and column == 'BytesExtra':
+            conditions.append('IsSender=0')
+        if conditions:
+            columns.append(f'CASE WHEN {" OR ".join(conditions)} THEN {column} END AS {column}')
+        else:
+            columns.append(f'NULL AS {column}')
+    return ','.join(columns)
 
 
 def singleton(cls):
@@ -140,9 +145,10 @@ class MsgType:
 
 class Msg:
     def __init__(self):
-        self.DB = None
-        self.cursor = None
+        self.pool: ConnectionPool = None
         self.open_flag = False
+        self.rollup_ready = False  # 统计汇总表是否可用，不可用时统计接口直接扫MSG
+        self.fts_ready = False  # 全文索引是否可用，不可用时搜索退回LIKE
         self.init_database()
 
     def init_database(self, path=None):
@@ -150,35 +156,55 @@ class Msg:
         if not self.open_flag:
             if path:
                 db_path = path
-            if os.path.exists(db_path):
-                self.DB = sqlite3.connect(db_path, check_same_thread=False)
-                # '''创建游标'''
-                self.cursor = self.DB.cursor()
+            if database_exists(db_path):
+                # 只读打开，不做任何维护：导出子进程也会导入msg_db，不能在这里写MSG.db；维护见start_maintenance
+                self.pool = ConnectionPool(db_path)
+                with self.pool.cursor() as cursor:
+                    # 直接读加密数据库时没有汇总表，统计接口直接扫MSG
+                    self.rollup_ready = not self.pool.encrypted_paths and rollup_is_current(cursor)
+                    self.fts_ready = has_msg_fts(cursor)
                 self.open_flag = True
-                if lock.locked():
-                    lock.release()
+
+    def start_maintenance(self):
+        """
+        在后台线程里补建索引、更新统计汇总表，再建或增量更新全文索引，完成之前统计直接扫MSG、搜索用LIKE
+        只由界面进程在打开数据库后调用；导出子进程也会导入msg_db，不能各自去写MSG.db、抢写锁
+        合并流程（MsgMerger）已经更新过索引和汇总表，这里通常很快，主要是旧版本解密出来的数据库需要
+        """
+        if not self.open_flag or self.pool.encrypted_paths:
+            return
+        threading.Thread(target=self._maintain, args=(db_path,), name='MsgMaintenance', daemon=True).start()
+
+    def _maintain(self, path):
+        if missing_msg_indexes(path):
+            # 旧版本合并出来的数据库没有复合索引，补建一次
+            ensure_msg_indexes(path)
+        if ensure_msg_rollup(path) and self.open_flag:
+            self.rollup_ready = True
+        if self.open_flag:
+            start_msg_fts_build(path, on_done=self._on_fts_built)
+
+    def _on_fts_built(self, ok):
+        if ok and self.open_flag:
+            self.fts_ready = True
 
     def add_sender(self, messages):
         """
         @param messages:
         @return:
         """
-        new_messages = []
+        return list(self.iter_add_sender(messages))
+
+    def iter_add_sender(self, messages):
+        """
+        add_sender的生成器版本，逐条在消息末尾追加发送人wxid
+        @param messages:
+        @return: generator
+        """
         for message in messages:
             is_sender = message[4]
-            wxid = ''
-            if is_sender:
-                pass
-            else:
-                msgbytes = MessageBytesExtra()
-                msgbytes.ParseFromString(message[10])
-                for tmp in msgbytes.message2:
-                    if tmp.field1 != 1:
-                        continue
-                    wxid = tmp.field2
-            new_message = (*message, wxid)
-            new_messages.append(new_message)
-        return new_messages
+            wxid = '' if is_sender else get_sender_wxid(message[10])
+            yield (*message, wxid)
 
     def get_messages(
             self,
@@ -204,45 +230,81 @@ class Msg:
         """
         if not self.open_flag:
             return None
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f'''
-            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
-            from MSG
-            where StrTalker=?
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-            order by CreateTime
-        '''
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_])
-            result = self.cursor.fetchall()
-        finally:
-            lock.release()
+        sql, params = MsgQuery().talker(username_).time_range(time_range).order_by('CreateTime').build()
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql, params)
+            result = cursor.fetchall()
         return parser_chatroom_message(result) if username_.__contains__('@chatroom') else result
         # result.sort(key=lambda x: x[5])
         # return self.add_sender(result)
 
     def get_messages_all(self, time_range=None):
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f'''
-            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,StrTalker,Reserved1,CompressContent
-            from MSG
-            {'WHERE CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-            order by CreateTime
-        '''
         if not self.open_flag:
             return None
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql)
-            result = self.cursor.fetchall()
-        finally:
-            lock.release()
-        result.sort(key=lambda x: x[5])
+        sql, params = MsgQuery(ALL_MESSAGE_COLUMNS).time_range(time_range).order_by('CreateTime').build()
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql, params)
+            result = cursor.fetchall()
         return result
 
+    def iter_messages(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            types=None,
+            batch_size=1000,
+            blobs=BLOBS_ALL,
+    ):
+        """
+        逐批读取一个联系人的聊天记录，内存占用只和batch_size有关，与聊天记录总数无关
+        字段含义同get_messages，群聊会在末尾追加发送人
+        @param username_: 联系人wxid
+        @param time_range: 时间范围
+        @param types: 只读取这些Type的消息，None表示全部
+        @param batch_size: 每次fetchmany的条数
+        @param blobs: BytesExtra、CompressContent、DisplayContent的读取方式，BLOBS_ALL/BLOBS_BY_TYPE/BLOBS_NONE
+                      没有读取的字段为None，下标不变
+        @return: generator of MessageRecord
+        """
+        if not self.open_flag:
+            return
+        is_chatroom = username_.__contains__('@chatroom')
+        columns = MESSAGE_COLUMNS.replace('BytesExtra,CompressContent,DisplayContent', blob_columns(blobs, is_chatroom))
+        sql, params = (
+            MsgQuery(columns)
+            .talker(username_)
+            .time_range(time_range)
+            .types(types)
+            .order_by('CreateTime')
+            .build()
+        )
+        with self.pool.cursor() as cursor:
+            cursor.row_factory = MessageRecord.row_factory
+            cursor.execute(sql, params)
+            rows = self._iter_rows(cursor, batch_size)
+            if is_chatroom:
+                rows = iter_chatroom_message(rows)
+            yield from rows
+
+    def iter_messages_all(self, time_range=None, batch_size=1000):
+        """
+        get_messages_all的生成器版本，字段含义同get_messages_all
+        """
+        if not self.open_flag:
+            return
+        sql, params = MsgQuery(ALL_MESSAGE_COLUMNS).time_range(time_range).order_by('CreateTime').build()
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql, params)
+            yield from self._iter_rows(cursor, batch_size)
+
+    @staticmethod
+    def _iter_rows(cursor, batch_size):
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
     def get_messages_group_by_day(
             self,
             username_: str,
@@ -256,21 +318,10 @@ class Msg:
         """
         if not self.open_flag:
             return {}
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f'''
-            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
-            from MSG
-            where StrTalker=? AND type=1
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-            order by CreateTime;
-        '''
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_])
-            result = self.cursor.fetchall()
-        finally:
-            lock.release()
+        sql, params = MsgQuery().talker(username_).type_(1).time_range(time_range).order_by('CreateTime').build()
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql, params)
+            result = cursor.fetchall()
         result = parser_chatroom_message(result) if username_.__contains__('@chatroom') else result
 
         # 按天分组存储聊天记录
@@ -283,45 +334,71 @@ class Msg:
         return grouped_results
 
     def get_messages_length(self):
-        sql = '''
-            select count(*)
-            group by MsgSvrID
-            from MSG
-        '''
         if not self.open_flag:
             return None
+        sql, params = MsgQuery('count(*)').build()
         try:
-            lock.acquire(True)
-            self.cursor.execute(sql)
-            result = self.cursor.fetchone()
+            with self.pool.cursor() as cursor:
+                cursor.execute(sql, params)
+                result = cursor.fetchone()
         except Exception as e:
             result = None
-        finally:
-            lock.release()
-        return result[0]
+        return result[0] if result else None
 
     def get_message_by_num(self, username_, local_id):
-        sql = '''
-                select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
-                from MSG
-                where StrTalker = ? and localId < ? and (Type=1 or Type=3)
-                order by CreateTime desc 
-                limit 20
-            '''
         result = None
         if not self.open_flag:
             return None
+        sql, params = (
+            MsgQuery()
+            .talker(username_)
+            .where('localId<?', local_id)
+            .types([1, 3])
+            .order_by('CreateTime desc')
+            .limit(20)
+            .build()
+        )
         try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_, local_id])
-            result = self.cursor.fetchall()
+            with self.pool.cursor() as cursor:
+                cursor.execute(sql, params)
+                result = cursor.fetchall()
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         # result.sort(key=lambda x: x[5])
         return parser_chatroom_message(result) if username_.__contains__('@chatroom') else result
 
+    def get_message_page(self, username_, cursor=None, direction=OLDER, limit=20, types=None):
+        """
+        按(CreateTime, localId)游标翻页获取聊天记录
+        @param username_: 联系人或群聊的wxid
+        @param cursor: 上一次返回的游标，None表示从最新（OLDER）或最早（NEWER）的消息开始
+        @param direction: OLDER往前翻（按时间倒序），NEWER往后翻（按时间正序）
+        @param limit: 每页条数
+        @param types: 只返回这些Type的消息，None表示全部
+        @return: (messages, next_cursor)，没有更多消息时next_cursor为None
+        """
+        if not self.open_flag:
+            return [], None
+        sql, params = (
+            MsgQuery()
+            .talker(username_)
+            .types(types)
+            .page(cursor, direction)
+            .limit(limit)
+            .build()
+        )
+        try:
+            with self.pool.cursor() as cursor_:
+                cursor_.execute(sql, params)
+                result = cursor_.fetchall()
+        except sqlite3.DatabaseError:
+            logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
+            return [], None
+        next_cursor = encode_page_cursor(result[-1][5], result[-1][0]) if len(result) == limit else None
+        if username_.__contains__('@chatroom'):
+            result = parser_chatroom_message(result)
+        return result, next_cursor
+
     def get_messages_by_type(
             self,
             username_,
@@ -338,75 +415,61 @@ class Msg:
         """
         if not self.open_flag:
             return None
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
+        query = MsgQuery().talker(username_).type_(type_)
         if year_ == 'all':
-            sql = f'''
-                        select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
-                        from MSG
-                        where StrTalker=? and Type=? 
-                        {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-                        order by CreateTime
-                    '''
-            try:
-                lock.acquire(True)
-                self.cursor.execute(sql, [username_, type_])
-                result = self.cursor.fetchall()
-            finally:
-                lock.release()
+            query.time_range(time_range)
         else:
-            sql = '''
-                select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
-                from MSG
-                where StrTalker=? and Type=? and strftime('%Y', CreateTime, 'unixepoch', 'localtime') = ?
-                order by CreateTime
-             '''
-            try:
-                lock.acquire(True)
-                self.cursor.execute(sql, [username_, type_, year_])
-            finally:
-                lock.release()
-                result = self.cursor.fetchall()
+            query.year(year_)
+        sql, params = query.order_by('CreateTime').build()
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql, params)
+            result = cursor.fetchall()
         return result
 
     def get_messages_by_keyword(self, username_, keyword, num=5, max_len=10, time_range=None, year_='all'):
         if not self.open_flag:
             return None
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f'''
-            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra
-            from MSG
-            where StrTalker=? and Type=1 and LENGTH(StrContent)<? and StrContent like ?
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-            order by CreateTime desc
-        '''
+        columns = MESSAGE_COLUMNS.replace(',CompressContent,DisplayContent', '')
+        expression = match_expression(keyword) if self.fts_ready else ''
+        if expression:
+            # 全文索引先筛出包含关键词的消息，LIKE只在这些消息上确认原文里有这个词
+            query = MsgQuery(columns, table=f'{FTS_TABLE} JOIN MSG ON MSG.localId={FTS_TABLE}.rowid')
+            query.where(f'{FTS_TABLE} MATCH ?', expression)
+        else:
+            query = MsgQuery(columns)
+        sql, params = (
+            query
+            .talker(username_)
+            .type_(1)
+            .where('LENGTH(StrContent)<?', max_len)
+            .where('StrContent like ?', f'%{keyword}%')
+            .time_range(time_range)
+            .year(year_)
+            .order_by('CreateTime desc')
+            .build()
+        )
         temp = []
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_, max_len, f'%{keyword}%'] if year_ == "all" else [username_, max_len,
-                                                                                                  f'%{keyword}%',
-                                                                                                  year_])
-            messages = self.cursor.fetchall()
-        finally:
-            lock.release()
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql, params)
+            messages = cursor.fetchall()
         if len(messages) > 5:
             messages = random.sample(messages, num)
-        try:
-            lock.acquire(True)
+        reply_columns = MESSAGE_COLUMNS.replace(',BytesExtra,CompressContent,DisplayContent', '')
+        with self.pool.cursor() as cursor:
             for msg in messages:
                 local_id = msg[0]
                 is_send = msg[4]
-                sql = '''
-                    select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID
-                    from MSG
-                    where localId > ? and StrTalker=? and Type=1 and IsSender=?
-                    limit 1
-                '''
-                self.cursor.execute(sql, [local_id, username_, 1 - is_send])
-                temp.append((msg, self.cursor.fetchone()))
-        finally:
-            lock.release()
+                sql, params = (
+                    MsgQuery(reply_columns)
+                    .where('localId>?', local_id)
+                    .talker(username_)
+                    .type_(1)
+                    .sender(1 - is_send)
+                    .limit(1)
+                    .build()
+                )
+                cursor.execute(sql, params)
+                temp.append((msg, cursor.fetchone()))
         res = []
         for dialog in temp:
             msg1 = dialog[0]
@@ -428,16 +491,72 @@ class Msg:
         """
         return res
 
+    def search_messages(self, query, talker=None, time_range=None, limit=20, offset=0):
+        """
+        全文搜索文本消息和引用消息，按相关度排序；没有全文索引时退回LIKE，按时间倒序
+        @param query: 搜索内容，多个词时全部命中才返回
+        @param talker: 只搜索某个会话，None表示全部
+        @param time_range:
+        @param limit: 每页条数
+        @param offset: 跳过的条数，用于翻页
+        @return: [(localId, StrTalker, Type, SubType, IsSender, CreateTime, StrTime, 消息文本, 高亮片段)]
+        """
+        if not self.open_flag or not query or not query.strip():
+            return []
+        columns = (
+            "MSG.localId,StrTalker,Type,SubType,IsSender,CreateTime,"
+            "strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,"
+            "StrContent,CompressContent"
+        )
+        if self.fts_ready:
+            expression = match_expression(query)
+            if not expression:
+                return []
+            sql, params = (
+                MsgQuery(columns, table=f'{FTS_TABLE} JOIN MSG ON MSG.localId={FTS_TABLE}.rowid')
+                .where(f'{FTS_TABLE} MATCH ?', expression)
+                .talker(talker)
+                .time_range(time_range)
+                .order_by(f'bm25({FTS_TABLE}),CreateTime desc')
+                .limit(limit)
+                .offset(offset)
+                .build()
+            )
+        else:
+            sql, params = (
+                MsgQuery(columns)
+                .talker(talker)
+                .type_(1)
+                .where('StrContent like ?', f'%{query.strip()}%')
+                .time_range(time_range)
+                .order_by('CreateTime desc')
+                .limit(limit)
+                .offset(offset)
+                .build()
+            )
+        with self.pool.cursor() as cursor:
+            try:
+                cursor.execute(sql, params)
+                rows = cursor.fetchall()
+            except sqlite3.DatabaseError:
+                logger.error(f'搜索失败:{query}\n{traceback.format_exc()}')
+                return []
+        res = []
+        for local_id, str_talker, type_, sub_type, is_sender, create_time, str_time, str_content, compress_content in rows:
+            text = message_text(type_, sub_type, str_content, compress_content)
+            res.append((
+                local_id, str_talker, type_, sub_type, is_sender, create_time, str_time, text,
+                make_snippet(text, query)
+            ))
+        return res
+
     def get_contact(self, contacts):
         if not self.open_flag:
             return None
-        try:
-            lock.acquire(True)
-            sql = '''select StrTalker, MAX(CreateTime) from MSG group by StrTalker'''
-            self.cursor.execute(sql)
-            res = self.cursor.fetchall()
-        finally:
-            lock.release()
+        sql, params = MsgQuery('StrTalker, MAX(CreateTime)').group_by('StrTalker').build()
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql, params)
+            res = cursor.fetchall()
         res = {StrTalker: CreateTime for StrTalker, CreateTime in res}
         contacts = [list(cur_contact) for cur_contact in contacts]
         for i, cur_contact in enumerate(contacts):
@@ -449,25 +568,12 @@ class Msg:
         return contacts
 
     def get_messages_calendar(self, username_):
-        sql = '''
-            SELECT strftime('%Y-%m-%d',CreateTime,'unixepoch','localtime') as days
-            from (
-                SELECT MsgSvrID, CreateTime
-                FROM MSG
-                WHERE StrTalker = ?
-                ORDER BY CreateTime
-            )
-            group by days
-        '''
         if not self.open_flag:
             print('数据库未就绪')
             return None
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_])
-            result = self.cursor.fetchall()
-        finally:
-            lock.release()
+        query = RollupQuery(["strftime('%Y-%m-%d',{time},'unixepoch','localtime')"]).talker(username_)
+        with self.pool.cursor() as cursor:
+            result = query.fetch(cursor, self.rollup_ready)
         return [date[0] for date in result]
 
     def get_messages_by_days(
@@ -478,27 +584,13 @@ class Msg:
         result = None
         if not self.open_flag:
             return None
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f'''
-            SELECT strftime('%Y-%m-%d',CreateTime,'unixepoch','localtime') as days,count(MsgSvrID)
-            from (
-                SELECT MsgSvrID, CreateTime
-                FROM MSG
-                WHERE StrTalker = ?
-                {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-            )
-            group by days
-        '''
-        result = None
-        if not self.open_flag:
-            return None
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_])
-            result = self.cursor.fetchall()
-        finally:
-            lock.release()
+        query = (
+            RollupQuery(["strftime('%Y-%m-%d',{time},'unixepoch','localtime')"])
+            .talker(username_)
+            .time_range(time_range)
+        )
+        with self.pool.cursor() as cursor:
+            result = query.fetch(cursor, self.rollup_ready)
         return result
 
     def get_messages_by_month(
@@ -509,96 +601,73 @@ class Msg:
         result = None
         if not self.open_flag:
             return None
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f'''
-            SELECT strftime('%Y-%m',CreateTime,'unixepoch','localtime') as days,count(MsgSvrID)
-            from (
-                SELECT MsgSvrID, CreateTime
-                FROM MSG
-                WHERE StrTalker = ?
-                {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-            )
-            group by days
-        '''
+        query = (
+            RollupQuery(["strftime('%Y-%m',{time},'unixepoch','localtime')"])
+            .talker(username_)
+            .time_range(time_range)
+        )
         try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_])
-            result = self.cursor.fetchall()
+            with self.pool.cursor() as cursor:
+                result = query.fetch(cursor, self.rollup_ready)
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         return result
 
     def get_messages_by_hour(self, username_, time_range=None, year_='all'):
         result = []
         if not self.open_flag:
             return result
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f'''
-            SELECT strftime('%H:00',CreateTime,'unixepoch','localtime') as hours,count(MsgSvrID)
-            from (
-                SELECT MsgSvrID, CreateTime
-                FROM MSG
-                where StrTalker = ?
-                {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-            )
-            group by hours
-        '''
+        query = (
+            RollupQuery(["strftime('%H:00',{time},'unixepoch','localtime')"])
+            .talker(username_)
+            .time_range(time_range)
+        )
         try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_])
+            with self.pool.cursor() as cursor:
+                result = query.fetch(cursor, self.rollup_ready)
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
-            result = self.cursor.fetchall()
         return result
 
     def get_first_time_of_message(self, username_=''):
         if not self.open_flag:
             return None
-        sql = f'''
-            select StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime
-            from MSG
-            {'where StrTalker=?' if username_ else ''}
-            order by CreateTime
-            limit 1
-        '''
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_] if username_ else [])
-            result = self.cursor.fetchone()
-        finally:
-            lock.release()
+        sql, params = (
+            MsgQuery("StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime")
+            .talker(username_ or None)
+            .order_by('CreateTime')
+            .limit(1)
+            .build()
+        )
+        with self.pool.cursor() as cursor:
+            cursor.execute(sql, params)
+            result = cursor.fetchone()
         return result
 
     def get_latest_time_of_message(self, username_='', time_range=None, year_='all'):
         if not self.open_flag:
             return None
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f'''
-                SELECT isSender,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,
-                strftime('%H:%M:%S', CreateTime,'unixepoch','localtime') as hour
-                FROM MSG
-                WHERE Type=1 AND 
-                {'StrTalker = ? AND ' if username_ else f"'{username_}'=? AND "} 
-                hour BETWEEN '00:00:00' AND '05:00:00'
-                {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-                ORDER BY hour DESC
-                LIMIT 20;
-            '''
+        sql, params = (
+            MsgQuery(
+                "isSender,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,"
+                "strftime('%H:%M:%S', CreateTime,'unixepoch','localtime') as hour"
+            )
+            .type_(1)
+            .talker(username_ or None)
+            .where("hour BETWEEN '00:00:00' AND '05:00:00'")
+            .time_range(time_range)
+            .year(year_)
+            .order_by('hour DESC')
+            .limit(20)
+            .build()
+        )
+        result = []
         try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_, year_] if year_ != "all" else [username_])
+            with self.pool.cursor() as cursor:
+                cursor.execute(sql, params)
+                result = cursor.fetchall()
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
-            result = self.cursor.fetchall()
         if not result:
             return []
         res = []
@@ -619,59 +688,40 @@ class Msg:
         return [(type_1, subtype_1, number_1), (type_2, subtype_2, number_2), ...]\n
         be like [(1, 0, 71481), (3, 0, 6686), (49, 57, 3887), ..., (10002, 0, 1)]
         """
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f"""
-            SELECT type, subtype, Count(MsgSvrID)
-            from MSG
-            where isSender = 1
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-            group by type, subtype
-            order by Count(MsgSvrID) desc
-        """
+        query = RollupQuery(['Type', 'SubType']).sender(1).time_range(time_range)
         result = None
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
-            self.cursor.execute(sql)
-            result = self.cursor.fetchall()
+            with self.pool.cursor() as cursor:
+                result = query.fetch(cursor, self.rollup_ready)
+            result.sort(key=lambda x: x[-1], reverse=True)
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         return result
 
     def get_messages_number(
             self,
             username_,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            types=None,
     ) -> int:
         """
         统计好友聊天消息的数量
         @param username_:
         @param time_range:
+        @param types: 只统计这些Type的消息，None表示全部
         @return:
         """
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f"""
-            SELECT Count(MsgSvrID)
-            from MSG
-            where StrTalker = ?
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-        """
+        query = RollupQuery().talker(username_).time_range(time_range).types(types)
         result = 0
         if not self.open_flag:
             return 0
         try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [username_])
-            result = self.cursor.fetchone()
+            with self.pool.cursor() as cursor:
+                result = query.fetch(cursor, self.rollup_ready)[0]
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         return result[0] if result else 0
 
     def get_chatted_top_contacts(
@@ -684,29 +734,24 @@ class Msg:
         统计聊天最多的 n 个联系人（默认不包含群组），按条数降序\n
         return [(wxid_1, number_1), (wxid_2, number_2), ...]
         """
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f"""
-            SELECT strtalker, Count(MsgSvrID)
-            from MSG
-            where strtalker != "filehelper" and strtalker != "notifymessage" and strtalker not like "gh_%"
-            {"and strtalker not like '%@chatroom'" if not contain_chatroom else ""}
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-            group by strtalker
-            order by Count(MsgSvrID) desc
-            limit {top_n}
-        """
+        query = (
+            RollupQuery(['StrTalker'])
+            .where('strtalker not in (?,?)', 'filehelper', 'notifymessage')
+            .where('strtalker not like ?', 'gh_%')
+            .time_range(time_range)
+        )
+        if not contain_chatroom:
+            query.where('strtalker not like ?', '%@chatroom')
         result = None
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
-            self.cursor.execute(sql)
-            result = self.cursor.fetchall()
+            with self.pool.cursor() as cursor:
+                result = query.fetch(cursor, self.rollup_ready)
+            result.sort(key=lambda x: x[1], reverse=True)
+            result = result[:top_n]
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         return result
 
     def get_send_messages_length(
@@ -716,20 +761,10 @@ class Msg:
         """
         统计自己总共发消息的字数，包含type=1的文本和type=49,subtype=57里面自己发的文本
         """
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql_type_1 = f"""
-            SELECT sum(length(strContent))
-            from MSG
-            where isSender = 1 and type = 1
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-        """
-        sql_type_49 = f"""
-            SELECT CompressContent
-            from MSG
-            where isSender = 1 and type = 49 and subtype = 57
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-        """
+        query_type_1 = RollupQuery(values=['length']).sender(1).type_(1).time_range(time_range)
+        sql_type_49, params_type_49 = (
+            MsgQuery('CompressContent').sender(1).type_(49).subtypes([57]).time_range(time_range).build()
+        )
         sum_type_1 = None
         result_type_49 = None
         sum_type_49 = 0
@@ -737,11 +772,10 @@ class Msg:
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
-            self.cursor.execute(sql_type_1)
-            sum_type_1 = self.cursor.fetchall()[0][0]
-            self.cursor.execute(sql_type_49)
-            result_type_49 = self.cursor.fetchall()
+            with self.pool.cursor() as cursor:
+                sum_type_1 = query_type_1.fetch(cursor, self.rollup_ready)[0][0]
+                cursor.execute(sql_type_49, params_type_49)
+                result_type_49 = cursor.fetchall()
             for message in result_type_49:
                 message = message[0]
                 content = parser_reply(message)
@@ -750,34 +784,22 @@ class Msg:
                 sum_type_49 += len(content["title"])
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
-        return sum_type_1 + sum_type_49
+        return (sum_type_1 or 0) + sum_type_49
 
     def get_send_messages_number_sum(
             self,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
     ) -> int:
         """统计自己总共发了多少条消息"""
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f"""
-            SELECT count(MsgSvrID)
-            from MSG
-            where isSender = 1
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-        """
+        query = RollupQuery().sender(1).time_range(time_range)
         result = None
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
-            self.cursor.execute(sql)
-            result = self.cursor.fetchall()[0][0]
+            with self.pool.cursor() as cursor:
+                result = query.fetch(cursor, self.rollup_ready)[0][0]
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         return result
 
     def get_send_messages_number_by_hour(
@@ -788,30 +810,20 @@ class Msg:
         统计每个（小时）时段自己总共发了多少消息，从最多到最少排序\n
         return be like [('23', 9526), ('00', 7890), ('22', 7600),  ..., ('05', 29)]
         """
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql = f"""
-            SELECT strftime('%H', CreateTime, 'unixepoch', 'localtime') as hour,count(MsgSvrID)
-            from (
-                SELECT MsgSvrID, CreateTime
-                FROM MSG
-                where isSender = 1
-                    {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-            )
-            group by hour
-            order by count(MsgSvrID) desc
-        """
+        query = (
+            RollupQuery(["strftime('%H', {time}, 'unixepoch', 'localtime')"])
+            .sender(1)
+            .time_range(time_range)
+        )
         result = None
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
-            self.cursor.execute(sql)
-            result = self.cursor.fetchall()
+            with self.pool.cursor() as cursor:
+                result = query.fetch(cursor, self.rollup_ready)
+            result.sort(key=lambda x: x[1], reverse=True)
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         return result
 
     def get_message_length(
@@ -822,22 +834,10 @@ class Msg:
         """
                 统计自己总共发消息的字数，包含type=1的文本和type=49,subtype=57里面自己发的文本
                 """
-        if time_range:
-            start_time, end_time = convert_to_timestamp(time_range)
-        sql_type_1 = f"""
-                    SELECT sum(length(strContent))
-                    from MSG
-                    where  StrTalker = ? and
-                    type = 1
-                    {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-                """
-        sql_type_49 = f"""
-                    SELECT CompressContent
-                    from MSG
-                    where  StrTalker = ? and
-                    type = 49 and subtype = 57
-                    {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
-                """
+        query_type_1 = RollupQuery(values=['length']).talker(username_).type_(1).time_range(time_range)
+        sql_type_49, params_type_49 = (
+            MsgQuery('CompressContent').talker(username_).type_(49).subtypes([57]).time_range(time_range).build()
+        )
         sum_type_1 = 0
         result_type_1 = 0
         result_type_49 = 0
@@ -846,15 +846,12 @@ class Msg:
         if not self.open_flag:
             return None
         try:
-            lock.acquire(True)
-            self.cursor.execute(sql_type_1, [username_])
-            result_type_1 = self.cursor.fetchall()[0][0]
-            self.cursor.execute(sql_type_49, [username_])
-            result_type_49 = self.cursor.fetchall()
+            with self.pool.cursor() as cursor:
+                result_type_1 = query_type_1.fetch(cursor, self.rollup_ready)[0][0]
+                cursor.execute(sql_type_49, params_type_49)
+                result_type_49 = cursor.fetchall()
         except sqlite3.DatabaseError:
             logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
         for message in result_type_49:
             message = message[0]
             content = parser_reply(message)
@@ -864,14 +861,59 @@ class Msg:
         sum_type_1 = result_type_1 if result_type_1 else 0
         return sum_type_1 + sum_type_49
 
+    def get_messages_weekday_statistics(
+            self,
+            username_=None,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> list:
+        """
+        按消息类型、发送方、星期统计消息条数和文本长度，给年度报告/聊天统计用
+        @param username_: 联系人wxid，None表示所有联系人
+        @param time_range:
+        @return: [(type, subtype, is_sender, weekday(0是周日), 条数, 文本长度), ...]
+        """
+        if not self.open_flag:
+            return []
+        query = (
+            RollupQuery(['Type', 'SubType', 'IsSender', "strftime('%w',{time},'unixepoch','localtime')"],
+                        values=['rows', 'length'])
+            .talker(username_)
+            .time_range(time_range)
+        )
+        result = []
+        try:
+            with self.pool.cursor() as cursor:
+                result = query.fetch(cursor, self.rollup_ready)
+        except sqlite3.DatabaseError:
+            logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
+        return result
+
+    def get_send_messages_text(
+            self,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> str:
+        """
+        自己发送的所有文本消息拼接在一起，用于生成词云
+        """
+        if not self.open_flag:
+            return ''
+        sql, params = (
+            MsgQuery('StrContent').sender(1).type_(1).subtypes([0]).time_range(time_range).order_by('CreateTime')
+            .build()
+        )
+        result = []
+        try:
+            with self.pool.cursor() as cursor:
+                cursor.execute(sql, params)
+                result = cursor.fetchall()
+        except sqlite3.DatabaseError:
+            logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
+        return ''.join(row[0] for row in result if row[0])
+
     def close(self):
         if self.open_flag:
-            try:
-                lock.acquire(True)
-                self.open_flag = False
-                self.DB.close()
-            finally:
-                lock.release()
+            self.open_flag = False
+            self.pool.close()
 
     def __del__(self):
         self.close()
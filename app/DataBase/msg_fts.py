@@ -0,0 +1,175 @@
+"""
+MSG.db 全文索引
+文本消息和引用消息的标题先用jieba分词，再以空格连接写进FTS5表，rowid就是MSG的localId
+FTS5表不保存原文（content=''），查询时再和MSG关联取出原文
+按localId增量更新；jieba分词很慢，不在解密合并的流程里做，界面进程打开数据库后在后台线程里建（Msg.start_maintenance），导出子进程不建，
+也可以离线执行：python -m app.DataBase.msg_fts MSG.db
+"""
+import os.path
+import re
+import sqlite3
+import threading
+import time
+import traceback
+
+from app.log import logger
+
+FTS_TABLE = 'MSG_FTS'
+STATE_TABLE = 'MSG_FTS_STATE'
+BATCH_SIZE = 5000
+
+
+_building = set()  # 正在后台建索引的数据库
+_building_lock = threading.Lock()
+
+
+def has_msg_fts(conn: sqlite3.Connection) -> bool:
+    """
+    全文索引是否建完：进度表的建表语句单独提交，索引数据和进度记录在同一个事务里提交，
+    只有进度记录存在才说明索引完整，中途中断的不算
+    """
+    cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", [STATE_TABLE])
+    if cursor.fetchone() is None:
+        return False
+    cursor = conn.execute(f"SELECT Value FROM {STATE_TABLE} WHERE Name='max_local_id'")
+    return cursor.fetchone() is not None
+
+
+def tokenize(text) -> list:
+    """
+    jieba搜索引擎模式分词，去掉纯标点和空白
+    """
+    import jieba
+    if not text:
+        return []
+    return [word for word in jieba.cut_for_search(text.lower()) if any(ch.isalnum() for ch in word)]
+
+
+def match_expression(query) -> str:
+    """
+    把用户输入转换成FTS5的MATCH表达式：分词后每个词作为短语，全部命中才算匹配
+    """
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in tokenize(query))
+
+
+def message_text(type_, sub_type, str_content, compress_content) -> str:
+    """
+    需要建索引的文本：文本消息取StrContent，引用消息取CompressContent里的标题
+    """
+    if type_ == 1:
+        return str_content or ''
+    if type_ == 49 and sub_type == 57:
+        from app.util.compress_content import parser_reply
+        content = parser_reply(compress_content)
+        return '' if content.get('is_error') else content.get('title') or ''
+    return ''
+
+
+def make_snippet(text, query, width=20, left='<b>', right='</b>') -> str:
+    """
+    截取第一个命中词前后width个字，并高亮所有命中词
+    """
+    if not text:
+        return ''
+    words = sorted(set(tokenize(query)), key=len, reverse=True)
+    if not words:
+        return text[:width * 2]
+    pattern = re.compile('|'.join(re.escape(word) for word in words), re.IGNORECASE)
+    match = pattern.search(text)
+    if match is None:
+        return text[:width * 2]
+    start = max(0, match.start() - width)
+    end = min(len(text), match.end() + width)
+    snippet = pattern.sub(lambda m: f'{left}{m.group(0)}{right}', text[start:end])
+    return ('...' if start > 0 else '') + snippet + ('...' if end < len(text) else '')
+
+
+def ensure_msg_fts(db_path) -> bool:
+    """
+    创建或增量更新全文索引：只索引localId大于上次记录的新消息；MSG被替换（localId变小）时重建
+    @param db_path: MSG.db路径
+    @return: 全文索引是否可用
+    """
+    if not os.path.exists(db_path):
+        return False
+    try:
+        import jieba
+    except ImportError:
+        logger.error('没有安装jieba，跳过全文索引')
+        return False
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {STATE_TABLE}(Name TEXT PRIMARY KEY, Value INTEGER)')
+        row = conn.execute(f"SELECT Value FROM {STATE_TABLE} WHERE Name='max_local_id'").fetchone()
+        last_id = row[0] if row else None
+        max_id = conn.execute('SELECT MAX(localId) FROM MSG').fetchone()[0] or 0
+        if last_id is None or max_id < last_id:
+            # contentless的FTS5表不能按行删除，直接重建
+            conn.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+            last_id = 0
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(Tokens, content='')")
+        if max_id > last_id:
+            start = time.time()
+            num = 0
+            reader = conn.cursor()
+            reader.execute('''
+                SELECT localId,Type,SubType,StrContent,CompressContent
+                FROM MSG
+                WHERE localId>? AND localId<=? AND (Type=1 OR (Type=49 AND SubType=57))
+            ''', [last_id, max_id])
+            while True:
+                rows = reader.fetchmany(BATCH_SIZE)
+                if not rows:
+                    break
+                docs = []
+                for local_id, type_, sub_type, str_content, compress_content in rows:
+                    tokens = tokenize(message_text(type_, sub_type, str_content, compress_content))
+                    if tokens:
+                        docs.append((local_id, ' '.join(tokens)))
+                conn.executemany(f'INSERT INTO {FTS_TABLE}(rowid,Tokens) VALUES (?,?)', docs)
+                num += len(docs)
+            reader.close()
+            conn.execute(f"INSERT OR REPLACE INTO {STATE_TABLE}(Name,Value) VALUES ('max_local_id',?)", [max_id])
+            logger.info(f'更新全文索引 {num}条 localId {last_id}->{max_id} 耗时 {time.time() - start:.2f}s')
+        conn.commit()
+        return True
+    except sqlite3.DatabaseError:
+        conn.rollback()
+        logger.error(f'{db_path}全文索引更新失败:\n{traceback.format_exc()}')
+        return False
+    finally:
+        conn.close()
+
+
+def start_msg_fts_build(db_path, on_done=None):
+    """
+    在后台线程里创建或更新全文索引，同一个数据库同时只建一个
+    @param db_path: MSG.db路径
+    @param on_done: 建完后在后台线程里回调 on_done(全文索引是否可用)
+    @return: 后台线程，已经在建时返回None
+    """
+    key = os.path.abspath(db_path)
+    with _building_lock:
+        if key in _building:
+            return None
+        _building.add(key)
+
+    def build():
+        try:
+            ok = ensure_msg_fts(db_path)
+        finally:
+            with _building_lock:
+                _building.discard(key)
+        if on_done:
+            on_done(ok)
+
+    thread = threading.Thread(target=build, name='MsgFtsBuilder', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    # 离线建索引
+    import sys
+
+    print(ensure_msg_fts(sys.argv[1] if len(sys.argv) > 1 else './app/Database/Msg/MSG.db'))
@@ -0,0 +1,228 @@
+"""
+MSG.db、MediaMSG.db 索引维护
+合并后的MSG.db只是MSG0.db的拷贝加上批量插入的数据，这里负责补齐查询用到的复合索引并更新统计信息
+"""
+import os.path
+import sqlite3
+import time
+import traceback
+
+from app.log import logger
+
+# (索引名, 索引列)，msg.py里的查询基本都是按StrTalker过滤、按CreateTime排序或过滤
+# 只按CreateTime查询用微信自带的MSG_CREATETIME；已经有索引以这些列开头时不再建
+MSG_INDEXES = [
+    ('IDX_MSG_TALKER_TIME', ('StrTalker', 'CreateTime')),
+    ('IDX_MSG_TALKER_TYPE_TIME', ('StrTalker', 'Type', 'CreateTime')),
+    ('IDX_MSG_SENDER_TIME', ('IsSender', 'CreateTime')),
+]
+
+# 旧版本建过、和微信自带索引重复的索引，有其他索引覆盖时删掉
+LEGACY_MSG_INDEXES = [
+    ('IDX_MSG_TIME', ('CreateTime',)),
+]
+
+# MediaMsg.get_media_buffer按Reserved0（语音消息的MsgSvrID）查找
+MEDIA_INDEX = ('IDX_MEDIA_RESERVED0', ('Reserved0',))
+
+
+def get_msg_indexes(conn: sqlite3.Connection) -> set:
+    cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='MSG'")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def get_msg_index_columns(conn: sqlite3.Connection) -> dict:
+    """
+    @return: {索引名: (索引列, ...)}，不包括带WHERE的部分索引（只覆盖一部分行）
+    """
+    indexes = {}
+    for _, name, _, _, partial in conn.execute('PRAGMA index_list(MSG)').fetchall():
+        if partial:
+            continue
+        indexes[name] = tuple(row[2] for row in conn.execute(f'PRAGMA index_info("{name}")').fetchall())
+    return indexes
+
+
+def _covered_by(indexes: dict, columns, exclude=None) -> str | None:
+    """
+    @return: 以columns开头的索引名（不算exclude），没有返回None
+    """
+    for name, index_columns in indexes.items():
+        if name != exclude and index_columns[:len(columns)] == tuple(columns):
+            return name
+    return None
+
+
+def _missing(conn: sqlite3.Connection) -> list:
+    indexes = get_msg_index_columns(conn)
+    return [(name, columns) for name, columns in MSG_INDEXES
+            if name not in indexes and not _covered_by(indexes, columns)]
+
+
+def missing_msg_indexes(db_path) -> list:
+    """
+    返回MSG.db中缺少的索引名（已经有其他索引以同样的列开头的不算缺少）
+    """
+    if not os.path.exists(db_path):
+        return []
+    conn = sqlite3.connect(db_path)
+    try:
+        return [name for name, _ in _missing(conn)]
+    except sqlite3.DatabaseError:
+        logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
+        return []
+    finally:
+        conn.close()
+
+
+def ensure_msg_indexes(db_path, analyze=True) -> list:
+    """
+    创建缺少的索引并执行ANALYZE，删掉旧版本建的重复索引
+    @param db_path: MSG.db路径
+    @param analyze: 是否更新统计信息
+    @return: 新建的索引名
+    """
+    if not os.path.exists(db_path):
+        return []
+    created = []
+    conn = sqlite3.connect(db_path)
+    try:
+        indexes = get_msg_index_columns(conn)
+        for name, columns in LEGACY_MSG_INDEXES:
+            if name in indexes and _covered_by(indexes, columns, exclude=name):
+                conn.execute(f'DROP INDEX IF EXISTS {name}')
+                logger.info(f'删除重复的索引 {name}{columns}')
+        for name, columns in _missing(conn):
+            start = time.time()
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON MSG ({",".join(columns)})')
+            created.append(name)
+            logger.info(f'创建索引 {name}{columns} 耗时 {time.time() - start:.2f}s')
+        if analyze and (created or not has_statistics(conn)):
+            conn.execute('ANALYZE MSG')
+        conn.commit()
+    except sqlite3.DatabaseError:
+        conn.rollback()
+        logger.error(f'{db_path}索引创建失败:\n{traceback.format_exc()}')
+    finally:
+        conn.close()
+    return created
+
+
+def has_statistics(conn: sqlite3.Connection) -> bool:
+    try:
+        return conn.execute("SELECT 1 FROM sqlite_stat1 WHERE tbl='MSG' LIMIT 1").fetchone() is not None
+    except sqlite3.OperationalError:
+        # 从未ANALYZE过，sqlite_stat1不存在
+        return False
+
+
+def explain_msg_queries(msg=None, username_='', time_range=None):
+    """
+    诊断工具：执行msg.py里的每个查询，打印其EXPLAIN QUERY PLAN，标出MSG表的全表扫描
+    @param msg: Msg对象，默认使用app.DataBase.msg_db
+    @param username_: 用于测试的联系人wxid，默认取消息最多的联系人
+    @param time_range: 用于测试的时间范围，默认最近30天，避免在大库上把整个表读出来
+    @return: {sql: [plan行]}
+    """
+    if msg is None:
+        from app.DataBase import msg_db as msg
+    if not msg.open_flag:
+        print('数据库未就绪')
+        return {}
+    if not username_:
+        top = msg.get_chatted_top_contacts(contain_chatroom=True, top_n=1)
+        username_ = top[0][0] if top else ''
+    if not time_range:
+        now = int(time.time())
+        time_range = (now - 30 * 24 * 3600, now)
+
+    statements = []
+    msg.pool.set_trace_callback(statements.append)
+    try:
+        for name, args, kwargs in [
+            ('get_messages', (username_,), {'time_range': time_range}),
+            ('get_messages_all', (), {'time_range': time_range}),
+            ('get_messages_group_by_day', (username_,), {'time_range': time_range}),
+            ('get_message_by_num', (username_, 9999999999), {}),
+            ('get_message_page', (username_, '9999999999:0'), {}),
+            ('get_messages_by_type', (username_, 1), {'time_range': time_range}),
+            ('get_messages_by_type', (username_, 1), {'year_': '2023'}),
+            ('get_messages_by_keyword', (username_, '的'), {'time_range': time_range}),
+            ('get_contact', ([],), {}),
+            ('get_messages_calendar', (username_,), {}),
+            ('get_messages_by_days', (username_,), {'time_range': time_range}),
+            ('get_messages_by_month', (username_,), {'time_range': time_range}),
+            ('get_messages_by_hour', (username_,), {'time_range': time_range}),
+            ('get_first_time_of_message', (username_,), {}),
+            ('get_latest_time_of_message', (username_,), {'time_range': time_range}),
+            ('get_send_messages_type_number', (), {'time_range': time_range}),
+            ('get_messages_number', (username_,), {'time_range': time_range}),
+            ('get_chatted_top_contacts', (), {'time_range': time_range}),
+            ('get_send_messages_length', (), {'time_range': time_range}),
+            ('get_send_messages_number_sum', (), {'time_range': time_range}),
+            ('get_send_messages_number_by_hour', (), {'time_range': time_range}),
+            ('get_message_length', (username_,), {'time_range': time_range}),
+        ]:
+            try:
+                getattr(msg, name)(*args, **kwargs)
+            except Exception:
+                logger.error(f'{name}执行失败:\n{traceback.format_exc()}')
+    finally:
+        msg.pool.set_trace_callback(None)
+
+    plans = {}
+    with msg.pool.cursor() as cursor:
+        for sql in statements:
+            sql = sql.strip()
+            if sql in plans or not sql.lower().startswith('select'):
+                continue
+            try:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            except sqlite3.DatabaseError:
+                continue
+            plans[sql] = [row[3] for row in cursor.fetchall()]
+    for sql, plan in plans.items():
+        print('=' * 32)
+        print(' '.join(sql.split()))
+        for detail in plan:
+            # SCAN MSG 后面没有 USING INDEX 的就是全表扫描
+            flag = '  <-- 全表扫描' if detail.startswith('SCAN MSG') and 'INDEX' not in detail else ''
+            print(f'    {detail}{flag}')
+    return plans
+
+
+def ensure_media_index(db_path) -> bool:
+    """
+    给MediaMSG.db的Media表补建Reserved0索引（旧版本合并出来的数据库没有）
+    @param db_path: MediaMSG.db路径
+    @return: 是否新建了索引
+    """
+    if not os.path.exists(db_path):
+        return False
+    name, columns = MEDIA_INDEX
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND name=?", [name])
+        if cursor.fetchone() is not None:
+            return False
+        start = time.time()
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON Media ({",".join(columns)})')
+        conn.commit()
+        logger.info(f'创建索引 {name}{columns} 耗时 {time.time() - start:.2f}s')
+        return True
+    except sqlite3.DatabaseError:
+        conn.rollback()
+        logger.error(f'{db_path}索引创建失败:\n{traceback.format_exc()}')
+        return False
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    db_path = './Msg/MSG.db'
+    print(ensure_msg_indexes(db_path))
+    from app.DataBase import msg_db
+
+    msg_db.init_database(db_path)
+    explain_msg_queries(msg_db)
+
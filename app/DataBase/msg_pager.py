@@ -0,0 +1,66 @@
+"""
+聊天记录翻页
+返回当前页的同时在后台线程预取下一页，界面翻页时通常不用再等数据库
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from app.DataBase.msg_query import OLDER
+
+
+class MessagePager:
+    """
+    用法：
+        pager = MessagePager(msg_db, wxid)
+        messages = pager.next_page()  # 第一页是最新的消息，按时间倒序
+        ...
+        pager.close()
+    """
+
+    def __init__(self, msg, username_, direction=OLDER, page_size=20, types=None, cursor=None):
+        """
+        @param msg: Msg对象
+        @param username_: 联系人或群聊的wxid
+        @param direction: 同Msg.get_message_page
+        @param page_size: 每页条数
+        @param types: 只返回这些Type的消息，None表示全部
+        @param cursor: 起始游标，None表示从头开始
+        """
+        self.msg = msg
+        self.username_ = username_
+        self.direction = direction
+        self.page_size = page_size
+        self.types = types
+        self.cursor = cursor
+        self.finished = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='MessagePager')
+        self._future = None
+
+    def _fetch(self, cursor):
+        return self.msg.get_message_page(self.username_, cursor, self.direction, self.page_size, self.types)
+
+    def prefetch(self):
+        """
+        提前在后台取下一页，重复调用不会重复查询
+        """
+        if not self.finished and self._future is None:
+            self._future = self._executor.submit(self._fetch, self.cursor)
+
+    def next_page(self) -> list:
+        """
+        @return: 下一页消息，没有更多时返回空列表
+        """
+        if self.finished:
+            return []
+        self.prefetch()
+        future, self._future = self._future, None
+        messages, self.cursor = future.result()
+        if self.cursor is None:
+            self.finished = True
+        else:
+            self.prefetch()
+        return messages
+
+    def close(self):
+        self.finished = True
+        self._future = None
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,207 @@
+"""
+MSG表查询构造器
+msg.py里的查询都由这里拼出参数化的SQL：条件的值全部走?占位符，同一种查询的SQL文本保持不变，
+这样sqlite3连接上的预编译语句缓存（见ConnectionPool的cached_statements）才能命中
+"""
+from datetime import datetime, date
+from typing import Tuple
+
+# get_messages等接口返回的13个字段
+MESSAGE_COLUMNS = (
+    "localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,"
+    "strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,"
+    "MsgSvrID,BytesExtra,CompressContent,DisplayContent"
+)
+# get_messages_all返回的字段
+ALL_MESSAGE_COLUMNS = (
+    "localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,"
+    "strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,"
+    "MsgSvrID,BytesExtra,StrTalker,Reserved1,CompressContent"
+)
+
+# 翻页方向
+OLDER = 'older'
+NEWER = 'newer'
+
+
+def encode_page_cursor(create_time, local_id) -> str:
+    """
+    翻页游标，调用方不需要关心内容，原样传回即可
+    """
+    return f'{create_time}:{local_id}'
+
+
+def decode_page_cursor(cursor) -> Tuple[int, int]:
+    try:
+        create_time, local_id = cursor.split(':')
+        return int(create_time), int(local_id)
+    except (AttributeError, ValueError):
+        raise ValueError(f'无效的翻页游标:{cursor!r}')
+
+
+def convert_to_timestamp_(time_input) -> int:
+    if isinstance(time_input, (int, float)):
+        # 如果输入是时间戳，直接返回
+        return int(time_input)
+    elif isinstance(time_input, str):
+        # 如果输入是格式化的时间字符串，将其转换为时间戳
+        try:
+            dt_object = datetime.strptime(time_input, '%Y-%m-%d %H:%M:%S')
+            return int(dt_object.timestamp())
+        except ValueError:
+            # 如果转换失败，可能是其他格式的字符串，可以根据需要添加更多的处理逻辑
+            print("Error: Unsupported date format")
+            return -1
+    elif isinstance(time_input, date):
+        # 如果输入是datetime.date对象，将其转换为时间戳
+        dt_object = datetime.combine(time_input, datetime.min.time())
+        return int(dt_object.timestamp())
+    else:
+        print("Error: Unsupported input type")
+        return -1
+
+
+def convert_to_timestamp(time_range) -> Tuple[int, int]:
+    """
+    将时间转换成时间戳
+    @param time_range:
+    @return:
+    """
+    if not time_range:
+        return 0, 0
+    else:
+        return convert_to_timestamp_(time_range[0]), convert_to_timestamp_(time_range[1])
+
+
+def year_range(year_) -> Tuple[int, int]:
+    """
+    某一年（本地时间）的起止时间戳，左闭右开
+    """
+    year_ = int(year_)
+    return int(datetime(year_, 1, 1).timestamp()), int(datetime(year_ + 1, 1, 1).timestamp())
+
+
+class MsgQuery:
+    """
+    链式构造MSG表的查询，例如
+        sql, params = MsgQuery().talker(wxid).types([1, 3]).time_range(time_range).order_by('CreateTime').build()
+    传入None（或year_='all'）的条件会被忽略，方便直接透传接口参数
+    """
+
+    def __init__(self, columns=MESSAGE_COLUMNS, table='MSG'):
+        self.columns = columns
+        self.table = table
+        self.conditions = []
+        self.params = []
+        self.group = ''
+        self.order = ''
+        self.limit_ = None
+        self.offset_ = None
+
+    def where(self, condition, *params):
+        self.conditions.append(condition)
+        self.params.extend(params)
+        return self
+
+    def _in(self, column, values):
+        if values is None:
+            return self
+        values = list(values)
+        if len(values) == 1:
+            return self.where(f'{column}=?', values[0])
+        return self.where(f'{column} in ({",".join("?" * len(values))})', *values)
+
+    def talker(self, username_):
+        if username_ is None:
+            return self
+        return self.where('StrTalker=?', username_)
+
+    def types(self, types):
+        """
+        @param types: Type列表，None或空列表表示不过滤
+        """
+        return self._in('Type', types or None)
+
+    def type_(self, type_):
+        if type_ is None:
+            return self
+        return self.where('Type=?', type_)
+
+    def subtypes(self, subtypes):
+        return self._in('SubType', subtypes or None)
+
+    def sender(self, is_sender):
+        """
+        @param is_sender: 1自己发送 0对方发送 None不过滤
+        """
+        if is_sender is None:
+            return self
+        return self.where('IsSender=?', is_sender)
+
+    def time_range(self, time_range):
+        if not time_range:
+            return self
+        start_time, end_time = convert_to_timestamp(time_range)
+        return self.where('CreateTime>? AND CreateTime<?', start_time, end_time)
+
+    def year(self, year_):
+        """
+        按本地时间的年份过滤，换算成CreateTime的范围以便走索引
+        """
+        if not year_ or year_ == 'all':
+            return self
+        start_time, end_time = year_range(year_)
+        return self.where('CreateTime>=? AND CreateTime<?', start_time, end_time)
+
+    def page(self, cursor=None, direction=OLDER):
+        """
+        按(CreateTime, localId)做游标翻页，CreateTime相同的消息用localId区分，不会跳过或重复
+        @param cursor: 上一页最后一条消息的游标，None表示从头（最新或最早）开始
+        @param direction: OLDER往前翻，结果按时间倒序；NEWER往后翻，结果按时间正序
+        """
+        if direction == OLDER:
+            op, order = '<', 'desc'
+        elif direction == NEWER:
+            op, order = '>', 'asc'
+        else:
+            raise ValueError(f'无效的翻页方向:{direction!r}')
+        if cursor:
+            create_time, local_id = decode_page_cursor(cursor)
+            # 先用CreateTime限定索引范围，再排除同一秒里已经返回过的消息
+            self.where(
+                f'CreateTime{op}=? AND (CreateTime{op}? OR localId{op}?)', create_time, create_time, local_id
+            )
+        return self.order_by(f'CreateTime {order},localId {order}')
+
+    def group_by(self, columns):
+        self.group = columns
+        return self
+
+    def order_by(self, order):
+        self.order = order
+        return self
+
+    def limit(self, limit_):
+        self.limit_ = limit_
+        return self
+
+    def offset(self, offset_):
+        self.offset_ = offset_
+        return self
+
+    def build(self) -> Tuple[str, list]:
+        sql = f'SELECT {self.columns} FROM {self.table}'
+        params = list(self.params)
+        if self.conditions:
+            sql += ' WHERE ' + ' AND '.join(self.conditions)
+        if self.group:
+            sql += f' GROUP BY {self.group}'
+        if self.order:
+            sql += f' ORDER BY {self.order}'
+        if self.limit_ is not None:
+            sql += ' LIMIT ?'
+            params.append(self.limit_)
+            if self.offset_:
+                sql += ' OFFSET ?'
+                params.append(self.offset_)
+        return sql, params
@@ -0,0 +1,220 @@
+"""
+MSG.db 统计汇总表
+按 (StrTalker, 本地时间的整点, IsSender, Type, SubType) 预先汇总消息条数和文本长度，
+统计类接口（日历、按天/月/小时统计、聊天排行、年度报告等）读这张表，不再逐行扫描MSG
+合并后按localId增量更新
+"""
+import os.path
+import sqlite3
+import time
+import traceback
+
+from app.DataBase.msg_query import MsgQuery, convert_to_timestamp
+from app.log import logger
+
+ROLLUP_TABLE = 'MSG_ROLLUP'
+STATE_TABLE = 'MSG_ROLLUP_STATE'
+# 消息所在的本地整点（时间戳），按本地时间的分、秒对齐，非整点时区也能对齐到本地小时
+HOUR_START = (
+    "CreateTime"
+    " - CAST(strftime('%M',CreateTime,'unixepoch','localtime') AS INTEGER)*60"
+    " - CAST(strftime('%S',CreateTime,'unixepoch','localtime') AS INTEGER)"
+)
+# 统计值 -> (汇总表里的表达式, MSG表里的表达式)
+VALUE_COLUMNS = {
+    'rows': ('sum(Num)', 'count(*)'),  # 消息条数
+    'num': ('sum(SvrNum)', 'count(MsgSvrID)'),  # 和原来的count(MsgSvrID)一致
+    'length': ('sum(TextLength)', 'sum(length(StrContent))'),  # 文本长度
+}
+
+
+def has_rollup(conn: sqlite3.Connection) -> bool:
+    cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", [STATE_TABLE])
+    return cursor.fetchone() is not None
+
+
+def rollup_is_current(conn) -> bool:
+    """
+    只读检查汇总表是否已经汇总到最新的消息，不是最新时统计结果会少，不能用
+    @param conn: 连接或游标
+    """
+    if not has_rollup(conn):
+        return False
+    row = conn.execute(f"SELECT Value FROM {STATE_TABLE} WHERE Name='max_local_id'").fetchone()
+    max_id = conn.execute('SELECT MAX(localId) FROM MSG').fetchone()[0] or 0
+    return row is not None and row[0] == max_id
+
+
+def ensure_msg_rollup(db_path) -> bool:
+    """
+    创建或增量更新汇总表：只汇总localId大于上次记录的新消息；MSG被替换（localId变小）时重建
+    @param db_path: MSG.db路径
+    @return: 汇总表是否可用
+    """
+    if not os.path.exists(db_path):
+        return False
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE}(
+                StrTalker TEXT,
+                HourStart INTEGER,
+                IsSender INTEGER,
+                Type INTEGER,
+                SubType INTEGER,
+                Num INTEGER,
+                SvrNum INTEGER,
+                TextLength INTEGER
+            )
+        ''')
+        conn.execute(
+            f'CREATE UNIQUE INDEX IF NOT EXISTS IDX_{ROLLUP_TABLE}_KEY '
+            f'ON {ROLLUP_TABLE}(StrTalker,HourStart,IsSender,Type,SubType)'
+        )
+        conn.execute(f'CREATE INDEX IF NOT EXISTS IDX_{ROLLUP_TABLE}_HOUR ON {ROLLUP_TABLE}(HourStart)')
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {STATE_TABLE}(Name TEXT PRIMARY KEY, Value INTEGER)')
+        row = conn.execute(f"SELECT Value FROM {STATE_TABLE} WHERE Name='max_local_id'").fetchone()
+        last_id = row[0] if row else None
+        max_id = conn.execute('SELECT MAX(localId) FROM MSG').fetchone()[0] or 0
+        if last_id is None or max_id < last_id:
+            conn.execute(f'DELETE FROM {ROLLUP_TABLE}')
+            last_id = 0
+        if max_id > last_id:
+            start = time.time()
+            # StrTalker为NULL的行不会触发唯一索引冲突，会多插一行，求和时结果一样
+            conn.execute(f'''
+                INSERT INTO {ROLLUP_TABLE}(StrTalker,HourStart,IsSender,Type,SubType,Num,SvrNum,TextLength)
+                SELECT StrTalker,{HOUR_START} AS HourStart,IsSender,Type,SubType,
+                    count(*),count(MsgSvrID),IFNULL(sum(length(StrContent)),0)
+                FROM MSG
+                WHERE localId>? AND localId<=?
+                GROUP BY StrTalker,HourStart,IsSender,Type,SubType
+                ON CONFLICT(StrTalker,HourStart,IsSender,Type,SubType) DO UPDATE SET
+                    Num=Num+excluded.Num,
+                    SvrNum=SvrNum+excluded.SvrNum,
+                    TextLength=TextLength+excluded.TextLength
+            ''', [last_id, max_id])
+            conn.execute(
+                f"INSERT OR REPLACE INTO {STATE_TABLE}(Name,Value) VALUES ('max_local_id',?)", [max_id]
+            )
+            logger.info(f'更新统计汇总表 localId {last_id}->{max_id} 耗时 {time.time() - start:.2f}s')
+        conn.commit()
+        return True
+    except sqlite3.DatabaseError:
+        conn.rollback()
+        logger.error(f'{db_path}统计汇总表更新失败:\n{traceback.format_exc()}')
+        return False
+    finally:
+        conn.close()
+
+
+def local_hour_start(timestamp) -> int:
+    t = time.localtime(timestamp)
+    return int(timestamp) - t.tm_min * 60 - t.tm_sec
+
+
+def _sort_key(row):
+    return tuple((value is None, value if value is not None else 0) for value in row)
+
+
+class RollupQuery:
+    """
+    统计查询：时间范围内的整小时从汇总表读，两端不满一小时的部分从MSG补上，结果和直接统计MSG一致
+    keys里的{time}在汇总表里替换成HourStart，在MSG表里替换成CreateTime，例如
+        RollupQuery(["strftime('%Y-%m-%d',{time},'unixepoch','localtime')"]).talker(wxid).fetch(cursor)
+    过滤条件只能用两张表共有的列：StrTalker、IsSender、Type、SubType
+    """
+
+    def __init__(self, keys=(), values=('num',)):
+        self.keys = list(keys)
+        self.values = list(values)
+        self.conditions = []
+        self.range = None
+
+    def where(self, condition, *params):
+        self.conditions.append((condition, params))
+        return self
+
+    def talker(self, username_):
+        if username_ is None:
+            return self
+        return self.where('StrTalker=?', username_)
+
+    def sender(self, is_sender):
+        if is_sender is None:
+            return self
+        return self.where('IsSender=?', is_sender)
+
+    def type_(self, type_):
+        if type_ is None:
+            return self
+        return self.where('Type=?', type_)
+
+    def types(self, types):
+        if not types:
+            return self
+        types = list(types)
+        return self.where(f'Type in ({",".join("?" * len(types))})', *types)
+
+    def subtypes(self, subtypes):
+        if not subtypes:
+            return self
+        subtypes = list(subtypes)
+        return self.where(f'SubType in ({",".join("?" * len(subtypes))})', *subtypes)
+
+    def time_range(self, time_range):
+        self.range = convert_to_timestamp(time_range) if time_range else None
+        return self
+
+    def _query(self, rollup: bool) -> MsgQuery:
+        time_column = 'HourStart' if rollup else 'CreateTime'
+        keys = [key.format(time=time_column) for key in self.keys]
+        values = [VALUE_COLUMNS[value][0 if rollup else 1] for value in self.values]
+        query = MsgQuery(','.join(keys + values), table=ROLLUP_TABLE if rollup else 'MSG')
+        for condition, params in self.conditions:
+            query.where(condition, *params)
+        if keys:
+            query.group_by(','.join(keys))
+        return query
+
+    def fetch(self, cursor, use_rollup=True) -> list:
+        """
+        @param cursor: MSG.db的游标
+        @param use_rollup: 汇总表不可用时传False，全部从MSG统计
+        @return: [(key1, key2, ..., value1, value2, ...)]，按key升序；没有key时返回一行合计
+        """
+        queries = []
+        if not use_rollup:
+            query = self._query(False)
+            if self.range:
+                query.where('CreateTime>? AND CreateTime<?', *self.range)
+            queries.append(query)
+        elif not self.range:
+            queries.append(self._query(True))
+        else:
+            start_time, end_time = self.range
+            lo = local_hour_start(start_time) + 3600  # 第一个完整落在范围内的整点
+            hi = local_hour_start(end_time)  # 最后一个完整整点的结束
+            if lo < hi:
+                queries.append(self._query(True).where('HourStart>=? AND HourStart<?', lo, hi))
+                queries.append(self._query(False).where('CreateTime>? AND CreateTime<?', start_time, lo))
+                queries.append(self._query(False).where('CreateTime>=? AND CreateTime<?', hi, end_time))
+            else:
+                queries.append(self._query(False).where('CreateTime>? AND CreateTime<?', start_time, end_time))
+
+        key_num = len(self.keys)
+        totals = {}
+        for query in queries:
+            sql, params = query.build()
+            cursor.execute(sql, params)
+            for row in cursor.fetchall():
+                key = row[:key_num]
+                values = totals.get(key)
+                if values is None:
+                    totals[key] = [value or 0 for value in row[key_num:]]
+                else:
+                    for i, value in enumerate(row[key_num:]):
+                        values[i] += value or 0
+        if not key_num:
+            return [tuple(totals.get((), [0] * len(self.values)))]
+        return sorted((key + tuple(values) for key, values in totals.items()), key=_sort_key)
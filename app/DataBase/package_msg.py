@@ -1,7 +1,7 @@
 import threading
 
 from app.DataBase import msg_db, micro_msg_db, misc_db
-from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+from app.util.protocbuf.bytes_extra import get_sender_wxid
 from app.util.protocbuf.roomdata_pb2 import ChatRoomData
 from app.person import Contact, Me, ContactDefault
 
@@ -28,9 +28,13 @@ class PackageMsg:
         '''
         获取完整的聊天记录
         '''
-        updated_messages = []  # 用于存储修改后的消息列表
+        return list(self.iter_package_message_all())
 
-        messages = msg_db.get_messages_all()
+    def iter_package_message_all(self):
+        '''
+        get_package_message_all的生成器版本，逐条读取并补全联系人信息
+        '''
+        messages = msg_db.iter_messages_all()
         for row in messages:
             row_list = list(row)
             # 删除不使用的几个字段
@@ -58,13 +62,7 @@ class PackageMsg:
                     if row[10] is None:
                         continue
                     # 解析BytesExtra
-                    msgbytes = MessageBytesExtra()
-                    msgbytes.ParseFromString(row[10])
-                    wxid = ''
-                    for tmp in msgbytes.message2:
-                        if tmp.field1 != 1:
-                            continue
-                        wxid = tmp.field2
+                    wxid = get_sender_wxid(row[10])
                     sender = ''
                     # 获取群聊成员列表
                     membersMap = self.get_chatroom_member_list(strtalker)
@@ -88,8 +86,7 @@ class PackageMsg:
                         row_list.append(info[4])
                     else:
                         row_list.append('')
-            updated_messages.append(tuple(row_list))
-        return updated_messages
+            yield tuple(row_list)
 
     def get_package_message_by_wxid(self, chatroom_wxid):
         '''
@@ -119,16 +116,10 @@ class PackageMsg:
                 updated_messages.append(message)
                 continue
             if message[10] is None:  # BytesExtra是空的跳过
-                message.append(ContactDefault(wxid))
+                message.append(ContactDefault(''))
                 updated_messages.append(message)
                 continue
-            msgbytes = MessageBytesExtra()
-            msgbytes.ParseFromString(message[10])
-            wxid = ''
-            for tmp in msgbytes.message2:
-                if tmp.field1 != 1:
-                    continue
-                wxid = tmp.field2
+            wxid = get_sender_wxid(message[10])
             if wxid == "":  # 系统消息里面 wxid 不存在
                 message.append(ContactDefault(wxid))
                 updated_messages.append(message)
@@ -0,0 +1,194 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from app.config import DB_POOL_SIZE, DB_STATEMENT_CACHE_SIZE
+
+
+def read_only_uri(db_path) -> str:
+    """
+    生成只读打开数据库用的URI
+    @param db_path: 数据库文件路径
+    @return: file:///...?mode=ro
+    """
+    return f'{Path(db_path).absolute().as_uri()}?mode=ro'
+
+
+_encrypted_sources = {}  # 解密后的数据库路径 -> 加密数据库路径列表
+
+
+def _source_key(db_path) -> str:
+    return os.path.normcase(os.path.abspath(db_path))
+
+
+def set_encrypted_sources(sources: dict):
+    """
+    设置直接读取的加密数据库，之后新建的连接池不再打开解密后的数据库，见app.decrypt.encrypted_vfs
+    @param sources: {解密后的数据库路径: [加密数据库路径, ...]}，传空字典恢复读取解密后的数据库
+    """
+    _encrypted_sources.clear()
+    for db_path, paths in sources.items():
+        _encrypted_sources[_source_key(db_path)] = list(paths)
+
+
+def encrypted_source(db_path) -> list:
+    return _encrypted_sources.get(_source_key(db_path))
+
+
+def encrypted_mode() -> bool:
+    """
+    是否在直接读取加密数据库（其他进程里没有这个设置）
+    """
+    return bool(_encrypted_sources)
+
+
+def database_exists(db_path) -> bool:
+    """
+    解密后的数据库存在，或者设置了对应的加密数据库
+    """
+    return encrypted_source(db_path) is not None or os.path.exists(db_path)
+
+
+class ConnectionPool:
+    """
+    只读SQLite连接池
+    每个线程查询时独占一个连接，互不阻塞；连接数上限为size，超出时等待其他线程归还
+    同一线程内嵌套查询（例如边遍历边查询）会复用该线程已借出的连接
+    """
+
+    def __init__(self, db_path, size=DB_POOL_SIZE, cached_statements=DB_STATEMENT_CACHE_SIZE):
+        self.db_path = db_path
+        self.size = max(1, int(size))
+        self.cached_statements = cached_statements  # 参数化查询的SQL文本相同，可以复用预编译语句
+        self.encrypted_paths = encrypted_source(db_path)  # 不为None时通过解密VFS直接读加密数据库
+        self._idle = []  # 空闲连接
+        self._opened = 0  # 已经打开的连接数（包括借出的）
+        self._closed = False
+        self._trace_callback = None
+        self._cond = threading.Condition()
+        self._holders = {}  # 线程号 -> [借出的连接, 引用计数]
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.encrypted_paths:
+            from app.decrypt.encrypted_vfs import connect
+            return connect(self.encrypted_paths, cached_statements=self.cached_statements)
+        # 连接会在不同线程之间流转，但同一时刻只会被一个线程使用
+        return sqlite3.connect(
+            read_only_uri(self.db_path),
+            uri=True,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+
+    def acquire(self) -> sqlite3.Connection:
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise sqlite3.ProgrammingError('Cannot operate on a closed connection pool.')
+                if self._idle:
+                    conn = self._idle.pop()
+                    conn.set_trace_callback(self._trace_callback)
+                    return conn
+                if self._opened < self.size:
+                    self._opened += 1
+                    break
+                self._cond.wait()
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+        conn.set_trace_callback(self._trace_callback)
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        with self._cond:
+            if self._closed or self._opened > self.size:
+                # 连接池已关闭或被调小了，直接关掉多余的连接
+                self._opened -= 1
+                conn.close()
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        owner = threading.get_ident()
+        with self._cond:
+            holder = self._holders.get(owner)
+            if holder:
+                # 当前线程已经借了连接，引用计数+1后直接复用
+                holder[1] += 1
+        if holder:
+            try:
+                yield holder[0]
+            finally:
+                self._put_holder(owner, holder)
+            return
+        conn = self.acquire()
+        holder = [conn, 1]
+        with self._cond:
+            self._holders[owner] = holder
+        try:
+            yield conn
+        finally:
+            self._put_holder(owner, holder)
+
+    def _put_holder(self, owner, holder):
+        """
+        引用计数-1，归零时归还借出时的连接
+        生成器可能在别的线程里结束（例如被垃圾回收），只用借出时记下的线程号和连接，不看当前线程
+        """
+        with self._cond:
+            holder[1] -= 1
+            if holder[1]:
+                return
+            if self._holders.get(owner) is holder:
+                del self._holders[owner]
+        self.release(holder[0])
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def set_trace_callback(self, trace_callback):
+        """
+        给之后借出的连接设置sqlite3的trace回调，传None取消
+        """
+        self._trace_callback = trace_callback
+
+    def resize(self, size):
+        """
+        调整连接数上限，多出来的连接在归还时关闭
+        """
+        with self._cond:
+            self.size = max(1, int(size))
+            while self._idle and self._opened > self.size:
+                self._idle.pop().close()
+                self._opened -= 1
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        关闭所有空闲连接，借出的连接在归还时关闭
+        """
+        with self._cond:
+            self._closed = True
+            for conn in self._idle:
+                conn.close()
+            self._opened -= len(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
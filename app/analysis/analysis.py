@@ -306,31 +306,35 @@ def get_weekday(timestamp):
     return weekdays[weekday]
 
 
-def sender(wxid, time_range, my_name='', ta_name=''):
-    msg_data = msg_db.get_messages(wxid, time_range)
-
+def count_statistics(statistics):
+    """
+    汇总msg_db.get_messages_weekday_statistics的结果
+    @return: 各类型条数, 星期分布, 发送条数, 总条数, 文本总字数
+    """
+    weekdays = ['周一', '周二', '周三', '周四', '周五', '周六', '周日']
     types_count = {}
-    send_num = 0  # 发送消息的数量
     weekday_count = {}
-    for message in msg_data:
-        type_ = message[2]
-        is_sender = message[4]
-        subType = message[3]
-        timestamp = message[5]
-        weekday = get_weekday(timestamp)
-        str_time = message[8]
-        send_num += is_sender
+    send_num = 0
+    total_num = 0
+    total_text_num = 0
+    for type_, subType, is_sender, weekday, num, text_length in statistics:
         type_ = f'{type_}{subType:0>2d}' if subType != 0 else type_
         type_ = int(type_)
-        if type_ in types_count:
-            types_count[type_] += 1
-        else:
-            types_count[type_] = 1
-        if weekday in weekday_count:
-            weekday_count[weekday] += 1
-        else:
-            weekday_count[weekday] = 1
-    receive_num = len(msg_data) - send_num
+        types_count[type_] = types_count.get(type_, 0) + num
+        weekday = weekdays[(int(weekday) + 6) % 7]  # strftime('%w')里0是周日
+        weekday_count[weekday] = weekday_count.get(weekday, 0) + num
+        send_num += num if is_sender else 0
+        total_num += num
+        if type_ == 1:
+            total_text_num += text_length
+    weekday_count = {weekday: weekday_count[weekday] for weekday in weekdays if weekday in weekday_count}
+    return types_count, weekday_count, send_num, total_num, total_text_num
+
+
+def sender(wxid, time_range, my_name='', ta_name=''):
+    statistics = msg_db.get_messages_weekday_statistics(wxid, time_range)
+    types_count, weekday_count, send_num, total_num, _ = count_statistics(statistics)
+    receive_num = total_num - send_num
     data = [[types_.get(key), value] for key, value in types_count.items() if key in types_]
     if not data:
         return {
@@ -446,35 +450,10 @@ def contacts_analysis(contacts):
 
 
 def my_message_counter(time_range, my_name=''):
-    msg_data = msg_db.get_messages_all(time_range=time_range)
-    types_count = {}
-    send_num = 0  # 发送消息的数量
-    weekday_count = {}
-    str_content = ''
-    total_text_num = 0
-    for message in msg_data:
-        type_ = message[2]
-        is_sender = message[4]
-        subType = message[3]
-        timestamp = message[5]
-        weekday = get_weekday(timestamp)
-        str_time = message[8]
-        send_num += is_sender
-        type_ = f'{type_}{subType:0>2d}' if subType != 0 else type_
-        type_ = int(type_)
-        if type_ in types_count:
-            types_count[type_] += 1
-        else:
-            types_count[type_] = 1
-        if weekday in weekday_count:
-            weekday_count[weekday] += 1
-        else:
-            weekday_count[weekday] = 1
-        if type_ == 1:
-            total_text_num += len(message[7])
-            if is_sender == 1:
-                str_content += message[7]
-    receive_num = len(msg_data) - send_num
+    statistics = msg_db.get_messages_weekday_statistics(time_range=time_range)
+    types_count, weekday_count, send_num, total_num, total_text_num = count_statistics(statistics)
+    str_content = msg_db.get_send_messages_text(time_range=time_range)
+    receive_num = total_num - send_num
     data = [[types_.get(key), value] for key, value in types_count.items() if key in types_]
     if not data:
         return {
@@ -32,4 +32,11 @@ os.makedirs(DB_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 # 全局参数
 SEND_LOG_FLAG = True  # 是否发送错误日志
+DB_POOL_SIZE = 8  # 每个数据库的只读连接数上限
+DB_STATEMENT_CACHE_SIZE = 256  # 每个连接缓存的预编译语句数
+DB_PAGE_CACHE_PAGES = 16384  # 直接读加密数据库时，解密后的页的缓存页数（每页4KB，所有数据库共用）
+EXPORT_WORKERS = 4  # 批量导出时同时执行的导出任务数（不超过DB_POOL_SIZE）
+EXPORT_PROCESS_WORKERS = 2  # 批量导出时CPU密集任务的进程数
+IMAGE_DECODE_WORKERS = 4  # 批量解密图片的线程数
+MEDIA_STORE_DIR = os.path.join(OUTPUT_DIR, 'media_store')  # 导出共用的媒体库，和导出文件夹在同一个盘才能用硬链接
 SERVER_API_URL = 'http://api.lc044.love'  # api接口
\ No newline at end of file
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-#
+"""
+解密、合并性能测试
+生成一套和微信Msg文件夹结构相同的合成数据库（MicroMsg.db、Multi/MSGn.db、Multi/MediaMSGn.db），用encrypt按微信的页格式
+（盐值、IV、HMAC、保留字节）和已知的密钥加密，然后分别测decrypt、batch_decrypt、merge_databases、merge_MediaMSG_databases
+的耗时、吞吐量（MB/s、行/s）和峰值内存；每一项在单独的进程里执行，峰值内存互不影响
+    python -m app.decrypt.benchmark --dir /tmp/wx_bench --msg-shards 4 --rows 200000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import lz4.block
+
+from app.decrypt.decrypt import DEFAULT_CHUNK_PAGES, DEFAULT_PAGESIZE, batch_decrypt, decrypt, encrypt
+from app.util.protocbuf.bytes_extra import ORIGINAL, SENDER, THUMB
+from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+from app.util.protocbuf.roomdata_pb2 import ChatRoomData
+
+RESERVED_SIZE = 48  # 每页末尾留给IV、HMAC的字节数
+DEFAULT_KEY = '0123456789abcdef' * 4
+BASE_TIME = 1577836800  # 2020-01-01
+
+MSG_SCHEMA = [
+    'CREATE TABLE MSG(localId INTEGER PRIMARY KEY AUTOINCREMENT,TalkerId INT DEFAULT 0,MsgSvrID INT,Type INT,'
+    'SubType INT,IsSender INT,CreateTime INT,Sequence INT DEFAULT 0,StatusEx INT DEFAULT 0,FlagEx INT,Status INT,'
+    'MsgServerSeq INT,MsgSequence INT,StrTalker TEXT,StrContent TEXT,DisplayContent TEXT,Reserved0 INT DEFAULT 0,'
+    'Reserved1 INT DEFAULT 0,Reserved2 INT DEFAULT 0,Reserved3 INT DEFAULT 0,Reserved4 TEXT,Reserved5 TEXT,'
+    'Reserved6 TEXT,CompressContent BLOB,BytesExtra BLOB,BytesTrans BLOB)',
+    'CREATE INDEX MSG_CREATETIME ON MSG(CreateTime)',
+    'CREATE INDEX MSG_MSGSVRID ON MSG(MsgSvrID)',
+    'CREATE INDEX MSG_SEQUENCE ON MSG(Sequence)',
+    'CREATE INDEX MSG_TALKER ON MSG(StrTalker)',
+    'CREATE TABLE Name2ID(UsrName TEXT PRIMARY KEY)',
+    'CREATE TABLE DBInfo(tableIndex INTEGER PRIMARY KEY,tableVersion INTEGER,tableDesc TEXT)',
+]
+MEDIA_SCHEMA = [
+    'CREATE TABLE Media(Key TEXT,Reserved0 INT,Buf BLOB,Reserved1 INT,Reserved2 TEXT)',
+    'CREATE UNIQUE INDEX MediaUniqueIndex ON Media(Key)',
+]
+MICRO_MSG_SCHEMA = [
+    'CREATE TABLE Contact(UserName TEXT PRIMARY KEY,Alias TEXT,EncryptUserName TEXT,DelFlag INTEGER DEFAULT 0,'
+    'Type INTEGER DEFAULT 0,VerifyFlag INTEGER DEFAULT 0,Reserved1 INTEGER DEFAULT 0,Reserved2 INTEGER DEFAULT 0,'
+    'Reserved3 TEXT,Reserved4 TEXT,Remark TEXT,NickName TEXT,LabelIDList TEXT,DomainList TEXT,'
+    'ChatRoomType INT,PYInitial TEXT,QuanPin TEXT,RemarkPYInitial TEXT,RemarkQuanPin TEXT,BigHeadImgUrl TEXT,'
+    'SmallHeadImgUrl TEXT,HeadImgMd5 TEXT,ChatRoomNotify INTEGER DEFAULT 0,Reserved5 INTEGER DEFAULT 0,'
+    'Reserved6 TEXT,Reserved7 TEXT,ExtraBuf BLOB,Reserved8 INTEGER DEFAULT 0,Reserved9 INTEGER DEFAULT 0,'
+    'Reserved10 TEXT,Reserved11 TEXT)',
+    'CREATE TABLE ContactHeadImgUrl(usrName TEXT PRIMARY KEY,smallHeadImgUrl TEXT,bigHeadImgUrl TEXT,'
+    'headImgMd5 TEXT,reverse0 INT,reverse1 TEXT)',
+    'CREATE TABLE ContactLabel(LabelId INTEGER PRIMARY KEY,LabelName TEXT,CreateTime INTEGER)',
+    'CREATE TABLE ChatRoom(ChatRoomName TEXT PRIMARY KEY,UserNameList TEXT,DisplayNameList TEXT,'
+    'ChatRoomFlag INT DEFAULT 0,Owner INTEGER DEFAULT 0,IsShowName INTEGER DEFAULT 0,SelfDisplayName TEXT,'
+    'Reserved1 INTEGER DEFAULT 0,Reserved2 TEXT,Reserved3 INTEGER DEFAULT 0,Reserved4 TEXT,'
+    'Reserved5 INTEGER DEFAULT 0,Reserved6 TEXT,RoomData BLOB,Reserved7 INTEGER DEFAULT 0,Reserved8 TEXT)',
+]
+WORDS = ['今天', '明天', '晚上', '吃饭', '开会', '好的', '收到', '哈哈', '周末', '一起', '项目', '文件',
+         '看看', '谢谢', '没问题', '回家', '电影', '出发', '微信', '记录', 'ok', 'hello', '[微笑]', '[捂脸]']
+# (Type, SubType, 权重)，大致是普通用户聊天记录里各类消息的比例
+MSG_TYPES = [(1, 0, 70), (3, 0, 10), (34, 0, 5), (47, 0, 5), (49, 57, 4), (49, 5, 3), (49, 6, 1), (10000, 0, 2)]
+
+
+def _create_plain_db(path, schema) -> sqlite3.Connection:
+    """
+    新建每页末尾预留48字节的明文数据库，加密时这48字节被IV、HMAC覆盖
+    sqlite3不能直接设置保留字节数：先写出只有空的第一页的数据库，改掉文件头里的保留字节数和第一页内容区的起始位置，
+    之后SQLite建表、插入都按这个保留字节数排布
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute(f'PRAGMA page_size={DEFAULT_PAGESIZE}')
+    conn.execute('PRAGMA user_version=1')
+    conn.commit()
+    conn.close()
+    with open(path, 'r+b') as file:
+        file.seek(20)
+        file.write(bytes([RESERVED_SIZE]))
+        file.seek(105)
+        file.write((DEFAULT_PAGESIZE - RESERVED_SIZE).to_bytes(2, 'big'))
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    for sql in schema:
+        conn.execute(sql)
+    return conn
+
+
+def _text(rng: random.Random, max_words=30) -> str:
+    return ''.join(rng.choice(WORDS) for _ in range(rng.randint(1, max_words)))
+
+
+def _contacts(contact_num) -> list:
+    # 大约5%是群聊
+    return [f'{i}@chatroom' if i % 20 == 0 else f'wxid_{i:08d}' for i in range(contact_num)]
+
+
+def _write_micro_msg(path, contacts, rng: random.Random):
+    conn = _create_plain_db(path, MICRO_MSG_SCHEMA)
+    conn.executemany('INSERT INTO ContactLabel(LabelId,LabelName,CreateTime) VALUES (?,?,?)',
+                     [(i, f'标签{i}', BASE_TIME) for i in range(1, 11)])
+    conn.executemany(
+        'INSERT INTO Contact(UserName,Alias,Type,Remark,NickName,LabelIDList,PYInitial,RemarkPYInitial,ExtraBuf) '
+        'VALUES (?,?,?,?,?,?,?,?,?)',
+        [(name, '', 3, _text(rng, 3), _text(rng, 3), str(rng.randint(1, 10)), 'PY', 'PY',
+          rng.randbytes(rng.randint(50, 300))) for name in contacts]
+    )
+    conn.executemany(
+        'INSERT INTO ContactHeadImgUrl(usrName,smallHeadImgUrl,bigHeadImgUrl,headImgMd5) VALUES (?,?,?,?)',
+        [(name, f'https://wx.qlogo.cn/mmhead/{name}/132', f'https://wx.qlogo.cn/mmhead/{name}/0',
+          rng.randbytes(16).hex()) for name in contacts]
+    )
+    chatrooms = [name for name in contacts if name.endswith('@chatroom')]
+    people = _members(contacts)
+    rows = []
+    for name in chatrooms:
+        members = rng.sample(people, min(20, len(people)))
+        room_data = ChatRoomData()
+        for member in members:
+            room_data.members.add(wxID=member, displayName=_text(rng, 3))
+        rows.append((name, '^G'.join(members), '', room_data.SerializeToString()))
+    conn.executemany('INSERT INTO ChatRoom(ChatRoomName,UserNameList,DisplayNameList,RoomData) VALUES (?,?,?,?)', rows)
+    conn.commit()
+    conn.close()
+
+
+def _members(contacts) -> list:
+    return [name for name in contacts if not name.endswith('@chatroom')] or contacts
+
+
+def _compress_content(rng: random.Random, sub_type) -> bytes:
+    """
+    Type为49的CompressContent：lz4块压缩（不带长度前缀）的appmsg XML，和compress_content里的解析对应
+    """
+    title = _text(rng, 10)
+    if sub_type == 57:
+        appmsg = (f'<type>57</type><title>{title}</title><refermsg><type>1</type>'
+                  f'<displayname>{_text(rng, 3)}</displayname><content>{_text(rng)}</content></refermsg>')
+    elif sub_type == 6:
+        appmsg = (f'<type>6</type><title>{title}.pdf</title><appattach><totallen>{rng.randint(1, 10 ** 7)}'
+                  f'</totallen><fileext>pdf</fileext></appattach>')
+    else:
+        appmsg = (f'<type>{sub_type}</type><title>{title}</title><des>{_text(rng)}</des>'
+                  f'<url>https://mp.weixin.qq.com/s/{rng.randbytes(8).hex()}</url>'
+                  f'<sourcedisplayname>{_text(rng, 3)}</sourcedisplayname>')
+    xml = f'<?xml version="1.0"?>\n<msg><appmsg appid="" sdkver="0">{appmsg}</appmsg><appinfo><version>1</version>' \
+          f'<appname>{_text(rng, 2)}</appname></appinfo></msg>'
+    return lz4.block.compress(xml.encode('utf-8'), store_size=False)
+
+
+def _bytes_extra(rng: random.Random, type_, sender, create_time) -> bytes:
+    """
+    MessageBytesExtra：群聊里别人发的消息带发送人wxid，图片、视频、文件带缩略图、原文件路径，再加上微信都会带的msgsource
+    """
+    extra = MessageBytesExtra()
+    extra.message1.field1 = 1
+    extra.message1.field2 = 0
+    if sender:
+        extra.message2.add(field1=SENDER, field2=sender)
+    month = time.strftime('%Y-%m', time.localtime(create_time))
+    name = rng.randbytes(16).hex()
+    if type_ == 3:
+        extra.message2.add(field1=THUMB, field2=f'wxid_self\\FileStorage\\Image\\Thumb\\{month}\\{name}_t.dat')
+        extra.message2.add(field1=ORIGINAL, field2=f'wxid_self\\FileStorage\\Image\\{month}\\{name}.dat')
+    elif type_ == 49:
+        extra.message2.add(field1=ORIGINAL, field2=f'wxid_self\\FileStorage\\File\\{month}\\{name}.pdf')
+    extra.message2.add(field1=7, field2=f'<msgsource><signature>{rng.randbytes(rng.randint(4, 60)).hex()}'
+                                         f'</signature></msgsource>')
+    return extra.SerializeToString()
+
+
+def _msg_rows(rng: random.Random, contacts, row_num, start_time, svr_ids):
+    types = [(type_, sub_type) for type_, sub_type, _ in MSG_TYPES]
+    weights = [weight for *_, weight in MSG_TYPES]
+    members = _members(contacts)
+    create_time = start_time
+    for _ in range(row_num):
+        type_, sub_type = rng.choices(types, weights)[0]
+        # 少数联系人占了大部分消息
+        talker = contacts[min(int(rng.paretovariate(1.2)) - 1, len(contacts) - 1)]
+        create_time += rng.randint(1, 600)
+        svr_id = rng.getrandbits(62)
+        svr_ids.append(svr_id)
+        str_content = _text(rng) if type_ in (1, 10000) else f'<msg><img length="{rng.randint(1, 10 ** 6)}"/></msg>'
+        compress_content = _compress_content(rng, sub_type) if type_ == 49 else None
+        is_sender = rng.randint(0, 1)
+        sender = rng.choice(members) if talker.endswith('@chatroom') and not is_sender else ''
+        yield (
+            svr_id, type_, sub_type, is_sender, create_time, create_time * 1000, talker,
+            str_content, '', compress_content, _bytes_extra(rng, type_, sender, create_time)
+        )
+
+
+def generate_corpus(root, key=DEFAULT_KEY, msg_shards=4, rows=100000, media_shards=1, voices=2000,
+                    voice_kb=16, contact_num=1000, seed=0) -> dict:
+    """
+    生成加密的合成数据库，目录结构和微信数据文件夹一样：root/Msg/MicroMsg.db、root/Msg/Multi/MSGn.db、root/Msg/Multi/MediaMSGn.db
+    @param root: 输出文件夹
+    @param key: 加密用的密钥（64位十六进制）
+    @param msg_shards: MSG分库数
+    @param rows: 每个MSG分库的消息条数
+    @param media_shards: MediaMSG分库数
+    @param voices: 每个MediaMSG分库的语音条数
+    @param voice_kb: 语音的平均大小（KB）
+    @param contact_num: 联系人（含群聊）数
+    @param seed: 随机数种子，相同参数生成的明文内容相同
+    @return: {'msg_dir': Msg文件夹, 'files': 加密数据库路径列表, 'rows': 消息总数, 'voices': 语音总数, 'bytes': 总大小}
+    """
+    rng = random.Random(seed)
+    msg_dir = os.path.join(root, 'Msg')
+    multi_dir = os.path.join(msg_dir, 'Multi')
+    os.makedirs(multi_dir, exist_ok=True)
+    contacts = _contacts(contact_num)
+    files = []
+    svr_ids = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        def seal(plain_path, out_path):
+            encrypt(key, plain_path, out_path)
+            os.remove(plain_path)
+            files.append(out_path)
+
+        plain_path = os.path.join(tmp_dir, 'MicroMsg.db')
+        _write_micro_msg(plain_path, contacts, rng)
+        seal(plain_path, os.path.join(msg_dir, 'MicroMsg.db'))
+
+        start_time = BASE_TIME
+        for i in range(msg_shards):
+            plain_path = os.path.join(tmp_dir, f'MSG{i}.db')
+            conn = _create_plain_db(plain_path, MSG_SCHEMA)
+            conn.executemany(
+                'INSERT INTO MSG(MsgSvrID,Type,SubType,IsSender,CreateTime,Sequence,StrTalker,StrContent,'
+                'DisplayContent,CompressContent,BytesExtra) VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                _msg_rows(rng, contacts, rows, start_time, svr_ids)
+            )
+            start_time = conn.execute('SELECT MAX(CreateTime) FROM MSG').fetchone()[0] or start_time
+            conn.executemany('INSERT INTO Name2ID(UsrName) VALUES (?)', [(name,) for name in contacts])
+            conn.commit()
+            conn.close()
+            seal(plain_path, os.path.join(multi_dir, f'MSG{i}.db'))
+
+        for i in range(media_shards):
+            plain_path = os.path.join(tmp_dir, f'MediaMSG{i}.db')
+            conn = _create_plain_db(plain_path, MEDIA_SCHEMA)
+            conn.executemany(
+                'INSERT INTO Media(Key,Reserved0,Buf,Reserved1,Reserved2) VALUES (?,?,?,?,?)',
+                ((rng.randbytes(16).hex(), rng.choice(svr_ids) if svr_ids else j,
+                  b'\x02#!SILK_V3' + rng.randbytes(rng.randint(voice_kb * 512, voice_kb * 1536)), 0, '')
+                 for j in range(voices))
+            )
+            conn.commit()
+            conn.close()
+            seal(plain_path, os.path.join(multi_dir, f'MediaMSG{i}.db'))
+    return {
+        'msg_dir': msg_dir,
+        'files': files,
+        'rows': msg_shards * rows,
+        'voices': media_shards * voices,
+        'bytes': sum(os.path.getsize(path) for path in files),
+    }
+
+
+def _peak_rss() -> int:
+    """
+    当前进程和已结束的子进程（解密进程池）中最大的常驻内存，字节
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _run_stage(queue, func, args):
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+        queue.put((time.perf_counter() - start, _peak_rss(), result, None))
+    except Exception as e:
+        queue.put((time.perf_counter() - start, _peak_rss(), None, repr(e)))
+
+
+def _stage(func, *args):
+    """
+    在新进程里执行一项测试，返回(秒, 峰值内存字节, 返回值)
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_stage, args=(queue, func, args))
+    process.start()
+    seconds, rss, result, error = queue.get()
+    process.join()
+    if error:
+        raise RuntimeError(f'{func.__name__}: {error}')
+    return seconds, rss, result
+
+
+def _merge_msg(paths, target_path):
+    from app.DataBase.merge import merge_databases
+    if os.path.exists(target_path):
+        os.remove(target_path)
+    return merge_databases(paths, target_path)
+
+
+def _merge_media(paths, target_path):
+    from app.DataBase.merge import merge_MediaMSG_databases
+    if os.path.exists(target_path):
+        os.remove(target_path)
+    return merge_MediaMSG_databases(paths, target_path)
+
+
+def _record(name, seconds, rss, size, rows=None) -> dict:
+    return {
+        'name': name,
+        'seconds': round(seconds, 3),
+        'mb_per_s': round(size / (1 << 20) / max(seconds, 1e-9), 1),
+        'rows_per_s': round(rows / max(seconds, 1e-9)) if rows is not None else None,
+        'peak_rss_mb': round(rss / (1 << 20), 1),
+    }
+
+
+def run_benchmark(root, key=DEFAULT_KEY) -> list:
+    """
+    对generate_corpus生成的数据测试解密和合并
+    @param root: generate_corpus的输出文件夹，解密、合并的结果放在root/out下
+    @param key: 生成时用的密钥
+    @return: [{'name', 'seconds', 'mb_per_s', 'rows_per_s', 'peak_rss_mb'}]
+    """
+    msg_dir = os.path.join(root, 'Msg')
+    out_dir = os.path.join(root, 'out')
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    enc_files = [os.path.join(dir_path, file) for dir_path, _, files in os.walk(msg_dir) for file in files]
+    records = []
+
+    # 单个最大的文件
+    largest = max(enc_files, key=os.path.getsize)
+    seconds, rss, _ = _stage(decrypt, key, largest, os.path.join(out_dir, 'single.db'), None, None,
+                              DEFAULT_CHUNK_PAGES, False)
+    records.append(_record(f'decrypt {os.path.basename(largest)}', seconds, rss, os.path.getsize(largest)))
+
+    # 整个文件夹
+    total_size = sum(os.path.getsize(path) for path in enc_files)
+    seconds, rss, _ = _stage(batch_decrypt, key, msg_dir, out_dir)
+    records.append(_record(f'batch_decrypt {len(enc_files)} files', seconds, rss, total_size))
+
+    decrypted = os.path.join(out_dir, 'Multi')
+    for name, prefix, func, target in (
+            ('merge_databases', 'de_MSG', _merge_msg, 'MSG.db'),
+            ('merge_MediaMSG_databases', 'de_MediaMSG', _merge_media, 'MediaMSG.db'),
+    ):
+        paths = sorted(
+            (os.path.join(decrypted, file) for file in os.listdir(decrypted)
+             if file.startswith(prefix) and file[len(prefix):-3].isdigit()),
+            key=lambda path: int(os.path.basename(path)[len(prefix):-3])
+        )
+        if not paths:
+            continue
+        seconds, rss, stats = _stage(func, paths, os.path.join(out_dir, target))
+        rows = sum(stat[1] for stat in stats)
+        records.append(_record(name, seconds, rss, sum(os.path.getsize(path) for path in paths), rows))
+    return records
+
+
+def print_records(records):
+    print(f'{"":<32}{"秒":>10}{"MB/s":>10}{"行/s":>12}{"峰值内存MB":>12}')
+    for record in records:
+        rows_per_s = record['rows_per_s'] if record['rows_per_s'] is not None else '-'
+        print(f'{record["name"]:<32}{record["seconds"]:>10}{record["mb_per_s"]:>10}{rows_per_s:>12}'
+              f'{record["peak_rss_mb"]:>12}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='生成加密的合成数据库并测试解密、合并性能')
+    parser.add_argument('--dir', default=os.path.join(tempfile.gettempdir(), 'wx_bench'), help='数据文件夹')
+    parser.add_argument('--key', default=DEFAULT_KEY, help='加密用的密钥')
+    parser.add_argument('--msg-shards', type=int, default=4, help='MSG分库数')
+    parser.add_argument('--rows', type=int, default=100000, help='每个MSG分库的消息条数')
+    parser.add_argument('--media-shards', type=int, default=1, help='MediaMSG分库数')
+    parser.add_argument('--voices', type=int, default=2000, help='每个MediaMSG分库的语音条数')
+    parser.add_argument('--voice-kb', type=int, default=16, help='语音平均大小（KB）')
+    parser.add_argument('--contacts', type=int, default=1000, help='联系人数')
+    parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+    parser.add_argument('--reuse', action='store_true', help='数据文件夹已经有数据时不重新生成')
+    parser.add_argument('--json', help='结果另存为json，方便和之前的结果对比')
+    args = parser.parse_args()
+
+    if not (args.reuse and os.path.exists(os.path.join(args.dir, 'Msg'))):
+        shutil.rmtree(os.path.join(args.dir, 'Msg'), ignore_errors=True)
+        start = time.time()
+        corpus = generate_corpus(
+            args.dir, args.key, args.msg_shards, args.rows, args.media_shards, args.voices, args.voice_kb,
+            args.contacts, args.seed
+        )
+        print(f'生成{len(corpus["files"])}个加密数据库 {corpus["bytes"] >> 20}MB '
+              f'消息{corpus["rows"]}条 语音{corpus["voices"]}条 耗时 {time.time() - start:.1f}s')
+    results = run_benchmark(args.dir, args.key)
+    print_records(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
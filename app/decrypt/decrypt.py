@@ -16,10 +16,16 @@
 import argparse
 import hmac
 import hashlib
+import mmap
 import os
+import struct
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from typing import Union, List
 from Cryptodome.Cipher import AES
 
+from app.decrypt.key_validator import check_key, derive_keys, read_first_page
+
 # from Crypto.Cipher import AES # 如果上面的导入失败，可以尝试使用这个
 
 SQLITE_FILE_HEADER = "SQLite format 3\x00"  # SQLite文件头
@@ -27,16 +33,60 @@ SQLITE_FILE_HEADER = "SQLite format 3\x00"  # SQLite文件头
 KEY_SIZE = 32
 DEFAULT_PAGESIZE = 4096
 DEFAULT_ITER = 64000
+DEFAULT_CHUNK_PAGES = 2048  # 每块8MB
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024  # 小于这个大小的文件起进程池不划算，直接在当前进程解密
+# 增量解密用的清单：文件头 + 每页的摘要
+MANIFEST_SUFFIX = '.pages'
+MANIFEST_MAGIC = b'WXP2'
+DIGEST_SIZE = 8
+_MANIFEST_HEADER = struct.Struct('<4sIQ8sq')  # magic, 页大小, 加密文件大小, 密钥指纹, 加密文件修改时间(ns)
+_MANIFEST_HEADER_V1 = struct.Struct('<4sIQ8s')  # 旧版清单（b'WXPM'）没有修改时间
 
 
-# 通过密钥解密数据库
-def decrypt(key: str, db_path, out_path):
+def decrypt_page(byte_key, page, index) -> bytes:
     """
-    通过密钥解密数据库
-    :param key: 密钥 64位16进制字符串
-    :param db_path:  待解密的数据库路径(必须是文件)
-    :param out_path:  解密后的数据库输出路径(必须是文件)
-    :return:
+    解密一页
+    :param byte_key: 解密密钥
+    :param page: 加密的页
+    :param index: 页号（从0开始）
+    :return: 明文页，保留段原样保留
+    """
+    t = AES.new(byte_key, AES.MODE_CBC, page[-48:-32])
+    if index == 0:
+        # 第一页前16字节是盐值，解密后换成SQLite文件头
+        return SQLITE_FILE_HEADER.encode() + t.decrypt(page[16:-48]) + page[-48:]
+    return t.decrypt(page[:-48]) + page[-48:]
+
+
+def _write_pages(byte_key, data, out, start, end):
+    """
+    解密[start, end)范围内的页，写到输出文件的对应偏移
+    @param byte_key: 解密密钥
+    @param data: 加密数据库的内容（mmap）
+    @param out: 预先分配好大小的输出文件
+    @return: 解密的页数
+    """
+    buf = bytearray()
+    for i in range(start, end):
+        buf += decrypt_page(byte_key, data[i * DEFAULT_PAGESIZE:(i + 1) * DEFAULT_PAGESIZE], i)
+    out.seek(start * DEFAULT_PAGESIZE)
+    out.write(buf)
+    return end - start
+
+
+def _decrypt_range(byte_key, db_path, out_path, start, end):
+    """
+    进程池里执行的任务：每个进程自己映射输入文件、打开输出文件，只传页号，不在进程间传数据
+    """
+    with open(db_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        with open(out_path, "r+b") as out:
+            return _write_pages(byte_key, data, out, start, end)
+
+
+def _prepare_decrypt(key: str, db_path, out_path):
+    """
+    检查参数并用第一页的HMAC校验密钥
+    :return: (True, 解密密钥) 或 (False, 错误信息)
     """
     if not os.path.exists(db_path) or not os.path.isfile(db_path):
         return False, f"[-] db_path:'{db_path}' File not found!"
@@ -47,38 +97,296 @@ def decrypt(key: str, db_path, out_path):
         return False, f"[-] key:'{key}' Len Error!"
 
     password = bytes.fromhex(key.strip())
-    with open(db_path, "rb") as file:
-        blist = file.read()
-
-    salt = blist[:16]
-    byteKey = hashlib.pbkdf2_hmac("sha1", password, salt, DEFAULT_ITER, KEY_SIZE)
-    first = blist[16:DEFAULT_PAGESIZE]
+    first_page = read_first_page(db_path)
+    salt = first_page[:16]
     if len(salt) != 16:
         return False, f"[-] db_path:'{db_path}' File Error!"
+    if not check_key(password, first_page):
+        return False, f"[-] Key Error! (key:'{key}'; db_path:'{db_path}'; out_path:'{out_path}' )"
+    # 派生结果有缓存，同一个文件再次解密时不用重新派生
+    return True, derive_keys(password, salt)[0]
 
-    mac_salt = bytes([(salt[i] ^ 58) for i in range(16)])
-    mac_key = hashlib.pbkdf2_hmac("sha1", byteKey, mac_salt, 2, KEY_SIZE)
-    hash_mac = hmac.new(mac_key, first[:-32], hashlib.sha1)
-    hash_mac.update(b'\x01\x00\x00\x00')
 
-    if hash_mac.digest() != first[-32:-12]:
-        return False, f"[-] Key Error! (key:'{key}'; db_path:'{db_path}'; out_path:'{out_path}' )"
+def _page_digest(data, file_size, page):
+    """
+    每页末尾HMAC的前8字节：页内容或IV变了，HMAC就会变
+    不满一页的尾部没有HMAC，用内容的sha1代替
+    """
+    start = page * DEFAULT_PAGESIZE
+    end = start + DEFAULT_PAGESIZE
+    if end > file_size:
+        return hashlib.sha1(data[start:file_size]).digest()[:DIGEST_SIZE]
+    return data[end - 32:end - 32 + DIGEST_SIZE]
 
-    newblist = [blist[i:i + DEFAULT_PAGESIZE] for i in range(DEFAULT_PAGESIZE, len(blist), DEFAULT_PAGESIZE)]
 
-    with open(out_path, "wb") as deFile:
-        deFile.write(SQLITE_FILE_HEADER.encode())
-        t = AES.new(byteKey, AES.MODE_CBC, first[-48:-32])
-        decrypted = t.decrypt(first[:-48])
-        deFile.write(decrypted)
-        deFile.write(first[-48:])
+def _page_digests(data, file_size) -> bytes:
+    full = file_size // DEFAULT_PAGESIZE
+    digests = b''.join([
+        data[offset:offset + DIGEST_SIZE]
+        for offset in range(DEFAULT_PAGESIZE - 32, full * DEFAULT_PAGESIZE, DEFAULT_PAGESIZE)
+    ])
+    if file_size % DEFAULT_PAGESIZE:
+        digests += _page_digest(data, file_size, full)
+    return digests
 
-        for i in newblist:
-            t = AES.new(byteKey, AES.MODE_CBC, i[-48:-32])
-            decrypted = t.decrypt(i[:-48])
-            deFile.write(decrypted)
-            deFile.write(i[-48:])
-    return True, [db_path, out_path, key]
+
+def _read_manifest(out_path):
+    """
+    :return: (密钥指纹, 文件大小, 修改时间, 每页摘要) 或 None，旧版清单的修改时间为None
+    """
+    try:
+        with open(out_path + MANIFEST_SUFFIX, "rb") as file:
+            magic = file.read(4)
+            file.seek(0)
+            if magic == MANIFEST_MAGIC:
+                magic, page_size, file_size, fingerprint, mtime_ns = _MANIFEST_HEADER.unpack(
+                    file.read(_MANIFEST_HEADER.size))
+            else:
+                magic, page_size, file_size, fingerprint = _MANIFEST_HEADER_V1.unpack(
+                    file.read(_MANIFEST_HEADER_V1.size))
+                mtime_ns = None
+                if magic != b'WXPM':
+                    return None
+            digests = file.read()
+    except (OSError, struct.error):
+        return None
+    if page_size != DEFAULT_PAGESIZE or len(digests) % DIGEST_SIZE:
+        return None
+    return fingerprint, file_size, mtime_ns, digests
+
+
+def _write_manifest(out_path, fingerprint, file_size, mtime_ns, digests):
+    tmp_path = out_path + MANIFEST_SUFFIX + '.tmp'
+    with open(tmp_path, "wb") as file:
+        file.write(_MANIFEST_HEADER.pack(MANIFEST_MAGIC, DEFAULT_PAGESIZE, file_size, fingerprint, mtime_ns))
+        file.write(digests)
+    os.replace(tmp_path, out_path + MANIFEST_SUFFIX)
+
+
+def _remove_manifest(out_path):
+    try:
+        os.remove(out_path + MANIFEST_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+def _changed_pages(old_digests, digests) -> list:
+    """
+    比较两次的每页摘要，返回变化了的页号（包括新增的页）；先整段比较，相同的段直接跳过
+    """
+    changed = []
+    block = 512 * DIGEST_SIZE
+    for offset in range(0, len(digests), block):
+        if old_digests[offset:offset + block] == digests[offset:offset + block]:
+            continue
+        for pos in range(offset, min(offset + block, len(digests)), DIGEST_SIZE):
+            if old_digests[pos:pos + DIGEST_SIZE] != digests[pos:pos + DIGEST_SIZE]:
+                changed.append(pos // DIGEST_SIZE)
+    return changed
+
+
+def _page_ranges(pages, chunk_pages) -> list:
+    """
+    把页号合并成连续的[start, end)范围，每段不超过chunk_pages页
+    """
+    ranges = []
+    for page in pages:
+        if ranges and ranges[-1][1] == page and page - ranges[-1][0] < chunk_pages:
+            ranges[-1][1] = page + 1
+        else:
+            ranges.append([page, page + 1])
+    return [tuple(r) for r in ranges]
+
+
+def _has_wal(db_path) -> bool:
+    try:
+        return os.path.getsize(db_path + '-wal') > 0
+    except OSError:
+        return False
+
+
+def _plan_decrypt(byte_key, db_path, out_path, incremental, chunk_pages):
+    """
+    决定一个文件需要解密哪些页，并准备好输出文件
+    增量模式下和上次解密留下的清单比较：修改时间、大小、第一页和最后一页都没变，并且没有未合并的-wal文件时直接跳过；
+    否则计算每页摘要，只解密摘要变了的页
+    （第一页里的文件修改计数只在rollback journal模式下每次写事务都更新，WAL检查点写回主库时不更新、大小也可能不变，
+    所以不能只看第一页）
+    :return: (文件大小, 需要解密的页范围, 密钥指纹, 修改时间, 每页摘要)
+    """
+    fingerprint = hashlib.sha1(byte_key).digest()[:DIGEST_SIZE]
+    stat = os.stat(db_path)
+    file_size = stat.st_size
+    manifest = _read_manifest(out_path) if incremental and os.path.isfile(out_path) else None
+    if manifest is not None:
+        old_fingerprint, old_size, old_mtime_ns, old_digests = manifest
+        if old_fingerprint != fingerprint or os.path.getsize(out_path) != old_size:
+            manifest = None
+    with open(db_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if manifest is not None and old_size == file_size and old_mtime_ns == stat.st_mtime_ns \
+                and not _has_wal(db_path):
+            last = len(old_digests) // DIGEST_SIZE - 1
+            if old_digests[:DIGEST_SIZE] == _page_digest(data, file_size, 0) and \
+                    old_digests[last * DIGEST_SIZE:] == _page_digest(data, file_size, last):
+                return file_size, [], fingerprint, stat.st_mtime_ns, None
+        digests = _page_digests(data, file_size)
+    # 输出文件改动之前先删掉清单，中途失败时下次会全部重新解密
+    _remove_manifest(out_path)
+    if manifest is None:
+        page_num = len(digests) // DIGEST_SIZE
+        ranges = [(start, min(start + chunk_pages, page_num)) for start in range(0, page_num, chunk_pages)]
+        mode = "wb"
+    else:
+        ranges = _page_ranges(_changed_pages(old_digests, digests), chunk_pages)
+        mode = "r+b"
+    # 解密前后大小不变，先分配好输出文件，各块直接写到自己的偏移
+    with open(out_path, mode) as deFile:
+        deFile.truncate(file_size)
+    return file_size, ranges, fingerprint, stat.st_mtime_ns, digests
+
+
+def decrypt_files(tasks, workers=None, progress=None, chunk_pages=DEFAULT_CHUNK_PAGES, incremental=True,
+                  on_file=None):
+    """
+    并发解密多个数据库文件
+    所有文件按chunk_pages页分块，放进同一个进程池，大文件的块先调度，让最慢的文件最早开始；
+    某个文件出错只记录在它自己的结果里，不影响其他文件
+    解密完在输出文件旁边写一个每页摘要的清单（out_path + '.pages'），下次只解密变化了的页
+    :param tasks: [[key, db_path, out_path], ...]
+    :param workers: 进程数，默认CPU核数；1表示在当前进程解密
+    :param progress: 进度回调 progress(已解密字节数, 需要解密的总字节数)，每解密完一块调用一次
+    :param chunk_pages: 每块的页数
+    :param incremental: False时忽略清单，全部重新解密
+    :param on_file: 每个文件处理完（成功、失败或无需解密）立即回调 on_file(下标, 结果)，不用等整批结束
+    :return: 和tasks一一对应的结果，(True, [db_path, out_path, key]) 或 (False, 错误信息)
+    """
+    results = [None] * len(tasks)
+    jobs = []
+    manifests = {}
+    finished = set()
+
+    def finish(index):
+        if index in finished:
+            return
+        finished.add(index)
+        if results[index] is None:
+            key, db_path, out_path = tasks[index]
+            if index in manifests:
+                try:
+                    _write_manifest(out_path, *manifests[index])
+                except OSError:
+                    # 没有清单只是下次要全部重新解密
+                    pass
+            results[index] = (True, [db_path, out_path, key])
+        if on_file:
+            on_file(index, results[index])
+
+    for index, (key, db_path, out_path) in enumerate(tasks):
+        try:
+            ok, ret = _prepare_decrypt(key, db_path, out_path)
+            if ok:
+                file_size, chunks, fingerprint, mtime_ns, digests = _plan_decrypt(
+                    ret, db_path, out_path, incremental, chunk_pages
+                )
+        except (OSError, ValueError) as e:
+            ok, ret = False, f"[-] db_path:'{db_path}' {e}"
+        if not ok:
+            results[index] = (False, ret)
+            finish(index)
+            continue
+        if digests is not None:
+            manifests[index] = (fingerprint, file_size, mtime_ns, digests)
+        jobs.append((file_size, index, ret, chunks))
+    jobs.sort(key=lambda job: job[0], reverse=True)
+
+    def chunk_size(file_size, start, end):
+        return min(end * DEFAULT_PAGESIZE, file_size) - start * DEFAULT_PAGESIZE
+
+    def job_size(job):
+        return sum(chunk_size(job[0], start, end) for start, end in job[3])
+
+    def fail(index, e):
+        if results[index] is None:
+            results[index] = (False, f"[-] db_path:'{tasks[index][1]}' {e}")
+
+    # 没有变化、不用解密的文件直接完成
+    for job in jobs:
+        if not job[3]:
+            finish(job[1])
+    total = sum(job_size(job) for job in jobs)
+    done = 0
+    workers = workers or os.cpu_count() or 1
+    chunk_num = sum(len(job[3]) for job in jobs)
+    parallel = workers > 1 and chunk_num > 1 and total >= PARALLEL_MIN_SIZE
+    if parallel:
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, chunk_num)) as executor:
+                futures = {}
+                remaining = {}
+                for file_size, index, byte_key, chunks in jobs:
+                    db_path, out_path = tasks[index][1], tasks[index][2]
+                    remaining[index] = len(chunks)
+                    for start, end in chunks:
+                        future = executor.submit(_decrypt_range, byte_key, db_path, out_path, start, end)
+                        futures[future] = (index, chunk_size(file_size, start, end))
+                for future in as_completed(futures):
+                    index, size = futures[future]
+                    try:
+                        future.result()
+                    except BrokenProcessPool:
+                        raise
+                    except (OSError, ValueError) as e:
+                        fail(index, e)
+                    done += size
+                    if progress:
+                        progress(done, total)
+                    remaining[index] -= 1
+                    if not remaining[index]:
+                        finish(index)
+        except BrokenProcessPool:
+            # 起不了子进程（例如打包后没有调用freeze_support），没完成的文件退回单进程
+            parallel = False
+            done = sum(job_size(job) for job in jobs if job[1] in finished)
+            for _, index, _, _ in jobs:
+                if index not in finished:
+                    results[index] = None
+
+    if not parallel:
+        for file_size, index, byte_key, chunks in jobs:
+            if index in finished:
+                continue
+            db_path, out_path = tasks[index][1], tasks[index][2]
+            try:
+                with open(db_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    with open(out_path, "r+b") as deFile:
+                        for start, end in chunks:
+                            _write_pages(byte_key, data, deFile, start, end)
+                            done += chunk_size(file_size, start, end)
+                            if progress:
+                                progress(done, total)
+            except (OSError, ValueError) as e:
+                fail(index, e)
+            finish(index)
+    return results
+
+
+# 通过密钥解密数据库
+def decrypt(key: str, db_path, out_path, workers=None, progress=None, chunk_pages=DEFAULT_CHUNK_PAGES,
+            incremental=True):
+    """
+    通过密钥解密数据库
+    输入文件用mmap映射，按chunk_pages页分块解密后直接写到输出文件的对应位置，内存占用和文件大小无关；
+    大文件的分块交给进程池并行解密
+    :param key: 密钥 64位16进制字符串
+    :param db_path:  待解密的数据库路径(必须是文件)
+    :param out_path:  解密后的数据库输出路径(必须是文件)
+    :param workers: 进程数，默认CPU核数；1表示在当前进程解密
+    :param progress: 进度回调 progress(已解密字节数, 总字节数)，每解密完一块调用一次
+    :param chunk_pages: 每块的页数
+    :param incremental: 同decrypt_files
+    :return:
+    """
+    return decrypt_files([[key, db_path, out_path]], workers, progress, chunk_pages, incremental)[0]
 
 
 def batch_decrypt(key: str, db_path: Union[str, List[str]], out_path: str, is_logging: bool = False):
@@ -137,9 +445,13 @@ def batch_decrypt(key: str, db_path: Union[str, List[str]], out_path: str, is_lo
         if is_logging: print(error)
         return False, error
 
-    result = []
-    for i in process_list:
-        result.append(decrypt(*i))  # 解密
+    progress = None
+    if is_logging:
+        def progress(done, total):
+            print(f"\r[*] 解密中 {done * 100 // max(total, 1)}% ({done >> 20}/{total >> 20} MB)", end='', flush=True)
+    result = decrypt_files(process_list, progress=progress)  # 解密
+    if is_logging:
+        print()
 
     # 删除空文件夹
     for root, dirs, files in os.walk(out_path, topdown=False):
@@ -166,7 +478,8 @@ def batch_decrypt(key: str, db_path: Union[str, List[str]], out_path: str, is_lo
 
 def encrypt(key: str, db_path, out_path):
     """
-    通过密钥加密数据库
+    通过密钥加密数据库，是decrypt的逆过程
+    每页末尾48字节的保留区被IV、HMAC和填充覆盖，明文数据库需要和解密出来的一样预留这48字节
     :param key: 密钥 64位16进制字符串
     :param db_path:  待加密的数据库路径(必须是文件)
     :param out_path:  加密后的数据库输出路径(必须是文件)
@@ -181,28 +494,30 @@ def encrypt(key: str, db_path, out_path):
         return False, f"[-] key:'{key}' Len Error!"
 
     password = bytes.fromhex(key.strip())
-    with open(db_path, "rb") as file:
-        blist = file.read()
-
     salt = os.urandom(16)  # 生成随机盐值
-    byteKey = hashlib.pbkdf2_hmac("sha1", password, salt, DEFAULT_ITER, KEY_SIZE)
-
-    # 计算消息认证码
-    mac_salt = bytes([(salt[i] ^ 58) for i in range(16)])
-    mac_key = hashlib.pbkdf2_hmac("sha1", byteKey, mac_salt, 2, KEY_SIZE)
-    hash_mac = hmac.new(mac_key, blist[:-32], hashlib.sha1)
-    hash_mac.update(b'\x01\x00\x00\x00')
-    mac_digest = hash_mac.digest()
-
-    newblist = [blist[i:i + DEFAULT_PAGESIZE] for i in range(DEFAULT_PAGESIZE, len(blist), DEFAULT_PAGESIZE)]
-
-    with open(out_path, "wb") as enFile:
-        enFile.write(salt)  # 写入盐值
-        enFile.write(mac_digest)  # 写入消息认证码
-
-        for i in newblist:
-            t = AES.new(byteKey, AES.MODE_CBC, os.urandom(16))  # 生成随机的初始向量
-            encrypted = t.encrypt(i)  # 加密数据块
+    byteKey, mac_key = derive_keys(password, salt)
+
+    with open(db_path, "rb") as file, open(out_path, "wb") as enFile:
+        page_no = 1
+        while True:
+            page = file.read(DEFAULT_PAGESIZE)
+            if not page:
+                break
+            page = page.ljust(DEFAULT_PAGESIZE, b'\x00')
+            if page_no == 1:
+                # 第一页的文件头换成盐值
+                enFile.write(salt)
+                page = page[16:]
+            iv = os.urandom(16)  # 每页随机的初始向量
+            t = AES.new(byteKey, AES.MODE_CBC, iv)
+            encrypted = t.encrypt(page[:-48])  # 加密数据块
+            # 计算消息认证码
+            hash_mac = hmac.new(mac_key, encrypted + iv, hashlib.sha1)
+            hash_mac.update(page_no.to_bytes(4, 'little'))
             enFile.write(encrypted)
+            enFile.write(iv)
+            enFile.write(hash_mac.digest())
+            enFile.write(b'\x00' * 12)
+            page_no += 1
 
-    return True, [db_path, out_path, key]
\ No newline at end of file
+    return True, [db_path, out_path, key]
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-#
+"""
+不解密出明文副本，直接查询加密数据库
+用apsw注册一个只读的SQLite VFS：SQLite读哪一页就从加密文件里读出哪一页，按decrypt.py里的格式（盐值、每页末尾的IV）解密后返回，
+解密后的页放在一个所有数据库共用的LRU缓存里
+MSG、MediaMSG的分库ATTACH到同一个连接上，再建同名的临时视图把各分库的表拼起来，原来的SQL不用改；
+各分库的localId都从1开始，视图里第i个分库的localId加上i<<SHARD_ID_BITS，和合并后的库一样按分库顺序递增、不重复
+一个连接能ATTACH的数据库数有上限（SQLite编译时的SQLITE_MAX_ATTACHED，默认10），分库更多时打不开，要先解密
+apsw是可选依赖，调用方导入本模块时要处理ImportError
+"""
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import apsw
+
+from app.config import DB_PAGE_CACHE_PAGES, DB_STATEMENT_CACHE_SIZE
+from app.decrypt.decrypt import DEFAULT_PAGESIZE, decrypt_page
+from app.decrypt.key_validator import SALT_SIZE, check_key, derive_keys, read_first_page
+
+VFS_NAME = 'wxdecrypt'
+SHARD_SCHEMA = 'shard{}'
+UNION_TABLES = ('MSG', 'Media')  # 分库里需要拼起来的表
+SHARD_ID_COLUMNS = {'MSG': 'localId'}  # 各分库里各自编号的列，视图里加上分库的偏移量
+SHARD_ID_BITS = 32  # 单个分库的localId不会超过2^32
+SHARDED_DATABASES = {
+    re.compile(r'^MSG(\d+)\.db$'): 'MSG.db',
+    re.compile(r'^MediaMSG(\d+)\.db$'): 'MediaMSG.db',
+}
+
+_vfs = None
+_vfs_lock = threading.Lock()
+
+
+class PageCache:
+    """
+    解密后的页的LRU缓存，key为(文件路径, 页号)
+    每个读事务开始时检查文件的大小和修改时间，文件被微信改写后丢弃这个文件的缓存
+    """
+
+    def __init__(self, capacity=DB_PAGE_CACHE_PAGES):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, index):
+        with self._lock:
+            page = self._pages.get((path, index))
+            if page is None:
+                self.misses += 1
+            else:
+                self._pages.move_to_end((path, index))
+                self.hits += 1
+            return page
+
+    def put(self, path, index, page, version):
+        with self._lock:
+            if self._versions.get(path) != version:
+                # 解密期间文件变了，这一页不能缓存
+                return
+            self._pages[(path, index)] = page
+            self._pages.move_to_end((path, index))
+            while len(self._pages) > self.capacity:
+                self._pages.popitem(last=False)
+
+    def check_version(self, path):
+        """
+        :return: 文件当前的(大小, 修改时间)
+        """
+        try:
+            stat = os.stat(path)
+            version = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            version = None
+        with self._lock:
+            if path in self._versions and self._versions[path] != version:
+                for key in [key for key in self._pages if key[0] == path]:
+                    del self._pages[key]
+            self._versions[path] = version
+        return version
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self._versions.clear()
+
+
+class EncryptedFile(apsw.VFSFile):
+    """
+    加密的主数据库文件：读操作按页解密，日志等其他文件由EncryptedVFS直接交给默认VFS
+    """
+
+    def __init__(self, vfs: 'EncryptedVFS', name, flags):
+        # 只读打开
+        flags[0] = (flags[0] & ~(apsw.SQLITE_OPEN_READWRITE | apsw.SQLITE_OPEN_CREATE)) | apsw.SQLITE_OPEN_READONLY
+        super().__init__('', name, flags)
+        self.vfs = vfs
+        self.cache = vfs.cache
+        filename = name.filename() if isinstance(name, apsw.URIFilename) else name
+        self.path = os.path.normcase(os.path.abspath(filename))
+        self.byte_key = None
+        self.version = self.cache.check_version(self.path)
+        self._load_key()
+
+    def _load_key(self):
+        salt = super().xRead(SALT_SIZE, 0)
+        self.byte_key = derive_keys(self.vfs.password, salt)[0] if len(salt) == SALT_SIZE else None
+
+    def _page(self, index) -> bytes:
+        page = self.cache.get(self.path, index)
+        if page is None:
+            page = super().xRead(DEFAULT_PAGESIZE, index * DEFAULT_PAGESIZE)
+            if len(page) < DEFAULT_PAGESIZE or self.byte_key is None:
+                # 读到了文件末尾，交给SQLite按短读处理
+                return page
+            page = decrypt_page(self.byte_key, page, index)
+            self.cache.put(self.path, index, page, self.version)
+        return page
+
+    def xRead(self, amount, offset):
+        first = offset // DEFAULT_PAGESIZE
+        last = (offset + amount - 1) // DEFAULT_PAGESIZE
+        start = offset - first * DEFAULT_PAGESIZE
+        if first == last:
+            return self._page(first)[start:start + amount]
+        data = b''.join(self._page(index) for index in range(first, last + 1))
+        return data[start:start + amount]
+
+    def xLock(self, level):
+        super().xLock(level)
+        if level == apsw.SQLITE_LOCK_SHARED:
+            # 新的读事务，文件可能已经被微信改写
+            version = self.cache.check_version(self.path)
+            if version != self.version:
+                self.version = version
+                self._load_key()
+
+    def xWrite(self, data, offset):
+        raise apsw.ReadOnlyError('encrypted database is read-only')
+
+    def xTruncate(self, newsize):
+        raise apsw.ReadOnlyError('encrypted database is read-only')
+
+
+class EncryptedVFS(apsw.VFS):
+    def __init__(self, password: bytes, cache: PageCache = None):
+        self.password = password
+        self.cache = cache or PageCache()
+        super().__init__(VFS_NAME, '')
+
+    def xOpen(self, name, flags):
+        if flags[0] & apsw.SQLITE_OPEN_MAIN_DB:
+            return EncryptedFile(self, name, flags)
+        return apsw.VFSFile('', name, flags)
+
+
+def enable(key: str) -> EncryptedVFS:
+    """
+    注册VFS，换密钥时清空页缓存
+    :param key: 64位十六进制密钥
+    """
+    global _vfs
+    password = bytes.fromhex(key.strip())
+    with _vfs_lock:
+        if _vfs is None:
+            _vfs = EncryptedVFS(password)
+        elif _vfs.password != password:
+            _vfs.password = password
+            _vfs.cache.clear()
+        return _vfs
+
+
+def page_cache() -> PageCache:
+    return _vfs.cache if _vfs else None
+
+
+def _uri(path) -> str:
+    from app.DataBase.pool import read_only_uri
+    return f'{read_only_uri(path)}&vfs={VFS_NAME}'
+
+
+def _database_error(e: apsw.Error) -> sqlite3.DatabaseError:
+    if isinstance(e, apsw.SQLError):
+        return sqlite3.OperationalError(str(e))
+    return sqlite3.DatabaseError(str(e))
+
+
+class Cursor:
+    """
+    apsw游标套一层sqlite3游标的接口（execute、fetch*、row_factory）
+    """
+
+    def __init__(self, cursor: apsw.Cursor):
+        self._cursor = cursor
+        self._running = False
+        self.row_factory = None
+
+    def execute(self, sql, parameters=()):
+        try:
+            self._cursor.execute(sql, tuple(parameters))
+        except apsw.Error as e:
+            raise _database_error(e) from e
+        self._running = True
+        return self
+
+    def fetchmany(self, size=1) -> list:
+        rows = []
+        if not self._running:
+            return rows
+        try:
+            for row in self._cursor:
+                rows.append(self.row_factory(self, row) if self.row_factory else row)
+                if len(rows) >= size:
+                    return rows
+        except apsw.Error as e:
+            raise _database_error(e) from e
+        self._running = False
+        return rows
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchall(self) -> list:
+        return self.fetchmany(float('inf'))
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(256)
+            if not rows:
+                return
+            yield from rows
+
+    def close(self):
+        self._running = False
+        self._cursor.close()
+
+
+class Connection:
+    """
+    apsw连接套一层sqlite3连接的接口，ConnectionPool和各数据库类不用区分是不是加密数据库
+    """
+
+    def __init__(self, conn: apsw.Connection):
+        self._conn = conn
+
+    def cursor(self) -> Cursor:
+        return Cursor(self._conn.cursor())
+
+    def execute(self, sql, parameters=()) -> Cursor:
+        return self.cursor().execute(sql, parameters)
+
+    def set_trace_callback(self, trace_callback):
+        if trace_callback is None:
+            self._conn.exec_trace = None
+        else:
+            self._conn.exec_trace = lambda cursor, sql, bindings: trace_callback(sql) or True
+
+    def close(self):
+        self._conn.close()
+
+
+def _create_union_views(conn: apsw.Connection, shard_num):
+    """
+    在temp里建和分库表同名的视图，查询时temp优先于main，原来的SQL直接查到所有分库
+    各分库的列可能不一样（新版本微信加了列），视图只取所有分库都有的列
+    各分库自己编号的列（SHARD_ID_COLUMNS）加上分库序号<<SHARD_ID_BITS，拼起来之后不重复
+    """
+    schemas = ['main'] + [SHARD_SCHEMA.format(i) for i in range(1, shard_num)]
+    for table in UNION_TABLES:
+        columns = None
+        for schema in schemas:
+            names = [row[1] for row in conn.execute(f'PRAGMA {schema}.table_info("{table}")')]
+            columns = names if columns is None else [column for column in columns if column in names]
+        if not columns:
+            continue
+        id_column = SHARD_ID_COLUMNS.get(table)
+        selects = []
+        for i, schema in enumerate(schemas):
+            select = ','.join(
+                f'"{column}"+{i << SHARD_ID_BITS} AS "{column}"' if column == id_column and i else f'"{column}"'
+                for column in columns
+            )
+            selects.append(f'SELECT {select} FROM {schema}."{table}"')
+        conn.execute(f'CREATE TEMP VIEW "{table}" AS {" UNION ALL ".join(selects)}')
+
+
+def connect(paths, cached_statements=DB_STATEMENT_CACHE_SIZE) -> Connection:
+    """
+    只读打开加密数据库，有多个分库时ATTACH到同一个连接上
+    :param paths: 加密数据库路径，分库按编号排序
+    :param cached_statements: 预编译语句缓存数
+    :return: 和sqlite3接口一致的连接
+    :raise sqlite3.DatabaseError: 密钥错误，或者分库数超过了能ATTACH的上限
+    """
+    if _vfs is None:
+        raise sqlite3.ProgrammingError('encrypted database key is not set')
+    for path in paths:
+        if not check_key(_vfs.password, read_first_page(path)):
+            raise sqlite3.DatabaseError(f'{path}: key error')
+    try:
+        conn = apsw.Connection(
+            _uri(paths[0]),
+            flags=apsw.SQLITE_OPEN_READONLY | apsw.SQLITE_OPEN_URI,
+            vfs=VFS_NAME,
+            statementcachesize=cached_statements,
+        )
+        if len(paths) > 1:
+            # 超过编译时的上限时limit只会设到上限，设完再读一次
+            conn.limit(apsw.SQLITE_LIMIT_ATTACHED, len(paths) - 1)
+            max_attached = conn.limit(apsw.SQLITE_LIMIT_ATTACHED, -1)
+            if len(paths) - 1 > max_attached:
+                conn.close()
+                raise sqlite3.DatabaseError(
+                    f'{len(paths)} shards exceed the SQLite attach limit ({max_attached + 1}), decrypt them instead'
+                )
+            for i, path in enumerate(paths[1:], 1):
+                conn.execute(f'ATTACH DATABASE ? AS {SHARD_SCHEMA.format(i)}', (_uri(path),))
+            _create_union_views(conn, len(paths))
+    except apsw.Error as e:
+        raise _database_error(e) from e
+    return Connection(conn)
+
+
+def collect_sources(msg_dir, db_dir) -> dict:
+    """
+    微信Msg文件夹下的加密数据库和解密后的数据库路径的对应关系，分库对应合并后的数据库
+    :param msg_dir: 微信数据文件夹下的Msg文件夹
+    :param db_dir: 解密后的数据库文件夹（见app.config.DB_DIR）
+    :return: {解密后的数据库路径: [加密数据库路径, ...]}
+    """
+    from app.decrypt.ingest import collect_decrypt_tasks
+
+    sources = {}
+    shards = {}
+    for _, inpath, output_path in collect_decrypt_tasks('', msg_dir, db_dir):
+        name = os.path.basename(output_path)
+        for pattern, merged_name in SHARDED_DATABASES.items():
+            match = pattern.match(name)
+            if match:
+                shards.setdefault(os.path.join(db_dir, merged_name), []).append((int(match.group(1)), inpath))
+                break
+        else:
+            sources[output_path] = [inpath]
+    for output_path, items in shards.items():
+        sources[output_path] = [inpath for _, inpath in sorted(items)]
+    return sources
+
+
+if __name__ == '__main__':
+    # 直接统计加密数据库里的消息数：python -m app.decrypt.encrypted_vfs 密钥 微信Msg文件夹
+    import sys
+    import time
+
+    enable(sys.argv[1])
+    msg_sources = collect_sources(sys.argv[2], '.')
+    start = time.time()
+    msg_conn = connect(msg_sources[os.path.join('.', 'MSG.db')])
+    print(msg_conn.execute('SELECT count(*) FROM MSG').fetchone()[0], f'{time.time() - start:.2f}s')
+    print(f'page cache hits: {page_cache().hits} misses: {page_cache().misses}')
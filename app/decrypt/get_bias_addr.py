@@ -8,7 +8,6 @@
 # -------------------------------------------------------------------------------
 import argparse
 import ctypes
-import hashlib
 import json
 import multiprocessing
 import os
@@ -19,7 +18,8 @@ import psutil
 from win32com.client import Dispatch
 from pymem import Pymem
 import pymem
-import hmac
+
+from app.decrypt.key_validator import check_key, find_key, read_first_page
 
 ReadProcessMemory = ctypes.windll.kernel32.ReadProcessMemory
 void_p = ctypes.c_void_p
@@ -29,15 +29,7 @@ DEFAULT_ITER = 64000
 
 
 def validate_key(key, salt, first, mac_salt):
-    byteKey = hashlib.pbkdf2_hmac("sha1", key, salt, DEFAULT_ITER, KEY_SIZE)
-    mac_key = hashlib.pbkdf2_hmac("sha1", byteKey, mac_salt, 2, KEY_SIZE)
-    hash_mac = hmac.new(mac_key, first[:-32], hashlib.sha1)
-    hash_mac.update(b'\x01\x00\x00\x00')
-
-    if hash_mac.digest() == first[-32:-12]:
-        return True
-    else:
-        return False
+    return check_key(key, salt + first)
 
 
 def get_exe_bit(file_path):
@@ -190,25 +182,6 @@ class BiasAddr:
             key_bytes = bytes(key)
             return key_bytes
 
-        def verify_key(key, wx_db_path):
-            KEY_SIZE = 32
-            DEFAULT_PAGESIZE = 4096
-            DEFAULT_ITER = 64000
-            with open(wx_db_path, "rb") as file:
-                blist = file.read(5000)
-            salt = blist[:16]
-            byteKey = hashlib.pbkdf2_hmac("sha1", key, salt, DEFAULT_ITER, KEY_SIZE)
-            first = blist[16:DEFAULT_PAGESIZE]
-
-            mac_salt = bytes([(salt[i] ^ 58) for i in range(16)])
-            mac_key = hashlib.pbkdf2_hmac("sha1", byteKey, mac_salt, 2, KEY_SIZE)
-            hash_mac = hmac.new(mac_key, first[:-32], hashlib.sha1)
-            hash_mac.update(b'\x01\x00\x00\x00')
-
-            if hash_mac.digest() != first[-32:-12]:
-                return False
-            return True
-
         phone_type1 = "iphone\x00"
         phone_type2 = "android\x00"
         phone_type3 = "ipad\x00"
@@ -227,13 +200,18 @@ class BiasAddr:
             type2_addrs) >= 2 else type3_addrs if len(type3_addrs) >= 2 else "None"
         if type_addrs == "None":
             return 0
+        # 先把所有候选密钥读出来，再批量校验
+        candidates = []
         for i in type_addrs[::-1]:
             for j in range(i, i - 2000, -addr_len):
                 key_bytes = read_key_bytes(pm.process_handle, j, addr_len)
                 if key_bytes == "None":
                     continue
-                if verify_key(key_bytes, MicroMsg_path):
-                    return j - module.lpBaseOfDll
+                candidates.append((j, key_bytes))
+        key_bytes = find_key([key for _, key in candidates], read_first_page(MicroMsg_path))
+        for j, key in candidates:
+            if key == key_bytes:
+                return j - module.lpBaseOfDll
         return 0
 
     def run(self, logging_path=False, version_list_path=None):
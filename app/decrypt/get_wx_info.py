@@ -5,8 +5,6 @@
 # Author:       xaoyaoo
 # Date:         2023/08/21
 # -------------------------------------------------------------------------------
-import hmac
-import hashlib
 import ctypes
 import json
 import winreg
@@ -22,6 +20,8 @@ import pymem.process
 from pymem import Pymem
 from win32api import GetFileVersionInfo, HIWORD, LOWORD
 
+from app.decrypt.key_validator import find_key, read_first_page
+
 """
 class Wechat来源：https://github.com/SnowMeteors/GetWeChatKey
 """
@@ -300,27 +300,6 @@ def get_key(db_path, addr_len):
         key_bytes = bytes(key)
         return key_bytes
 
-    def verify_key(key, wx_db_path):
-        if not wx_db_path or wx_db_path.lower() == "none":
-            return True
-        KEY_SIZE = 32
-        DEFAULT_PAGESIZE = 4096
-        DEFAULT_ITER = 64000
-        with open(wx_db_path, "rb") as file:
-            blist = file.read(5000)
-        salt = blist[:16]
-        byteKey = hashlib.pbkdf2_hmac("sha1", key, salt, DEFAULT_ITER, KEY_SIZE)
-        first = blist[16:DEFAULT_PAGESIZE]
-
-        mac_salt = bytes([(salt[i] ^ 58) for i in range(16)])
-        mac_key = hashlib.pbkdf2_hmac("sha1", byteKey, mac_salt, 2, KEY_SIZE)
-        hash_mac = hmac.new(mac_key, first[:-32], hashlib.sha1)
-        hash_mac.update(b'\x01\x00\x00\x00')
-
-        if hash_mac.digest() != first[-32:-12]:
-            return False
-        return True
-
     phone_type1 = "iphone\x00"
     phone_type2 = "android\x00"
     phone_type3 = "ipad\x00"
@@ -338,14 +317,18 @@ def get_key(db_path, addr_len):
     # print(type_addrs)
     if type_addrs == "None":
         return "None"
+    if db_path == "None":
+        return "None"
+    # 先把所有候选密钥读出来，再批量校验
+    candidates = []
     for i in type_addrs[::-1]:
         for j in range(i, i - 2000, -addr_len):
             key_bytes = read_key_bytes(pm.process_handle, j, addr_len)
             if key_bytes == "None":
                 continue
-            if db_path != "None" and verify_key(key_bytes, MicroMsg_path):
-                return key_bytes.hex()
-    return "None"
+            candidates.append(key_bytes)
+    key_bytes = find_key(candidates, read_first_page(MicroMsg_path))
+    return key_bytes.hex() if key_bytes else "None"
 
 
 # 读取微信信息(account,mobile,name,mail,wxid,key)
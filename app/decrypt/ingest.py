@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-#
+"""
+解密、合并流水线
+解密在进程池里做（CPU密集），合并在单独的线程里做（SQLite写入，I/O密集），两者之间用有界队列连接：
+一个MSG分库解密完立即交给合并线程，合并线程按分库编号顺序合并，合并跟不上时解密结果的收集会在队列上等待
+界面和命令行都通过IngestProgress拿到同一个0~1的总进度
+"""
+import os
+import queue
+import re
+import threading
+import traceback
+
+from app.DataBase.merge import MsgMerger, merge_MediaMSG_databases
+from app.decrypt.decrypt import decrypt_files
+from app.log import logger
+
+MSG_SHARD = re.compile(r'^MSG(\d+)\.db$')
+MERGE_QUEUE_SIZE = 4  # 解密完等待合并的分库数上限
+# 各阶段在总进度里的占比，剩下的是合并后建索引、汇总表等收尾工作
+DECRYPT_WEIGHT = 0.6
+MERGE_WEIGHT = 0.3
+
+
+def collect_decrypt_tasks(key, msg_dir, output_dir) -> list:
+    """
+    找出微信Msg文件夹下需要解密的数据库
+    @param key: 密钥
+    @param msg_dir: 微信数据文件夹下的Msg文件夹
+    @param output_dir: 解密后的输出文件夹
+    @return: [[key, 加密数据库路径, 输出路径], ...]
+    """
+    tasks = []
+    if not os.path.exists(msg_dir):
+        return tasks
+    for root, dirs, files in os.walk(msg_dir):
+        for file in files:
+            if '.db' == file[-3:]:
+                if 'xInfo.db' == file:
+                    continue
+                inpath = os.path.join(root, file)
+                output_path = os.path.join(output_dir, file)
+                tasks.append([key, inpath, output_path])
+            else:
+                try:
+                    name, suffix = file.split('.')
+                    if suffix.startswith('db_SQLITE'):
+                        inpath = os.path.join(root, file)
+                        output_path = os.path.join(output_dir, name + '.db')
+                        tasks.append([key, inpath, output_path])
+                except ValueError:
+                    continue
+    return tasks
+
+
+class IngestProgress:
+    """
+    把解密（字节数）和合并（分库数）两个阶段的进度汇总成一个0~1的总进度
+    callback(进度, 说明)，会在解密和合并两个线程里被调用
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.decrypt = 0.0
+        self.merge = 0.0
+        self.finalize = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def fraction(self) -> float:
+        return (
+                DECRYPT_WEIGHT * self.decrypt
+                + MERGE_WEIGHT * self.merge
+                + (1 - DECRYPT_WEIGHT - MERGE_WEIGHT) * self.finalize
+        )
+
+    def _report(self, message):
+        if self.callback:
+            self.callback(self.fraction, message)
+
+    def decrypted(self, done, total):
+        with self._lock:
+            self.decrypt = done / total if total else 1.0
+            self._report(f'解密 {self.decrypt:.0%}')
+
+    def merged(self, done, total, path=''):
+        with self._lock:
+            self.merge = done / total if total else 1.0
+            self._report(f'合并 {done}/{total} {os.path.basename(path)}')
+
+    def stage(self, message, finalize=None):
+        with self._lock:
+            if finalize is not None:
+                self.finalize = finalize
+            self._report(message)
+
+
+def shard_number(path) -> int:
+    match = MSG_SHARD.match(os.path.basename(path))
+    return int(match.group(1)) if match else -1
+
+
+def _merge_stage(shards: queue.Queue, target_path, order, progress: IngestProgress, state: dict):
+    """
+    合并线程：从队列里取解密完的MSG分库(路径, 是否成功)，取到None表示解密结束
+    解密按文件大小调度，完成顺序和分库编号无关；合并必须按编号进行，新库的localId才和时间顺序一致
+    （回复消息按localId查找、统计表和全文索引按localId增量更新），提前解密完的分库等编号更小的分库合并完再合并
+    @param order: 所有MSG分库的输出路径，按编号排序
+    """
+    merger = MsgMerger(target_path)
+    pending = {}
+    next_index = 0
+
+    def merge_ready():
+        nonlocal next_index
+        while next_index < len(order) and order[next_index] in pending:
+            path = order[next_index]
+            next_index += 1
+            if pending.pop(path):
+                merger.merge_shard(path)
+                state['merged'] += 1
+                progress.merged(state['merged'], state['total'], path)
+
+    try:
+        while True:
+            item = shards.get()
+            if item is None:
+                break
+            path, ok = item
+            pending[path] = ok
+            merge_ready()
+        # 没有结果的分库（解密出错中止）不再等待，剩下的按编号合并
+        for path in order[next_index:]:
+            pending.setdefault(path, False)
+        merge_ready()
+        progress.stage('更新索引和统计数据', finalize=0.0)
+        state['stats'] = merger.close()
+    except Exception:
+        merger.close(finalize=False)
+        state['error'] = traceback.format_exc()
+        logger.error(f'合并数据库出错:\n{state["error"]}')
+        # 让解密线程不会卡在已满的队列上
+        while True:
+            try:
+                if shards.get_nowait() is None:
+                    break
+            except queue.Empty:
+                break
+
+
+def ingest(tasks, output_dir, progress=None, workers=None, queue_size=MERGE_QUEUE_SIZE) -> dict:
+    """
+    解密并合并数据库，MSG分库一边解密一边合并
+    @param tasks: 解密任务，见collect_decrypt_tasks
+    @param output_dir: 解密后的输出文件夹，合并出的MSG.db、MediaMSG.db也放在这里
+    @param progress: 进度回调 progress(0~1的总进度, 说明)
+    @param workers: 解密进程数，默认CPU核数
+    @param queue_size: 解密完等待合并的分库数上限
+    @return: {'decrypt': decrypt_files的结果, 'merge': [(分库路径, 新增行数, 耗时秒)], 'error': 合并出错信息或None}
+    """
+    progress = IngestProgress(progress)
+    shards = queue.Queue(maxsize=queue_size)
+    order = sorted((task[2] for task in tasks if MSG_SHARD.match(os.path.basename(task[2]))), key=shard_number)
+    state = {'merged': 0, 'total': len(order), 'stats': [], 'error': None}
+    merge_thread = threading.Thread(
+        target=_merge_stage,
+        args=(shards, os.path.join(output_dir, 'MSG.db'), order, progress, state),
+        name='MsgMerger',
+        daemon=True,
+    )
+    merge_thread.start()
+
+    def on_file(index, result):
+        out_path = tasks[index][2]
+        if not MSG_SHARD.match(os.path.basename(out_path)):
+            return
+        ok = bool(result[0]) and state['error'] is None
+        if not ok:
+            state['total'] -= 1
+        # 失败的分库也要告诉合并线程，否则编号更大的分库会一直等它
+        if state['error'] is None:
+            # 队列满时在这里等待合并线程，形成反压
+            shards.put((out_path, ok))
+
+    try:
+        results = decrypt_files(tasks, workers=workers, progress=progress.decrypted, on_file=on_file)
+    finally:
+        shards.put(None)
+        merge_thread.join()
+    progress.stage('合并语音消息', finalize=0.5)
+
+    # 语音消息库在SQLite里增量合并，只拷贝新的语音
+    source_databases = [os.path.join(output_dir, f"MediaMSG{i}.db") for i in range(50)]
+    merge_MediaMSG_databases(source_databases, os.path.join(output_dir, 'MediaMSG.db'))
+    progress.stage('完成', finalize=1.0)
+    return {'decrypt': results, 'merge': state['stats'], 'error': state['error']}
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-#
+"""
+数据库密钥校验
+只读数据库的第一页，用第一页末尾的HMAC判断候选密钥是否正确
+PBKDF2派生出的(解密密钥, HMAC密钥)在本次运行内按(密钥, 盐值)缓存，同一个文件反复解密或校验时不再重复派生
+"""
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+from typing import Tuple, Optional
+
+KEY_SIZE = 32
+DEFAULT_PAGESIZE = 4096
+DEFAULT_ITER = 64000
+SALT_SIZE = 16
+PARALLEL_MIN_CANDIDATES = 8  # 候选密钥少于这个数时起进程池不划算
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _derive(password: bytes, salt: bytes) -> Tuple[bytes, bytes]:
+    byte_key = hashlib.pbkdf2_hmac("sha1", password, salt, DEFAULT_ITER, KEY_SIZE)
+    mac_salt = bytes([(salt[i] ^ 58) for i in range(SALT_SIZE)])
+    mac_key = hashlib.pbkdf2_hmac("sha1", byte_key, mac_salt, 2, KEY_SIZE)
+    return byte_key, mac_key
+
+
+def derive_keys(password: bytes, salt: bytes) -> Tuple[bytes, bytes]:
+    """
+    由主密钥和文件的盐值派生解密密钥和HMAC密钥，结果会缓存
+    :param password: 32字节主密钥
+    :param salt: 数据库文件开头的16字节盐值
+    :return: (解密密钥, HMAC密钥)
+    """
+    with _cache_lock:
+        keys = _cache.get((password, salt))
+    if keys is None:
+        keys = _derive(password, salt)
+        with _cache_lock:
+            _cache[(password, salt)] = keys
+    return keys
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+def read_first_page(db_path) -> bytes:
+    with open(db_path, "rb") as file:
+        return file.read(DEFAULT_PAGESIZE)
+
+
+def _hmac_ok(mac_key: bytes, first_page: bytes) -> bool:
+    first = first_page[SALT_SIZE:DEFAULT_PAGESIZE]
+    hash_mac = hmac.new(mac_key, first[:-32], hashlib.sha1)
+    hash_mac.update(b'\x01\x00\x00\x00')
+    return hash_mac.digest() == first[-32:-12]
+
+
+def check_key(password: bytes, first_page: bytes) -> bool:
+    """
+    :param password: 32字节主密钥
+    :param first_page: 数据库第一页，见read_first_page
+    :return: 密钥是否正确
+    """
+    if len(first_page) < SALT_SIZE + 48:
+        return False
+    return _hmac_ok(derive_keys(password, first_page[:SALT_SIZE])[1], first_page)
+
+
+def _check_candidate(password: bytes, first_page: bytes):
+    """
+    进程池里执行：子进程的缓存用不上，把派生结果带回主进程缓存
+    """
+    keys = _derive(password, first_page[:SALT_SIZE])
+    return keys if _hmac_ok(keys[1], first_page) else None
+
+
+def find_key(candidates, first_page: bytes, workers=None) -> Optional[bytes]:
+    """
+    按顺序校验一批候选密钥，返回第一个正确的
+    候选密钥多时分批交给进程池并行派生，找到后不再提交后面的批次
+    :param candidates: 候选主密钥（bytes），重复的只校验一次
+    :param first_page: 数据库第一页，见read_first_page
+    :param workers: 进程数，默认CPU核数；1表示在当前进程校验
+    :return: 正确的密钥，都不对时返回None
+    """
+    if len(first_page) < SALT_SIZE + 48:
+        return None
+    salt = first_page[:SALT_SIZE]
+    candidates = list(dict.fromkeys(password for password in candidates if password))
+    with _cache_lock:
+        cached = [(password, _cache.get((password, salt))) for password in candidates]
+    for password, keys in cached:
+        if keys is not None and _hmac_ok(keys[1], first_page):
+            return password
+    candidates = [password for password, keys in cached if keys is None]
+
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(candidates) >= PARALLEL_MIN_CANDIDATES:
+        batch_size = workers * 4
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for start in range(0, len(candidates), batch_size):
+                    batch = candidates[start:start + batch_size]
+                    for password, keys in zip(batch, executor.map(_check_candidate, batch, repeat(first_page))):
+                        if keys is not None:
+                            with _cache_lock:
+                                _cache[(password, salt)] = keys
+                            return password
+            return None
+        except BrokenProcessPool:
+            pass
+    for password in candidates:
+        if check_key(password, first_page):
+            return password
+    return None
+
+
+def benchmark(candidate_num=32, workers=None):
+    """
+    用decrypt.encrypt生成一个加密数据库，比较逐个校验、并行校验、命中缓存三种情况的耗时，
+    以及同一个文件第二次解密时省掉的派生时间
+    :param candidate_num: 候选密钥个数，正确的密钥放在最后
+    :param workers: 并行校验的进程数
+    :return: {名称: 秒}
+    """
+    import tempfile
+    import time
+    from app.decrypt.decrypt import encrypt, decrypt
+
+    key = os.urandom(KEY_SIZE)
+    candidates = [os.urandom(KEY_SIZE) for _ in range(candidate_num - 1)] + [key]
+    res = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        plain_path = os.path.join(tmp_dir, 'plain.db')
+        enc_path = os.path.join(tmp_dir, 'enc.db')
+        out_path = os.path.join(tmp_dir, 'out.db')
+        with open(plain_path, 'wb') as file:
+            file.write(os.urandom(DEFAULT_PAGESIZE * 16))
+        encrypt(key.hex(), plain_path, enc_path)
+        first_page = read_first_page(enc_path)
+
+        clear_cache()
+        start = time.time()
+        assert find_key(candidates, first_page, workers=1) == key
+        res['sequential'] = time.time() - start
+
+        clear_cache()
+        start = time.time()
+        assert find_key(candidates, first_page, workers=workers) == key
+        res['parallel'] = time.time() - start
+
+        start = time.time()
+        assert find_key(candidates, first_page, workers=workers) == key
+        res['cached'] = time.time() - start
+
+        clear_cache()
+        start = time.time()
+        decrypt(key.hex(), enc_path, out_path, workers=1, incremental=False)
+        res['decrypt'] = time.time() - start
+        start = time.time()
+        decrypt(key.hex(), enc_path, out_path, workers=1, incremental=False)
+        res['decrypt_cached'] = time.time() - start
+    return res
+
+
+if __name__ == '__main__':
+    for name, seconds in benchmark().items():
+        print(f'{name}: {seconds:.3f}s')
@@ -1,14 +1,21 @@
 """
 定义各种联系人
 """
+import hashlib
 import json
 import os.path
 import re
 from typing import Dict
-from PyQt5.QtGui import QPixmap
 
 from app.config import INFO_FILE_PATH
-from app.ui.Icon import Icon
+
+try:
+    from PyQt5.QtGui import QGuiApplication, QPixmap
+except ImportError:
+    # 命令行、服务器上没有Qt，头像只保留原始数据
+    QGuiApplication = QPixmap = None
+
+DEFAULT_AVATAR_PATH = ':/icons/icons/default_avatar.svg'
 
 
 def singleton(cls):
@@ -19,28 +26,54 @@ def singleton(cls):
             _instance[cls] = cls()
         return _instance[cls]
 
+    # pickle按名字找到的是inner，见Me.__reduce__
+    inner.__module__ = cls.__module__
+    inner.__qualname__ = cls.__qualname__
     return inner
 
 
+def qt_available() -> bool:
+    """
+    当前进程能不能用QPixmap（装了PyQt5并且已经创建了QApplication）
+    """
+    return QGuiApplication is not None and isinstance(QGuiApplication.instance(), QGuiApplication)
+
+
 class Person:
+    """
+    头像保存为原始数据avatar_bytes，QPixmap在界面第一次用到avatar时才创建
+    这样Person不依赖Qt，可以在命令行里使用，也可以pickle到导出进程里
+    """
+
     def __init__(self):
         self.avatar_path = None
-        self.avatar = None
-        self.avatar_path_qt = Icon.Default_avatar_path
+        self.avatar_bytes = b''
+        self._avatar = None
+        self.avatar_path_qt = DEFAULT_AVATAR_PATH
         self.detail = {}
 
+    @property
+    def avatar(self):
+        if self._avatar is None and QPixmap is not None:
+            self._avatar = QPixmap()
+            if not self.avatar_bytes:
+                self._avatar.load(DEFAULT_AVATAR_PATH)
+            elif self.avatar_bytes[:4] == b'\x89PNG':
+                self._avatar.loadFromData(self.avatar_bytes, format='PNG')
+            else:
+                self._avatar.loadFromData(self.avatar_bytes, format='jfif')
+        return self._avatar
+
     def set_avatar(self, img_bytes):
-        if not img_bytes:
-            self.avatar.load(Icon.Default_avatar_path)
-            return
-        if img_bytes[:4] == b'\x89PNG':
-            self.avatar.loadFromData(img_bytes, format='PNG')
-        else:
-            self.avatar.loadFromData(img_bytes, format='jfif')
+        self.avatar_bytes = img_bytes or b''
+        self._avatar = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_avatar'] = None
+        return state
 
     def save_avatar(self, path=None):
-        if not self.avatar:
-            return
         if path:
             save_path = path
             if os.path.exists(save_path):
@@ -49,18 +82,34 @@ class Person:
         else:
             os.makedirs('./data/avatar', exist_ok=True)
             save_path = os.path.join(f'data/avatar/', self.wxid + '.png')
-        self.avatar_path = save_path
         if not os.path.exists(save_path):
-            self.avatar.save(save_path)
+            if qt_available():
+                # 界面里统一转成PNG
+                write = self.avatar.save
+            elif self.avatar_bytes:
+                def write(path):
+                    with open(path, 'wb') as f:
+                        f.write(self.avatar_bytes)
+            else:
+                # 没有Qt画不出默认头像
+                return
+            if self.avatar_bytes:
+                # 同一个头像在各个导出文件夹里共用一份
+                from app.util import media_store
+                key = f'avatar:{qt_available()}:{hashlib.md5(self.avatar_bytes).hexdigest()}'
+                media_store.fetch(key, save_path, write)
+            else:
+                write(save_path)
             print('保存头像', save_path)
+        self.avatar_path = save_path
+        return save_path
 
 
 @singleton
 class Me(Person):
     def __init__(self):
         super().__init__()
-        self.avatar = QPixmap(Icon.Default_avatar_path)
-        self.avatar_path = ':/icons/icons/default_avatar.svg'
+        self.avatar_path = DEFAULT_AVATAR_PATH
         self.wxid = 'wxid_00112233'
         self.wx_dir = ''
         self.name = ''
@@ -70,6 +119,10 @@ class Me(Person):
         self.remark = self.nickName
         self.token = ''
 
+    def __reduce__(self):
+        # Me是单例，在导出进程里还原成那个进程的Me()
+        return Me, (), self.__getstate__()
+
     def save_info(self):
         if os.path.exists(INFO_FILE_PATH):
             with open(INFO_FILE_PATH, 'r', encoding='utf-8') as f:
@@ -92,8 +145,7 @@ class Contact(Person):
         self.remark = re.sub(r'[\\/:*?"<>|\s\.]', '_', self.remark)
         self.smallHeadImgUrl = contact_info.get('smallHeadImgUrl')
         self.smallHeadImgBLOG = b''
-        self.avatar = QPixmap()
-        self.avatar_path = Icon.Default_avatar_path
+        self.avatar_path = DEFAULT_AVATAR_PATH
         self.is_chatroom = self.wxid.__contains__('@chatroom')
         self.detail: Dict = contact_info.get('detail')
         self.label_name = contact_info.get('label_name')  # 联系人的标签分类
@@ -112,8 +164,7 @@ class Contact(Person):
 class ContactDefault(Person):
     def __init__(self, wxid=""):
         super().__init__()
-        self.avatar = QPixmap(Icon.Default_avatar_path)
-        self.avatar_path = ':/icons/icons/default_avatar.svg'
+        self.avatar_path = DEFAULT_AVATAR_PATH
         self.wxid = wxid
         self.remark = wxid
         self.alias = wxid
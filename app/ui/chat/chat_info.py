@@ -1,9 +1,11 @@
 import traceback
+from concurrent.futures import CancelledError
 
 from PyQt5.QtCore import QThread, pyqtSignal
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QLabel, QHBoxLayout
 
 from app.DataBase import msg_db, hard_link_db
+from app.DataBase.msg_pager import MessagePager
 from app.components.bubble_message import BubbleMessage, ChatWidget, Notice
 from app.person import Me
 from app.util import get_abs_path
@@ -41,6 +43,9 @@ class ChatInfo(QWidget):
         self.show_chat_thread = ShowChatThread(self.contact)
         self.show_chat_thread.showSingal.connect(self.add_message)
         self.show_chat_thread.finishSingal.connect(self.show_finish)
+        # 界面销毁时关掉翻页的预取线程
+        pager = self.show_chat_thread.pager
+        self.destroyed.connect(lambda *args: pager.close())
         # self.show_chat_thread.start()
 
     def show_finish(self, ok):
@@ -56,6 +61,9 @@ class ChatInfo(QWidget):
         # print(pos)
         if pos > 0:
             return
+        if self.show_chat_thread.isRunning():
+            # 上一页还在加载
+            return
 
         # 记录当前滚动条最大值
         self.last_pos = self.chat_window.verticalScrollBar().maximum()
@@ -175,13 +183,19 @@ class ShowChatThread(QThread):
     # heightSingal = pyqtSignal(int)
     def __init__(self, contact):
         super().__init__()
-        self.last_message_id = 9999999999
         self.wxid = contact.wxid
+        # 按(CreateTime, localId)往前翻页，后台预取下一页
+        self.pager = MessagePager(msg_db, self.wxid, types=[1, 3])
 
     def run(self) -> None:
-        messages = msg_db.get_message_by_num(self.wxid, self.last_message_id)
-        if messages:
-            self.last_message_id = messages[-1][0]
+        try:
+            messages = self.pager.next_page()
+        except CancelledError:
+            # 翻页时界面被关掉了
+            return
+        if self.pager.finished:
+            # 没有更早的消息了，不用再留着预取线程
+            self.pager.close()
         for message in messages:
             self.showSingal.emit(message)
         self.msg_id += 1
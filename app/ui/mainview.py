@@ -20,7 +20,7 @@ from PyQt5.QtCore import pyqtSignal, QThread, QSize, QUrl, Qt
 from PyQt5.QtGui import QPixmap, QIcon, QDesktopServices
 from PyQt5.QtWidgets import QMainWindow, QLabel, QMessageBox, QPushButton
 
-from app.DataBase import misc_db, micro_msg_db, close_db
+from app.DataBase import misc_db, micro_msg_db, msg_db, close_db, init_encrypted_db
 from app.ui.Icon import Icon
 from . import mainwindow
 # 不能删，删了会出错
@@ -30,6 +30,7 @@ from app.ui.tool.tool_window import ToolWindow
 from app.ui.home.home_window import HomeWindow
 from .menu.export import ExportDialog
 from app.util.exporter.output import Output
+from app.util import secret
 from ..components.QCursorGif import QCursorGif
 from ..config import INFO_FILE_PATH, DB_DIR, SERVER_API_URL, version
 from ..log import logger
@@ -314,6 +315,13 @@ class MainWinController(QMainWindow, mainwindow.Ui_MainWindow, QCursorGif):
             with open(INFO_FILE_PATH, 'r', encoding='utf-8') as f:
                 dic = json.loads(f.read())
                 wxid = dic.get('wxid')
+                if dic.get('read_encrypted') and dic.get('protected_key') and dic.get('wx_dir'):
+                    # 上次选择了直接读取加密数据库，密钥是DPAPI加密保存的
+                    key = secret.unprotect(dic['protected_key'])
+                    if not key or not init_encrypted_db(key, os.path.join(dic['wx_dir'], 'Msg')):
+                        self.statusbar.showMessage('直接读取加密数据库失败，请重新获取信息', 5000)
+                # 索引、汇总表、全文索引只在界面进程里后台更新
+                msg_db.start_maintenance()
                 if wxid:
                     me = Me()
                     me.wxid = dic.get('wxid')
@@ -165,7 +165,7 @@ class ExportDialog(QDialog, Ui_Dialog):
         print("选择的文件格式:", file_types)
         self.worker = Output(select_contacts, type_=Output.Batch, message_types=selected_types, sub_type=file_types,
                              time_range=self.time_range)
-        # self.worker.progressSignal.connect(self.update_progress)
+        self.worker.progressSignal.connect(self.progressBar.setValue)
         self.worker.okSignal.connect(self.export_finished)
         self.worker.rangeSignal.connect(self.set_total_msg_num)
         self.worker.nowContact.connect(self.update_progress)
@@ -241,9 +241,7 @@ class ExportDialog(QDialog, Ui_Dialog):
 
     def update_progress(self, remark):
         self.num += 1
-        progress_percentage = int((self.num) / self.total_msg_num * 100)
-        self.progressBar.setValue(progress_percentage)
-        self.label_process.setText(f"导出进度: {progress_percentage}% {remark}")
+        self.label_process.setText(f"导出进度: {self.num}/{self.total_msg_num} {remark}")
 
 
 class ShowContactThread(QThread):
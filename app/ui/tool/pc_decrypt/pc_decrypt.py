@@ -1,3 +1,4 @@
+import importlib.util
 import json
 import os.path
 import sys
@@ -9,17 +10,20 @@ from PyQt5.QtCore import pyqtSignal, QThread, QUrl
 from PyQt5.QtGui import QDesktopServices
 from PyQt5.QtWidgets import QWidget, QMessageBox, QFileDialog
 
-from app.DataBase import msg_db, misc_db, close_db
-from app.DataBase.merge import merge_databases, merge_MediaMSG_databases
+from app.DataBase import msg_db, misc_db, close_db, init_encrypted_db
+from app.DataBase.pool import set_encrypted_sources
 from app.components.QCursorGif import QCursorGif
 from app.config import INFO_FILE_PATH, DB_DIR, SERVER_API_URL
-from app.decrypt import get_wx_info, decrypt
+from app.decrypt import get_wx_info
+from app.decrypt.ingest import collect_decrypt_tasks, ingest
 from app.log import logger
-from app.util import path
+from app.util import path, secret
 from . import decryptUi
 from ...Icon import Icon
 from ...menu.about_dialog import Decrypt
 
+PROGRESS_MAX = 1000
+
 
 class DecryptControl(QWidget, decryptUi.Ui_Dialog, QCursorGif):
     DecryptSignal = pyqtSignal(bool)
@@ -155,6 +159,9 @@ class DecryptControl(QWidget, decryptUi.Ui_Dialog, QCursorGif):
         if self.info.get('key') == 'None':
             QMessageBox.critical(self, "错误",
                                  "密钥错误\n请查看教程解决相关问题")
+        if importlib.util.find_spec('apsw') and self.ask_read_encrypted():
+            self.read_encrypted(db_dir)
+            return
         close_db()
         self.thread2 = DecryptThread(db_dir, self.info['key'])
         self.thread2.maxNumSignal.connect(self.setProgressBarMaxNum)
@@ -166,6 +173,32 @@ class DecryptControl(QWidget, decryptUi.Ui_Dialog, QCursorGif):
         )
         self.thread2.start()
 
+    def ask_read_encrypted(self) -> bool:
+        """
+        安装了apsw时可以不解密，直接只读打开微信的加密数据库
+        @return: 是否直接读取
+        """
+        box = QMessageBox(self)
+        box.setIcon(QMessageBox.Question)
+        box.setWindowTitle('解密方式')
+        box.setText('解密：生成解密后的数据库副本，查询最快\n'
+                    '直接读取：不生成副本，只读打开微信的加密数据库，每次启动都读取最新的聊天记录')
+        btn_decrypt = box.addButton('解密', QMessageBox.AcceptRole)
+        btn_direct = box.addButton('直接读取', QMessageBox.ActionRole)
+        box.setDefaultButton(btn_decrypt)
+        box.exec_()
+        return box.clickedButton() == btn_direct
+
+    def read_encrypted(self, db_dir):
+        if not init_encrypted_db(self.info['key'], db_dir):
+            QMessageBox.critical(self, "错误", "直接读取加密数据库失败\n请检查密钥是否正确，或者选择解密")
+            return
+        if not self.save_info(read_encrypted=True):
+            QMessageBox.warning(self, "提示", "无法安全保存密钥\n下次启动后需要重新获取信息并选择直接读取")
+        self.progressBar_view(self.max_val)
+        self.DecryptSignal.emit(True)
+        self.close()
+
     def btnEnterClicked(self):
         # print("enter clicked")
         # 中间可以添加处理逻辑
@@ -188,8 +221,12 @@ class DecryptControl(QWidget, decryptUi.Ui_Dialog, QCursorGif):
         #     self.btnExitClicked()
         #     data.init_database()
 
-    def btnExitClicked(self):
-        # print("Exit clicked")
+    def save_info(self, read_encrypted=False):
+        """
+        保存个人信息，直接读取加密数据库时还要保存密钥，下次启动时用它打开数据库
+        密钥只用DPAPI加密后保存（见app.util.secret），不能加密时不保存，下次启动要重新获取
+        @return: 是否保存了密钥
+        """
         dic = {
             'wxid': self.info['wxid'],
             'wx_dir': self.wx_dir,
@@ -197,12 +234,21 @@ class DecryptControl(QWidget, decryptUi.Ui_Dialog, QCursorGif):
             'mobile': self.info['mobile'],
             'token': Decrypt.decrypt(self.info['wxid'])
         }
+        protected_key = secret.protect(self.info['key']) if read_encrypted else None
+        if protected_key:
+            dic['read_encrypted'] = True
+            dic['protected_key'] = protected_key
         try:
             with open(INFO_FILE_PATH, "w", encoding="utf-8") as f:
                 json.dump(dic, f, ensure_ascii=False, indent=4)
         except:
             with open('./info.json', 'w', encoding='utf-8') as f:
                 f.write(json.dumps(dic))
+        return protected_key is not None
+
+    def btnExitClicked(self):
+        # print("Exit clicked")
+        self.save_info()
         self.progressBar_view(self.max_val)
         self.DecryptSignal.emit(True)
         self.close()
@@ -225,56 +271,23 @@ class DecryptThread(QThread):
 
     def run(self):
         close_db()
+        set_encrypted_sources({})  # 解密后读明文数据库
         output_dir = DB_DIR
         os.makedirs(output_dir, exist_ok=True)
-        tasks = []
-        if os.path.exists(self.db_path):
-            for root, dirs, files in os.walk(self.db_path):
-                for file in files:
-                    if '.db' == file[-3:]:
-                        if 'xInfo.db' == file:
-                            continue
-                        inpath = os.path.join(root, file)
-                        # print(inpath)
-                        output_path = os.path.join(output_dir, file)
-                        tasks.append([self.key, inpath, output_path])
-                    else:
-                        try:
-                            name, suffix = file.split('.')
-                            if suffix.startswith('db_SQLITE'):
-                                inpath = os.path.join(root, file)
-                                # print(inpath)
-                                output_path = os.path.join(output_dir, name + '.db')
-                                tasks.append([self.key, inpath, output_path])
-                        except:
-                            continue
-        self.maxNumSignal.emit(len(tasks))
-        for i, task in enumerate(tasks):
-            if decrypt.decrypt(*task) == -1:
-                self.errorSignal.emit(True)
-            self.signal.emit(str(i))
-        # print(self.db_path)
-        # 目标数据库文件
-        target_database = os.path.join(DB_DIR, 'MSG.db')
-        # 源数据库文件列表
-        source_databases = [os.path.join(DB_DIR, f"MSG{i}.db") for i in range(1, 50)]
-        import shutil
-        if os.path.exists(target_database):
-            os.remove(target_database)
-        shutil.copy2(os.path.join(DB_DIR, 'MSG0.db'), target_database)  # 使用一个数据库文件作为模板
-        # 合并数据库
-        merge_databases(source_databases, target_database)
-
-        # 音频数据库文件
-        target_database = os.path.join(DB_DIR, 'MediaMSG.db')
-        # 源数据库文件列表
-        if os.path.exists(target_database):
-            os.remove(target_database)
-        source_databases = [os.path.join(DB_DIR, f"MediaMSG{i}.db") for i in range(1, 50)]
-        shutil.copy2(os.path.join(DB_DIR, 'MediaMSG0.db'), target_database)  # 使用一个数据库文件作为模板
-
-        # 合并数据库
-        merge_MediaMSG_databases(source_databases, target_database)
+        tasks = collect_decrypt_tasks(self.key, self.db_path, output_dir)
+        # 进度条按千分比显示
+        self.maxNumSignal.emit(PROGRESS_MAX)
+        # 解密和合并流水线执行，MSG分库解密完一个就合并一个
+        result = ingest(
+            tasks,
+            output_dir,
+            progress=lambda fraction, message: self.signal.emit(str(int(fraction * PROGRESS_MAX)))
+        )
+        failures = [ret for ok, ret in result['decrypt'] if not ok]
+        for ret in failures:
+            logger.error(f'解密失败:{ret}')
+        if tasks and len(failures) == len(tasks):
+            self.errorSignal.emit(True)
         self.okSignal.emit('ok')
         # self.signal.emit('100')
 
@@ -10,16 +10,15 @@ emoji.py
 
 import os
 import re
+import shutil
+import sys
 import traceback
 import xml.etree.ElementTree as ET
-import sqlite3
-import threading
-from PyQt5.QtGui import QPixmap
 import requests
 
+from app.DataBase.pool import ConnectionPool, database_exists
 from app.log import log, logger
 
-lock = threading.Lock()
 db_path = "./app/Database/Msg/Emotion.db"
 root_path = "./data/emoji/"
 if not os.path.exists("./data"):
@@ -93,20 +92,15 @@ def singleton(cls):
 @singleton
 class Emotion:
     def __init__(self):
-        self.DB = None
-        self.cursor: sqlite3.Cursor = None
+        self.pool: ConnectionPool = None
         self.open_flag = False
         self.init_database()
 
     def init_database(self):
         if not self.open_flag:
-            if os.path.exists(db_path):
-                self.DB = sqlite3.connect(db_path, check_same_thread=False)
-                # '''创建游标'''
-                self.cursor = self.DB.cursor()
+            if database_exists(db_path):
+                self.pool = ConnectionPool(db_path)
                 self.open_flag = True
-                if lock.locked():
-                    lock.release()
 
     def get_emoji_url(self, md5: str, thumb: bool) -> str | bytes:
         """供下载用，返回可能是url可能是bytes"""
@@ -126,22 +120,22 @@ class Emotion:
                 from CustomEmotion
                 where md5 = ?
             """
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [md5])
-            return self.cursor.fetchone()[0]
-        except:
-            md5 = md5.upper()
-            sql = f"""
-                select {"Thumb" if thumb else "Data"}
-                from EmotionItem
-                where md5 = ?
-            """
-            self.cursor.execute(sql, [md5])
-            res = self.cursor.fetchone()
-            return res[0] if res else ""
-        finally:
-            lock.release()
+        if not self.open_flag:
+            return ""
+        with self.pool.cursor() as cursor:
+            try:
+                cursor.execute(sql, [md5])
+                return cursor.fetchone()[0]
+            except:
+                md5 = md5.upper()
+                sql = f"""
+                    select {"Thumb" if thumb else "Data"}
+                    from EmotionItem
+                    where md5 = ?
+                """
+                cursor.execute(sql, [md5])
+                res = cursor.fetchone()
+                return res[0] if res else ""
 
     def get_emoji_URL(self, md5: str, thumb: bool):
         """只管url，另外的不管"""
@@ -161,23 +155,19 @@ class Emotion:
                 from CustomEmotion
                 where md5 = ?
             """
+        if not self.open_flag:
+            return ""
         try:
-            lock.acquire(True)
-            self.cursor.execute(sql, [md5])
-            return self.cursor.fetchone()[0]
+            with self.pool.cursor() as cursor:
+                cursor.execute(sql, [md5])
+                return cursor.fetchone()[0]
         except:
             return ""
-        finally:
-            lock.release()
 
     def close(self):
         if self.open_flag:
-            try:
-                lock.acquire(True)
-                self.open_flag = False
-                self.DB.close()
-            finally:
-                lock.release()
+            self.open_flag = False
+            self.pool.close()
 
     def __del__(self):
         self.close()
@@ -262,16 +252,24 @@ def get_emoji(xml_string, thumb=True, output_path=root_path) -> str:
             return output_path
         else:
             print("！！！未知表情包数据，信息：", xml_string, emoji_info, url)
-            output_path = os.path.join(output_path, "404.png")
-            if not os.path.exists(output_path):
-                QPixmap(":/icons/icons/404.png").save(output_path)
-            return output_path
+            return save_404(output_path)
     except:
         logger.error(traceback.format_exc())
-        output_path = os.path.join(output_path, "404.png")
-        if not os.path.exists(output_path):
-            QPixmap(":/icons/icons/404.png").save(output_path)
-        return output_path
+        return save_404(output_path)
+
+
+def save_404(output_path) -> str:
+    """
+    表情包找不到时放一张404图片，直接拷贝资源文件，不需要Qt
+    """
+    output_path = os.path.join(output_path, "404.png")
+    if not os.path.exists(output_path):
+        icon = os.path.join("app", "resources", "icons", "404.png")
+        if not os.path.exists(icon):
+            # 打包后的资源目录
+            icon = os.path.join(getattr(sys, "_MEIPASS", "."), "app", "resources", "icons", "404.png")
+        shutil.copy(icon, output_path)
+    return output_path
 
 
 def get_emoji_path(xml_string, thumb=True, output_path=root_path) -> str:
@@ -0,0 +1,58 @@
+"""
+导出一个联系人的一种或多种格式，不依赖Qt
+批量导出（线程池或进程池）和命令行都调用export_contact，界面的单个导出见output.Output
+"""
+from app.util.exporter.exporter import ExporterBase, export_stream
+from app.util.exporter.exporter_ai_txt import AiTxtExporter
+from app.util.exporter.exporter_csv import CSVExporter
+from app.util.exporter.exporter_docx import DocxExporter, DocxMerger
+from app.util.exporter.exporter_html import EmojiExporter, HtmlExporter, ImageExporter, MediaExporter
+from app.util.exporter.exporter_json import JsonExporter
+from app.util.exporter.exporter_txt import TxtExporter
+
+EXPORTERS = {
+    ExporterBase.DOCX: DocxExporter,
+    ExporterBase.TXT: TxtExporter,
+    ExporterBase.AI_TXT: AiTxtExporter,
+    ExporterBase.CSV: CSVExporter,
+    ExporterBase.HTML: HtmlExporter,
+    ExporterBase.JSON: JsonExporter,
+}
+# CPU密集的格式，批量导出时放到进程池里
+CPU_BOUND_TYPES = (ExporterBase.DOCX, ExporterBase.HTML)
+
+
+def export_contact(contact, types, message_types, time_range=None, me=None, on_progress=None) -> str:
+    """
+    导出一个联系人的一种或多种格式，所有格式共用一次消息查询（见exporter.export_stream）
+    DOCX会把分块文件合并，HTML会一起导出语音和图片
+    参数都能pickle，可以直接提交到进程池
+    @param contact: 联系人
+    @param types: 导出格式或格式列表，见EXPORTERS
+    @param message_types: 导出的消息类型
+    @param time_range: 时间范围
+    @param me: 自己的信息，默认Me()
+    @param on_progress: 进度回调，见ExporterBase
+    @return: 导出文件夹
+    @raise RuntimeError: 有格式导出出错，其他格式仍然导出完成
+    """
+    if isinstance(types, int):
+        types = [types]
+    kwargs = dict(message_types=message_types, time_range=time_range, me=me, on_progress=on_progress)
+    exporters = [EXPORTERS[type_](contact, type_=type_, **kwargs) for type_ in types]
+    if ExporterBase.HTML in types:
+        if message_types.get(34):
+            exporters.append(MediaExporter(contact, **kwargs))
+        if message_types.get(47):
+            exporters.append(EmojiExporter(contact, **kwargs))
+        if message_types.get(3):
+            exporters.append(ImageExporter(contact, **kwargs))
+    export_stream(exporters)
+    if ExporterBase.DOCX in types and not exporters[types.index(ExporterBase.DOCX)].error:
+        merger = DocxMerger(contact)
+        merger.append_all()
+        merger.save()
+    errors = [exporter.error for exporter in exporters if exporter.error]
+    if errors:
+        raise RuntimeError('\n'.join(errors))
+    return exporters[0].origin_path
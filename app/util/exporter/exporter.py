@@ -1,17 +1,21 @@
 import csv
 import html
 import os
-import shutil
 import sys
-
-import filecmp
-
-from PyQt5.QtCore import pyqtSignal, QThread
+import traceback
 
 from app.config import OUTPUT_DIR
+from app.DataBase import msg_db
+from app.DataBase.msg import BLOBS_ALL, BLOBS_BY_TYPE, BLOBS_NONE
+from app.log import logger
 from app.person import Me, Contact
+from app.util import media_store
+
+# 多个导出器共用一次查询时，BLOB字段按要求最多的那个读
+BLOBS_RANK = {BLOBS_NONE: 0, BLOBS_BY_TYPE: 1, BLOBS_ALL: 2}
 
 os.makedirs(os.path.join(OUTPUT_DIR, '聊天记录'), exist_ok=True)
+_synced_icon_folders = set()  # 本进程里已经拷贝过图标的文件夹
 
 
 def set_global_font(doc, font_name):
@@ -43,22 +47,18 @@ def makedirs(path):
         # 构建 FFmpeg 可执行文件的路径
         resource_dir = os.path.join(resource_dir, 'app', 'resources', 'data', 'icons')
     target_folder = os.path.join(path, 'icon')
-    # 拷贝一些必备的图标
+    if target_folder in _synced_icon_folders:
+        return
+    # 拷贝一些必备的图标，图标从媒体库硬链接过来，已经一致的不再比较内容
     for root, dirs, files in os.walk(resource_dir):
         relative_path = os.path.relpath(root, resource_dir)
         target_path = os.path.join(target_folder, relative_path)
+        os.makedirs(target_path, exist_ok=True)
 
         # 遍历文件夹中的文件
         for file in files:
-            source_file_path = os.path.join(root, file)
-            target_file_path = os.path.join(target_path, file)
-            if not os.path.exists(target_file_path):
-                shutil.copy(source_file_path, target_file_path)
-            else:
-                # 比较文件内容
-                if not filecmp.cmp(source_file_path, target_file_path, shallow=False):
-                    # 文件内容不一致，进行覆盖拷贝
-                    shutil.copy(source_file_path, target_file_path)
+            media_store.sync(os.path.join(root, file), os.path.join(target_path, file))
+    _synced_icon_folders.add(target_folder)
 
 
 def escape_js_and_html(input_str):
@@ -81,10 +81,14 @@ def escape_js_and_html(input_str):
     return js_escaped
 
 
-class ExporterBase(QThread):
-    progressSignal = pyqtSignal(int)
-    rangeSignal = pyqtSignal(int)
-    okSignal = pyqtSignal(int)
+class ExporterBase:
+    """
+    导出器的核心，不依赖Qt，可以在命令行、服务器和进程池里直接调用export()
+    进度通过回调通知，界面里用output.QtExporter把回调转成Qt信号：
+    on_range(总数)、on_progress(进度，各导出器发的是增量或百分比)、on_ok(完成编号)
+    导出器按begin/write/end流式写入，export_stream可以让多个导出器共用一次数据库查询
+    """
+    blobs = BLOBS_BY_TYPE  # 需要读取的BLOB字段，见app.DataBase.msg.BLOBS_*
     i = 1
     CSV = 0
     DOCX = 1
@@ -92,11 +96,14 @@ class ExporterBase(QThread):
     CSV_ALL = 3
     CONTACT_CSV = 4
     TXT = 5
+    JSON = 6
+    AI_TXT = 7
 
-    def __init__(self, contact, type_=DOCX, message_types={}, time_range=None, messages=None,index=0, parent=None):
-        super().__init__(parent)
+    def __init__(self, contact, type_=DOCX, message_types={}, time_range=None, messages=None, index=0, me=None,
+                 on_progress=None, on_range=None, on_ok=None):
         self.message_types = message_types  # 导出的消息类型
         self.contact: Contact = contact  # 联系人
+        self.me = me or Me()  # 自己的信息，在导出进程里由主进程传过来
         self.output_type = type_  # 导出文件类型
         self.total_num = 1  # 总的消息数量
         self.num = 0  # 当前处理的消息数量
@@ -104,17 +111,75 @@ class ExporterBase(QThread):
         self.last_timestamp = 0
         self.time_range = time_range
         self.messages = messages
+        self.on_progress = on_progress
+        self.on_range = on_range
+        self.on_ok = on_ok
+        self.cancelled = False
+        self.error = None  # 导出出错时的异常信息，出错后export_stream不再给它分发消息
         self.origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
         makedirs(self.origin_path)
 
-    def run(self):
-        self.export()
+    def __getstate__(self):
+        # 回调留在原来的进程里
+        state = self.__dict__.copy()
+        state.update(on_progress=None, on_range=None, on_ok=None)
+        return state
+
+    def report_progress(self, value):
+        if self.on_progress:
+            self.on_progress(value)
+
+    def report_range(self, total):
+        if self.on_range:
+            self.on_range(total)
+
+    def report_ok(self, num):
+        if self.on_ok:
+            self.on_ok(num)
+
+    def stream_types(self):
+        """
+        需要的消息Type，export_stream按它给各导出器分发消息
+        @return: Type列表，None表示全部
+        """
+        return self.query_types()
+
+    def begin(self, total):
+        """
+        开始导出，打开输出文件
+        @param total: 消息总数
+        """
+        self.report_range(total)
+
+    def write(self, message):
+        raise NotImplementedError("write method must be implemented in subclasses")
+
+    def end(self):
+        """
+        写完所有消息，关闭输出文件
+        """
+        self.report_ok(1)
 
     def export(self):
-        raise NotImplementedError("export method must be implemented in subclasses")
+        export_stream([self])
 
     def cancel(self):
-        self.requestInterruption()
+        self.cancelled = True
+
+    def query_types(self):
+        """
+        把界面上勾选的消息类型转换成MSG表里的Type，用于在数据库里提前过滤
+        4903、4905、4906、492000这类是Type=49的子类型，文本里的引用消息也是Type=49
+        @return: Type列表，没有勾选任何类型返回None表示不过滤
+        """
+        types = set()
+        for type_, checked in self.message_types.items():
+            if not checked:
+                continue
+            types.add(49 if type_ > 10000 else type_)
+            if type_ == 1:
+                types.add(49)
+        return sorted(types) or None
 
     def is_5_min(self, timestamp) -> bool:
         if abs(timestamp - self.last_timestamp) > 300:
@@ -127,22 +192,22 @@ class ExporterBase(QThread):
             if self.contact.is_chatroom:
                 avatar = message[13].avatar_path
             else:
-                avatar = Me().avatar_path if is_send else self.contact.avatar_path
+                avatar = self.me.avatar_path if is_send else self.contact.avatar_path
         else:
             if self.contact.is_chatroom:
                 avatar = message[13].smallHeadImgUrl
             else:
-                avatar = Me().smallHeadImgUrl if is_send else self.contact.smallHeadImgUrl
+                avatar = self.me.smallHeadImgUrl if is_send else self.contact.smallHeadImgUrl
         return avatar
 
     def get_display_name(self, is_send, message) -> str:
         if self.contact.is_chatroom:
             if is_send:
-                display_name = Me().name
+                display_name = self.me.name
             else:
                 display_name = message[13].remark
         else:
-            display_name = Me().name if is_send else self.contact.remark
+            display_name = self.me.name if is_send else self.contact.remark
         return escape_js_and_html(display_name)
 
     def text(self, doc, message):
@@ -174,3 +239,52 @@ class ExporterBase(QThread):
 
     def share_card(self, doc, message):
         return
+
+
+def _run_step(exporter, func, *args):
+    """
+    执行一个导出器的begin/write/end，出错只记录到这个导出器上，不影响共用查询的其他导出器
+    """
+    try:
+        func(*args)
+    except Exception:
+        error = traceback.format_exc()
+        exporter.error = exporter.error or error
+        logger.error(f'导出出错 {exporter.contact.remark} {type(exporter).__name__}:\n{error}')
+
+
+def export_stream(exporters):
+    """
+    同一个联系人的多个导出器共用一次查询：消息只读取一遍、群聊发送人只解析一遍，按各导出器的stream_types分发
+    某个导出器出错后不再给它分发消息（见ExporterBase.error），其他导出器照常导出；
+    不管是否出错，最后都会调用每个导出器的end()，关闭输出文件、发出on_ok
+    @param exporters: 同一个联系人、同一时间范围的导出器
+    """
+    contact = exporters[0].contact
+    time_range = exporters[0].time_range
+    filters = [exporter.stream_types() for exporter in exporters]
+    if any(types is None for types in filters):
+        types = None
+    else:
+        types = sorted(set().union(*filters))
+    blobs = max((exporter.blobs for exporter in exporters), key=BLOBS_RANK.get)
+    filters = [None if wanted is None else frozenset(wanted) for wanted in filters]
+    try:
+        # 各导出器的消息数分别统计（走汇总表，不扫描消息），相同的过滤条件只统计一次
+        totals = {}
+        for exporter, wanted in zip(exporters, filters):
+            if wanted not in totals:
+                totals[wanted] = msg_db.get_messages_number(
+                    contact.wxid, time_range=time_range, types=None if wanted is None else sorted(wanted)
+                )
+            _run_step(exporter, exporter.begin, totals[wanted])
+        for message in msg_db.iter_messages(contact.wxid, time_range=time_range, types=types, blobs=blobs):
+            type_ = message[2]
+            for exporter, wanted in zip(exporters, filters):
+                if not (exporter.cancelled or exporter.error) and (wanted is None or type_ in wanted):
+                    _run_step(exporter, exporter.write, message)
+            if all(exporter.cancelled or exporter.error for exporter in exporters):
+                break
+    finally:
+        for exporter in exporters:
+            _run_step(exporter, exporter.end)
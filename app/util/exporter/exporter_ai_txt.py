@@ -1,7 +1,7 @@
 import os
 import re
 
-from app.DataBase import msg_db
+from app.DataBase.msg import BLOBS_NONE
 from app.util.compress_content import parser_reply, share_card
 from app.util.exporter.exporter import ExporterBase
 
@@ -23,6 +23,7 @@ def remove_privacy_info(text):
 
 
 class AiTxtExporter(ExporterBase):
+    blobs = BLOBS_NONE
     last_is_send = -1
 
     def title(self, message):
@@ -75,22 +76,30 @@ class AiTxtExporter(ExporterBase):
             f'''{self.title(message)}[视频]'''
         )
 
-    def export(self):
-        # 实现导出为txt的逻辑
+    def stream_types(self):
+        return [1]
+
+    def begin(self, total):
         print(f"【开始导出 TXT {self.contact.remark}】")
-        origin_path = self.origin_path
-        os.makedirs(origin_path, exist_ok=True)
-        filename = os.path.join(origin_path, self.contact.remark + '_chat.txt')
-        messages = msg_db.get_messages_group_by_day(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
-        with open(filename, mode='w', newline='', encoding='utf-8') as f:
-            for date, messages in messages.items():
-                f.write(f"\n\n{'*' * 20}{date}{'*' * 20}\n")
-                for index, message in enumerate(messages):
-                    type_ = message[2]
-                    sub_type = message[3]
-                    self.progressSignal.emit(int((index + 1) / total_steps * 100))
-                    if type_ == 1 and self.message_types.get(type_):
-                        self.text(f, message)
+        super().begin(total)
+        self.total_num = max(total, 1)
+        self.date = None
+        os.makedirs(self.origin_path, exist_ok=True)
+        filename = os.path.join(self.origin_path, self.contact.remark + '_chat.txt')
+        self.output_file = open(filename, mode='w', newline='', encoding='utf-8')
+
+    def write(self, message):
+        f = self.output_file
+        date = message[8][:10]  # 按天分段
+        if date != self.date:
+            self.date = date
+            f.write(f"\n\n{'*' * 20}{date}{'*' * 20}\n")
+        self.num += 1
+        self.report_progress(int(self.num / self.total_num * 100))
+        if message[2] == 1 and self.message_types.get(1):
+            self.text(f, message)
+
+    def end(self):
+        self.output_file.close()
         print(f"【完成导出 TXT {self.contact.remark}】")
-        self.okSignal.emit(1)
+        super().end()
@@ -1,40 +1,42 @@
 import csv
 import os
 
-from app.DataBase import msg_db
-from app.person import Me
+from app.DataBase.msg import BLOBS_NONE
 from app.util.exporter.exporter import ExporterBase
-from app.config import OUTPUT_DIR
 
 
 class CSVExporter(ExporterBase):
-    def to_csv(self):
+    blobs = BLOBS_NONE
+    columns = ['localId', 'TalkerId', 'Type', 'SubType',
+               'IsSender', 'CreateTime', 'Status', 'StrContent',
+               'StrTime', 'Remark', 'NickName', 'Sender']
+
+    def stream_types(self):
+        # CSV导出全部消息，不看勾选的类型
+        return None
+
+    def begin(self, total):
         print(f"【开始导出 CSV {self.contact.remark}】")
-        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        os.makedirs(origin_path, exist_ok=True)
-        filename = os.path.join(origin_path,f"{self.contact.remark}_utf8.csv")
-        columns = ['localId', 'TalkerId', 'Type', 'SubType',
-                   'IsSender', 'CreateTime', 'Status', 'StrContent',
-                   'StrTime', 'Remark', 'NickName', 'Sender']
-        messages = msg_db.get_messages(self.contact.wxid, time_range=self.time_range)
-        # 写入CSV文件
-        with open(filename, mode='w', newline='', encoding='utf-8-sig') as file:
-            writer = csv.writer(file)
-            writer.writerow(columns)
-            # 写入数据
-            # writer.writerows(messages)
-            for msg in messages:
-                if self.contact.is_chatroom:
-                    other_data = [msg[13].remark, msg[13].nickName, msg[13].wxid]
-                else:
-                    is_send = msg[4]
-                    Remark = Me().remark if is_send else self.contact.remark
-                    nickname = Me().nickName if is_send else self.contact.nickName
-                    wxid = Me().wxid if is_send else self.contact.wxid
-                    other_data = [Remark,nickname,wxid]
-                writer.writerow([*msg[:9], *other_data])
-        print(f"【完成导出 CSV {self.contact.remark}】")
-        self.okSignal.emit(1)
+        super().begin(total)
+        os.makedirs(self.origin_path, exist_ok=True)
+        filename = os.path.join(self.origin_path, f"{self.contact.remark}_utf8.csv")
+        self.output_file = open(filename, mode='w', newline='', encoding='utf-8-sig')
+        self.writer = csv.writer(self.output_file)
+        self.writer.writerow(self.columns)
 
-    def run(self):
-        self.to_csv()
+    def write(self, msg):
+        if self.contact.is_chatroom:
+            other_data = [msg[13].remark, msg[13].nickName, msg[13].wxid]
+        else:
+            is_send = msg[4]
+            Remark = self.me.remark if is_send else self.contact.remark
+            nickname = self.me.nickName if is_send else self.contact.nickName
+            wxid = self.me.wxid if is_send else self.contact.wxid
+            other_data = [Remark, nickname, wxid]
+        self.writer.writerow([*msg[:9], *other_data])
+        self.report_progress(1)
+
+    def end(self):
+        self.output_file.close()
+        print(f"【完成导出 CSV {self.contact.remark}】")
+        super().end()
@@ -1,5 +1,4 @@
 import os
-import shutil
 import time
 from re import findall
 
@@ -10,11 +9,12 @@ from docx.enum.text import WD_COLOR_INDEX, WD_PARAGRAPH_ALIGNMENT
 from docx.oxml.ns import qn
 from docxcompose.composer import Composer
 
-from app.DataBase import msg_db, hard_link_db
+from app.DataBase import hard_link_db
+from app.DataBase.msg import BLOBS_ALL
 from app.util.exporter.exporter import ExporterBase, escape_js_and_html
 from app.config import OUTPUT_DIR
 from app.log import logger
-from app.person import Me
+from app.util import media_store
 from app.util.compress_content import parser_reply, share_card, music_share
 from app.util.image import get_image_abs_path
 from app.util.music import get_music_path
@@ -39,7 +39,59 @@ def filter_control_characters(input_string):
     return filtered_string
 
 
+def new_docx_composer() -> Composer:
+    doc = docx.Document()
+    doc.styles["Normal"].font.name = "Cambria"
+    doc.styles["Normal"]._element.rPr.rFonts.set(qn("w:eastAsia"), "宋体")
+    return Composer(doc)
+
+
+class DocxMerger:
+    """
+    按顺序合并DocxExporter分块保存的{remark}_{n}.docx，每50块另存一个文件
+    """
+
+    def __init__(self, contact):
+        self.contact = contact
+        self.origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', contact.remark)
+        self.document = new_docx_composer()
+
+    def _save(self, file):
+        try:
+            self.document.save(file)
+        except PermissionError:
+            file = file[:-5] + f'{time.time()}' + '.docx'
+            self.document.save(file)
+
+    def append(self, n) -> bool:
+        """
+        @param n: 分块编号
+        @return: 分块文件不存在时返回False
+        """
+        conRemark = self.contact.remark
+        filename = os.path.join(self.origin_path, f"{conRemark}_{n}.docx")
+        if not os.path.exists(filename):
+            return False
+        doc = docx.Document(filename)
+        self.document.append(doc)
+        os.remove(filename)
+        if n % 50 == 0:
+            self._save(os.path.join(self.origin_path, f'{conRemark}-{n // 50}.docx'))
+            self.document = new_docx_composer()
+        return True
+
+    def append_all(self):
+        n = 1
+        while self.append(n):
+            n += 1
+
+    def save(self):
+        self._save(os.path.join(self.origin_path, f'{self.contact.remark}.docx'))
+
+
 class DocxExporter(ExporterBase):
+    blobs = BLOBS_ALL
+
     def text(self, doc, message):
         type_ = message[2]
         str_content = message[7]
@@ -77,9 +129,9 @@ class DocxExporter(ExporterBase):
         str_content = escape_js_and_html(str_content)
         image_path = hard_link_db.get_image(str_content, BytesExtra, thumb=True)
         base_path = os.path.join(OUTPUT_DIR, '聊天记录', self.contact.remark, 'image')
-        if not os.path.exists(os.path.join(Me().wx_dir, image_path)):
+        if not os.path.exists(os.path.join(self.me.wx_dir, image_path)):
             image_thumb_path = hard_link_db.get_image(str_content, BytesExtra, thumb=False)
-            if not os.path.exists(os.path.join(Me().wx_dir, image_thumb_path)):
+            if not os.path.exists(os.path.join(self.me.wx_dir, image_thumb_path)):
                 return
             image_path = image_thumb_path
         image_path = get_image_abs_path(image_path, base_path=base_path)
@@ -266,17 +318,17 @@ class DocxExporter(ExporterBase):
         display_name = self.get_display_name(is_send, message)
         thumbnail = ''
         if card_data.get('thumbnail'):
-            thumbnail = os.path.join(Me().wx_dir, card_data.get('thumbnail'))
+            thumbnail = os.path.join(self.me.wx_dir, card_data.get('thumbnail'))
             if os.path.exists(thumbnail):
-                shutil.copy(thumbnail, os.path.join(origin_path, 'image', os.path.basename(thumbnail)))
+                media_store.copy(thumbnail, os.path.join(origin_path, 'image', os.path.basename(thumbnail)))
                 thumbnail = './image/' + os.path.basename(thumbnail)
             else:
                 thumbnail = ''
         app_logo = ''
         if card_data.get('app_logo'):
-            app_logo = os.path.join(Me().wx_dir, card_data.get('app_logo'))
+            app_logo = os.path.join(self.me.wx_dir, card_data.get('app_logo'))
             if os.path.exists(app_logo):
-                shutil.copy(app_logo, os.path.join(origin_path, 'image', os.path.basename(app_logo)))
+                media_store.copy(app_logo, os.path.join(origin_path, 'image', os.path.basename(app_logo)))
                 app_logo = './image/' + os.path.basename(app_logo)
             else:
                 app_logo = ''
@@ -303,78 +355,82 @@ class DocxExporter(ExporterBase):
             os.remove(word)
         middle_new_docx.save(origin_path + '/' + filename)
 
-    def export(self):
+    def stream_types(self):
+        return None
+
+    def new_doc(self):
+        self.doc = docx.Document()
+        self.doc.styles["Normal"].font.name = "Cambria"
+        self.doc.styles["Normal"]._element.rPr.rFonts.set(qn("w:eastAsia"), "宋体")
+        self.n += 1
+
+    def begin(self, total):
         print(f"【开始导出 DOCX {self.contact.remark}】")
-        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        messages = msg_db.get_messages(self.contact.wxid, time_range=self.time_range)
-        Me().save_avatar(os.path.join(origin_path, 'avatar', f'{Me().wxid}.png'))
-        if self.contact.is_chatroom:
-            for message in messages:
-                if message[4]:  # is_send
-                    continue
-                try:
-                    chatroom_avatar_path =os.path.join(origin_path, 'avatar', f'{message[13].wxid}.png')
-                    message[13].save_avatar(chatroom_avatar_path)
-                except:
-                    print(message)
-                    pass
-        else:
-            self.contact.save_avatar(os.path.join(origin_path, 'avatar', f'{self.contact.wxid}.png'))
-        self.rangeSignal.emit(len(messages))
-
-        def newdoc():
-            nonlocal n, doc
-            doc = docx.Document()
-            doc.styles["Normal"].font.name = "Cambria"
-            doc.styles["Normal"]._element.rPr.rFonts.set(qn("w:eastAsia"), "宋体")
-            n += 1
+        self.me.save_avatar(os.path.join(self.origin_path, 'avatar', f'{self.me.wxid}.png'))
+        if not self.contact.is_chatroom:
+            self.contact.save_avatar(os.path.join(self.origin_path, 'avatar', f'{self.contact.wxid}.png'))
+        # 群成员的头像在第一次出现时保存
+        self.saved_avatars = set()
+        super().begin(total)
+        self.total_num = total
+        self.index = 0
+        self.n = 0
+        self.new_doc()
+
+    def write(self, message):
+        index = self.index
+        self.index += 1
+        if index % 200 == 0 and index:
+            filename = os.path.join(self.origin_path, f"{self.contact.remark}_{self.n}.docx")
+            self.doc.save(filename)
+            self.report_ok(self.n)
+            self.new_doc()
+
+        doc = self.doc
+        type_ = message[2]
+        sub_type = message[3]
+        timestamp = message[5]
+        if self.contact.is_chatroom and not message[4] and message[13].wxid not in self.saved_avatars:
+            self.saved_avatars.add(message[13].wxid)
+            try:
+                chatroom_avatar_path = os.path.join(self.origin_path, 'avatar', f'{message[13].wxid}.png')
+                message[13].save_avatar(chatroom_avatar_path)
+            except:
+                print(message)
+        self.report_progress(1)
+        if self.is_5_min(timestamp):
+            str_time = message[8]
+            doc.add_paragraph(str_time).alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        if type_ == 1 and self.message_types.get(type_):
+            self.text(doc, message)
+        elif type_ == 3 and self.message_types.get(type_):
+            self.image(doc, message)
+        elif type_ == 34 and self.message_types.get(type_):
+            self.audio(doc, message)
+        elif type_ == 43 and self.message_types.get(type_):
+            self.video(doc, message)
+        elif type_ == 47 and self.message_types.get(type_):
+            self.emoji(doc, message)
+        elif type_ == 10000 and self.message_types.get(type_):
+            self.system_msg(doc, message)
+        elif type_ == 49 and sub_type == 57 and self.message_types.get(1):
+            self.refermsg(doc, message)
+        elif type_ == 49 and sub_type == 6 and self.message_types.get(4906):
+            self.file(doc, message)
+        if index % 25 == 0:
+            print(f"【导出 DOCX {self.contact.remark}】{index}/{self.total_num}")
 
-        doc = None
-        n = 0
-        index = 0
-        newdoc()
-        for index, message in enumerate(messages):
-            if index % 200 == 0 and index:
-                filename = os.path.join(origin_path, f"{self.contact.remark}_{n}.docx")
-                doc.save(filename)
-                self.okSignal.emit(n)
-                newdoc()
-
-            type_ = message[2]
-            sub_type = message[3]
-            timestamp = message[5]
-            self.progressSignal.emit(1)
-            if self.is_5_min(timestamp):
-                str_time = message[8]
-                doc.add_paragraph(str_time).alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-            if type_ == 1 and self.message_types.get(type_):
-                self.text(doc, message)
-            elif type_ == 3 and self.message_types.get(type_):
-                self.image(doc, message)
-            elif type_ == 34 and self.message_types.get(type_):
-                self.audio(doc, message)
-            elif type_ == 43 and self.message_types.get(type_):
-                self.video(doc, message)
-            elif type_ == 47 and self.message_types.get(type_):
-                self.emoji(doc, message)
-            elif type_ == 10000 and self.message_types.get(type_):
-                self.system_msg(doc, message)
-            elif type_ == 49 and sub_type == 57 and self.message_types.get(1):
-                self.refermsg(doc, message)
-            elif type_ == 49 and sub_type == 6 and self.message_types.get(4906):
-                self.file(doc, message)
-            if index % 25 == 0:
-                print(f"【导出 DOCX {self.contact.remark}】{index}/{len(messages)}")
-        if index % 25:
-            print(f"【导出 DOCX {self.contact.remark}】{index + 1}/{len(messages)}")
-        filename = os.path.join(origin_path, f"{self.contact.remark}_{n}.docx")
+    def end(self):
+        if (self.index - 1) % 25 and self.index:
+            print(f"【导出 DOCX {self.contact.remark}】{self.index}/{self.total_num}")
+        filename = os.path.join(self.origin_path, f"{self.contact.remark}_{self.n}.docx")
         try:
             # document.save(filename)
-            doc.save(filename)
+            self.doc.save(filename)
         except PermissionError:
             filename = filename[:-5] + f'{time.time()}' + '.docx'
             # document.save(filename)
-            doc.save(filename)
-        self.okSignal.emit(n)
+            self.doc.save(filename)
+        self.report_ok(self.n)
         print(f"【完成导出 DOCX {self.contact.remark}】")
-        self.okSignal.emit(10086)
+        self.report_ok(10086)
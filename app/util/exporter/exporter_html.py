@@ -1,20 +1,17 @@
 import os
-import shutil
 import sys
 import traceback
 from re import findall
 
-from PyQt5.QtCore import pyqtSignal, QThread
-
-from app.DataBase import msg_db, hard_link_db, media_msg_db
+from app.DataBase import hard_link_db, media_msg_db
+from app.DataBase.msg import BLOBS_NONE
 from app.util.exporter.exporter import ExporterBase, escape_js_and_html
 from app.config import OUTPUT_DIR
 from app.log import logger
-from app.person import Me
-from app.util import path
+from app.util import media_store, path
 from app.util.compress_content import parser_reply, share_card, music_share, file, transfer_decompress, call_decompress
 from app.util.emoji import get_emoji_url
-from app.util.image import get_image_path, get_image
+from app.util.image import decode_dat_files, get_image_path
 from app.util.music import get_music_path
 
 icon_files = {
@@ -56,7 +53,7 @@ class HtmlExporter(ExporterBase):
         avatar = self.get_avatar_path(is_send, message)
         display_name = self.get_display_name(is_send, message)
         str_content = escape_js_and_html(str_content)
-        image_path = hard_link_db.get_image(str_content, BytesExtra, up_dir=Me().wx_dir, thumb=False)
+        image_path = hard_link_db.get_image(str_content, BytesExtra, up_dir=self.me.wx_dir, thumb=False)
         image_path = get_image_path(image_path, base_path=base_path)
         doc.write(
             f'''{{ type:{type_}, text: '{image_path}',is_send:{is_send},avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}'}},'''
@@ -187,7 +184,7 @@ class HtmlExporter(ExporterBase):
             try:
                 # todo 网络图片问题
                 print(origin_path + image_path[1:])
-                os.utime(origin_path + image_path[1:], (timestamp, timestamp))
+                media_store.set_mtime(origin_path + image_path[1:], timestamp)
                 doc.write(
                     f'''{{ type:3, text: '{image_path}',is_send:{is_send},avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}'}},'''
                 )
@@ -198,13 +195,13 @@ class HtmlExporter(ExporterBase):
             return
         if video_path is None and image_path is None:
             return
-        video_path = f'{Me().wx_dir}/{video_path}'
+        video_path = f'{self.me.wx_dir}/{video_path}'
         video_path = video_path.replace('\\', '/')
         if os.path.exists(video_path):
             new_path = origin_path + '/video/' + os.path.basename(video_path)
-            if not os.path.exists(new_path):
-                shutil.copy(video_path, os.path.join(origin_path, 'video'))
-            os.utime(new_path, (timestamp, timestamp))
+            # 要改修改时间，拷贝而不是链接到媒体库
+            if media_store.copy(video_path, new_path, private=True):
+                media_store.set_mtime(new_path, timestamp)
             video_path = f'./video/{os.path.basename(video_path)}'
         doc.write(
             f'''{{ type:{type_}, text: '{video_path}',is_send:{is_send},avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}'}},'''
@@ -243,17 +240,17 @@ class HtmlExporter(ExporterBase):
         display_name = self.get_display_name(is_send, message)
         thumbnail = ''
         if card_data.get('thumbnail'):
-            thumbnail = os.path.join(Me().wx_dir, card_data.get('thumbnail'))
+            thumbnail = os.path.join(self.me.wx_dir, card_data.get('thumbnail'))
             if os.path.exists(thumbnail):
-                shutil.copy(thumbnail, os.path.join(origin_path, 'image', os.path.basename(thumbnail)))
+                media_store.copy(thumbnail, os.path.join(origin_path, 'image', os.path.basename(thumbnail)))
                 thumbnail = './image/' + os.path.basename(thumbnail)
             else:
                 thumbnail = ''
         app_logo = ''
         if card_data.get('app_logo'):
-            app_logo = os.path.join(Me().wx_dir, card_data.get('app_logo'))
+            app_logo = os.path.join(self.me.wx_dir, card_data.get('app_logo'))
             if os.path.exists(app_logo):
-                shutil.copy(app_logo, os.path.join(origin_path, 'image', os.path.basename(app_logo)))
+                media_store.copy(app_logo, os.path.join(origin_path, 'image', os.path.basename(app_logo)))
                 app_logo = './image/' + os.path.basename(app_logo)
             else:
                 app_logo = card_data.get('app_logo')
@@ -299,9 +296,8 @@ class HtmlExporter(ExporterBase):
         doc.write(
             f"""{{ type:50, text:'{call_detail["display_content"]}',call_type:{call_detail["call_type"]},avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}',}},\n""")
 
-    def export(self):
+    def begin(self, total):
         print(f"【开始导出 HTML {self.contact.remark}】")
-        messages = msg_db.get_messages(self.contact.wxid, time_range=self.time_range)
         filename = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark,
                                 f'{self.contact.remark}.html')
         file_path = './app/resources/data/template.html'
@@ -311,213 +307,147 @@ class HtmlExporter(ExporterBase):
 
         with open(file_path, "r", encoding="utf-8") as f:
             content = f.read()
-            html_head, html_end = content.split('/*注意看这是分割线*/')
-        f = open(filename, 'w', encoding='utf-8')
+            html_head, self.html_end = content.split('/*注意看这是分割线*/')
+        self.output_file = open(filename, 'w', encoding='utf-8')
         html_head = html_head.replace("<title>出错了</title>", f"<title>{self.contact.remark}</title>")
         html_head = html_head.replace("<p id=\"title\">出错了</p>", f"<p id=\"title\">{self.contact.remark}</p>")
-        f.write(html_head)
-        self.rangeSignal.emit(len(messages))
-        for index, message in enumerate(messages):
-            type_ = message[2]
-            sub_type = message[3]
-            timestamp = message[5]
-            if (type_ == 3 and self.message_types.get(3)) or (type_ == 34 and self.message_types.get(34)) or (
-                    type_ == 47 and self.message_types.get(47)):
-                pass
-            else:
-                self.progressSignal.emit(1)
-
-            if type_ == 1 and self.message_types.get(type_):
-                self.text(f, message)
-            elif type_ == 3 and self.message_types.get(type_):
-                self.image(f, message)
-            elif type_ == 34 and self.message_types.get(type_):
-                self.audio(f, message)
-            elif type_ == 43 and self.message_types.get(type_):
-                self.video(f, message)
-            elif type_ == 47 and self.message_types.get(type_):
-                self.emoji(f, message)
-            elif type_ == 10000 and self.message_types.get(type_):
-                self.system_msg(f, message)
-            elif type_ == 49 and sub_type == 57 and self.message_types.get(1):
-                self.refermsg(f, message)
-            elif type_ == 49 and sub_type == 6 and self.message_types.get(4906):
-                self.file(f, message)
-            elif type_ == 49 and sub_type == 3 and self.message_types.get(4903):
-                self.music_share(f, message)
-            elif type_ == 49 and sub_type == 5 and self.message_types.get(4905):
-                self.share_card(f, message)
-            elif type_ == 49 and sub_type == 2000 and self.message_types.get(492000):
-                self.transfer(f, message)
-            elif type_ == 50 and self.message_types.get(50):
-                self.call(f, message)
-            if index % 2000 == 0:
-                print(f"【导出 HTML {self.contact.remark}】{index}/{len(messages)}")
-        f.write(html_end)
-        f.close()
-        print(f"【完成导出 HTML {self.contact.remark}】{len(messages)}")
-        self.count_finish_num(1)
-
-    def count_finish_num(self, num):
-        """
-        记录子线程完成个数
-        @param num:
-        @return:
-        """
-        self.num += 1
-        print("子线程完成", self.num, "/", self.total_num)
-        if self.num == self.total_num:
-            # 所有子线程都完成之后就发送完成信号
-            self.okSignal.emit(1)
-
+        self.output_file.write(html_head)
+        self.total_num = total
+        self.index = 0
+        super().begin(total)
 
-class OutputMedia(QThread):
+    def write(self, message):
+        f = self.output_file
+        type_ = message[2]
+        sub_type = message[3]
+        if (type_ == 3 and self.message_types.get(3)) or (type_ == 34 and self.message_types.get(34)) or (
+                type_ == 47 and self.message_types.get(47)):
+            pass
+        else:
+            self.report_progress(1)
+
+        if type_ == 1 and self.message_types.get(type_):
+            self.text(f, message)
+        elif type_ == 3 and self.message_types.get(type_):
+            self.image(f, message)
+        elif type_ == 34 and self.message_types.get(type_):
+            self.audio(f, message)
+        elif type_ == 43 and self.message_types.get(type_):
+            self.video(f, message)
+        elif type_ == 47 and self.message_types.get(type_):
+            self.emoji(f, message)
+        elif type_ == 10000 and self.message_types.get(type_):
+            self.system_msg(f, message)
+        elif type_ == 49 and sub_type == 57 and self.message_types.get(1):
+            self.refermsg(f, message)
+        elif type_ == 49 and sub_type == 6 and self.message_types.get(4906):
+            self.file(f, message)
+        elif type_ == 49 and sub_type == 3 and self.message_types.get(4903):
+            self.music_share(f, message)
+        elif type_ == 49 and sub_type == 5 and self.message_types.get(4905):
+            self.share_card(f, message)
+        elif type_ == 49 and sub_type == 2000 and self.message_types.get(492000):
+            self.transfer(f, message)
+        elif type_ == 50 and self.message_types.get(50):
+            self.call(f, message)
+        if self.index % 2000 == 0:
+            print(f"【导出 HTML {self.contact.remark}】{self.index}/{self.total_num}")
+        self.index += 1
+
+    def end(self):
+        self.output_file.write(self.html_end)
+        self.output_file.close()
+        print(f"【完成导出 HTML {self.contact.remark}】{self.total_num}")
+        super().end()
+
+
+class MediaExporter(ExporterBase):
     """
-    导出语音消息
+    导出HTML里用到的语音
     """
+    blobs = BLOBS_NONE
 
-    okSingal = pyqtSignal(int)
-    progressSignal = pyqtSignal(int)
+    def stream_types(self):
+        return [34]
 
-    def __init__(self, contact):
-        super().__init__()
-        self.contact = contact
+    def begin(self, total):
+        # 进度算在HtmlExporter的总数里
+        pass
 
-    def run(self):
-        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        messages = msg_db.get_messages_by_type(self.contact.wxid, 34)
-        for message in messages:
-            is_send = message[4]
-            msgSvrId = message[9]
-            try:
-                audio_path = media_msg_db.get_audio(
-                    msgSvrId, output_path=origin_path + "/voice"
-                )
-            except:
-                logger.error(traceback.format_exc())
-            finally:
-                self.progressSignal.emit(1)
-        self.okSingal.emit(34)
+    def write(self, message):
+        msgSvrId = message[9]
+        try:
+            media_msg_db.get_audio(msgSvrId, output_path=self.origin_path + "/voice")
+        except:
+            logger.error(traceback.format_exc())
+        finally:
+            self.report_progress(1)
+
+    def end(self):
+        self.report_ok(34)
 
 
-class OutputEmoji(QThread):
+class EmojiExporter(ExporterBase):
     """
-    导出表情包
+    导出HTML里用到的表情包
     """
+    blobs = BLOBS_NONE
 
-    okSingal = pyqtSignal(int)
-    progressSignal = pyqtSignal(int)
+    def stream_types(self):
+        return [47]
 
-    def __init__(self, contact):
-        super().__init__()
-        self.contact = contact
+    def begin(self, total):
+        pass
 
-    def run(self):
-        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        messages = msg_db.get_messages_by_type(self.contact.wxid, 47)
-        for message in messages:
-            str_content = message[7]
-            try:
-                pass
-                # emoji_path = get_emoji(str_content, thumb=True, output_path=origin_path + '/emoji')
-            except:
-                logger.error(traceback.format_exc())
-            finally:
-                self.progressSignal.emit(1)
-        self.okSingal.emit(47)
+    def write(self, message):
+        str_content = message[7]
+        try:
+            pass
+            # emoji_path = get_emoji(str_content, thumb=True, output_path=self.origin_path + '/emoji')
+        except:
+            logger.error(traceback.format_exc())
+        finally:
+            self.report_progress(1)
+
+    def end(self):
+        self.report_ok(47)
 
 
-class OutputImage(QThread):
+class ImageExporter(ExporterBase):
     """
-    导出图片
+    导出HTML里用到的图片
+    先收集所有图片，结束时用线程池批量解密
     """
 
-    okSingal = pyqtSignal(int)
-    progressSignal = pyqtSignal(int)
-
-    def __init__(self, contact):
-        super().__init__()
-        self.contact = contact
-        self.child_thread_num = 2
-        self.child_threads = [0] * (self.child_thread_num + 1)
-        self.num = 0
+    def stream_types(self):
+        return [3]
 
-    def count1(self, num):
-        self.num += 1
-        print("图片导出完成一个")
-        if self.num == self.child_thread_num:
-            self.okSingal.emit(47)
-            print("图片导出完成")
-
-    def run(self):
-        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        messages = msg_db.get_messages_by_type(self.contact.wxid, 3)
-        base_path = os.path.join(OUTPUT_DIR, '聊天记录', self.contact.remark, 'image')
-        for message in messages:
-            str_content = message[7]
-            BytesExtra = message[10]
-            timestamp = message[5]
-            try:
-                image_path = hard_link_db.get_image(
-                    str_content, BytesExtra, thumb=False
-                )
-                if not os.path.exists(os.path.join(Me().wx_dir, image_path)):
-                    image_thumb_path = hard_link_db.get_image(
-                        str_content, BytesExtra, thumb=True
-                    )
-                    if not os.path.exists(os.path.join(Me().wx_dir, image_thumb_path)):
-                        continue
-                    image_path = image_thumb_path
-                image_path = get_image(
-                    image_path, base_path=base_path
-                )
-                try:
-                    os.utime(origin_path + image_path[1:], (timestamp, timestamp))
-                except:
-                    pass
-            except:
-                logger.error(traceback.format_exc())
-            finally:
-                self.progressSignal.emit(1)
-        self.okSingal.emit(47)
+    def begin(self, total):
+        self.base_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark, 'image')
+        self.tasks = []
 
+    def write(self, message):
+        str_content = message[7]
+        BytesExtra = message[10]
+        timestamp = message[5]
+        try:
+            image_path = hard_link_db.get_image(str_content, BytesExtra, up_dir=self.me.wx_dir, thumb=False)
+        except:
+            logger.error(traceback.format_exc())
+            image_path = ''
+        if image_path:
+            self.tasks.append((os.path.join(self.me.wx_dir, image_path), self.base_path, timestamp))
+        else:
+            self.report_progress(1)
 
-class OutputImageChild(QThread):
-    okSingal = pyqtSignal(int)
-    progressSignal = pyqtSignal(int)
+    def end(self):
+        decoded = 0
 
-    def __init__(self, contact, messages):
-        super().__init__()
-        self.contact = contact
-        self.messages = messages
+        def progress(done, total):
+            nonlocal decoded
+            self.report_progress(done - decoded)
+            decoded = done
 
-    def run(self):
-        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        for message in self.messages:
-            str_content = message[7]
-            BytesExtra = message[10]
-            timestamp = message[5]
-            try:
-                image_path = hard_link_db.get_image(
-                    str_content, BytesExtra, thumb=False
-                )
-                if not os.path.exists(os.path.join(Me().wx_dir, image_path)):
-                    image_thumb_path = hard_link_db.get_image(
-                        str_content, BytesExtra, thumb=True
-                    )
-                    if not os.path.exists(os.path.join(Me().wx_dir, image_thumb_path)):
-                        continue
-                    image_path = image_thumb_path
-                image_path = get_image(
-                    image_path, base_path=f"/data/聊天记录/{self.contact.remark}/image"
-                )
-                try:
-                    os.utime(origin_path + image_path[1:], (timestamp, timestamp))
-                except:
-                    pass
-            except:
-                logger.error(traceback.format_exc())
-            finally:
-                self.progressSignal.emit(1)
-        self.okSingal.emit(47)
-        print("图片子线程完成")
+        decode_dat_files(self.tasks, progress=progress, is_cancelled=lambda: self.cancelled)
+        self.tasks = []
+        self.report_ok(3)
@@ -3,7 +3,7 @@ import random
 import os
 
 from app.DataBase import msg_db
-from app.person import Me
+from app.DataBase.msg import BLOBS_NONE
 from .exporter import ExporterBase
 
 
@@ -41,17 +41,17 @@ def merge_content(conversions_list) -> list:
     return merged_data
 
 
-def system_prompt():
+def system_prompt(name):
     system = {
         "role": "system",
-        # "content": f"你是{Me().name}，一个聪明、热情、善良的男大学生，后面的对话来自{self.contact.remark}(！！！注意：对方的身份十分重要，你务必记住对方的身份，因为跟不同的人对话要用不同的态度、语气)，你要认真地回答他"
-        "content": f"你是{Me().name}，一个聪明、热情、善良的人，后面的对话来自你的朋友，你要认真地回答他"
+        # "content": f"你是{name}，一个聪明、热情、善良的男大学生，后面的对话来自{self.contact.remark}(！！！注意：对方的身份十分重要，你务必记住对方的身份，因为跟不同的人对话要用不同的态度、语气)，你要认真地回答他"
+        "content": f"你是{name}，一个聪明、热情、善良的人，后面的对话来自你的朋友，你要认真地回答他"
     }
     return system
 
 
-def message_to_conversion(group):
-    conversions = [system_prompt()]
+def message_to_conversion(group, name):
+    conversions = [system_prompt(name)]
     while len(group) and group[-1][4] == 0:
         group.pop()
     for message in group:
@@ -75,7 +75,48 @@ def message_to_conversion(group):
     return merge_content(conversions)
 
 
+def iter_groups_by_intervals(messages, max_diff_seconds=300):
+    """
+    逐条读取消息并切分成对话：每段以对方的消息开头，
+    与上一条间隔不超过max_diff_seconds的消息归为同一段，段尾紧跟的自己发送的消息也归入这一段
+    @param messages: 按时间排序的消息，可以是生成器
+    @param max_diff_seconds: 最大间隔
+    @return: generator，每次返回一段消息列表
+    """
+    group = []
+    last_send = None  # 开头连续的自己发送的消息，只在全部都是自己发送时保留最后一条
+    tail = False  # 是否正在收集段尾自己发送的消息
+    for message in messages:
+        is_send = message[4]
+        if not group:
+            if is_send:
+                last_send = message
+                continue
+            group = [message]
+            continue
+        if tail:
+            if is_send:
+                group.append(message)
+                continue
+        elif message[5] - group[-1][5] <= max_diff_seconds:
+            group.append(message)
+            continue
+        elif is_send:
+            group.append(message)
+            tail = True
+            continue
+        yield group
+        group = [message]
+        tail = False
+    if group:
+        yield group
+    elif last_send is not None:
+        yield [last_send]
+
+
 class JsonExporter(ExporterBase):
+    blobs = BLOBS_NONE
+
     def split_by_time(self, length=300):
         messages = msg_db.get_messages_by_type(self.contact.wxid, type_=1, time_range=self.time_range)
         start_time = 0
@@ -86,7 +127,7 @@ class JsonExporter(ExporterBase):
             timestamp = message[5]
             is_send = message[4]
             group = [
-                system_prompt()
+                system_prompt(self.me.name)
             ]
             while i < len(messages) and timestamp - start_time < length:
                 if is_send:
@@ -132,45 +173,36 @@ class JsonExporter(ExporterBase):
             })
         return res_
 
-    def split_by_intervals(self, max_diff_seconds=300):
-        messages = msg_db.get_messages_by_type(self.contact.wxid, type_=1, time_range=self.time_range)
-        res = []
-        i = 0
-        current_group = []
-        while i < len(messages):
-            message = messages[i]
-            timestamp = message[5]
-            is_send = message[4]
-            while is_send and i + 1 < len(messages):
-                i += 1
-                message = messages[i]
-                is_send = message[4]
-            current_group = [messages[i]]
-            i += 1
-            while i < len(messages) and messages[i][5] - current_group[-1][5] <= max_diff_seconds:
-                current_group.append(messages[i])
-                i += 1
-            while i < len(messages) and messages[i][4]:
-                current_group.append(messages[i])
-                i += 1
-            res.append(current_group)
+    def split_by_intervals(self, messages, max_diff_seconds=300):
         res_ = []
-        for group in res:
-            conversations = message_to_conversion(group)
+        for group in iter_groups_by_intervals(messages, max_diff_seconds):
+            conversations = message_to_conversion(group, self.me.name)
             if conversations:
                 res_.append({
                     'conversations': conversations
                 })
         return res_
 
-    def to_json(self):
+    def stream_types(self):
+        return [1]
+
+    def begin(self, total):
         print(f"【开始导出 json {self.contact.remark}】")
+        super().begin(total)
+        self.text_messages = []
+
+    def write(self, message):
+        # 训练数据要打乱顺序，只能先收集起来
+        self.text_messages.append(message)
+
+    def end(self):
         origin_path = self.origin_path
         os.makedirs(origin_path, exist_ok=True)
         filename = os.path.join(origin_path, f"{self.contact.remark}")
 
         # res = self.split_by_time()
-        res = self.split_by_intervals(60)
+        res = self.split_by_intervals(self.text_messages, 60)
+        self.text_messages = []
         # 打乱列表顺序
         random.shuffle(res)
 
@@ -187,7 +219,4 @@ class JsonExporter(ExporterBase):
             json.dump(train_data, f, ensure_ascii=False, indent=4)
         with open(f'{filename}_dev.json', "w", encoding="utf-8") as f:
             json.dump(dev_data, f, ensure_ascii=False, indent=4)
-        self.okSignal.emit(1)
-
-    def run(self):
-        self.to_json()
+        super().end()
@@ -1,8 +1,6 @@
 import os
 
-from app.DataBase import msg_db
 from app.util.exporter.exporter import ExporterBase
-from app.config import OUTPUT_DIR
 from app.util.compress_content import parser_reply, share_card
 
 
@@ -109,38 +107,42 @@ class TxtExporter(ExporterBase):
             \n\n'''
         )
 
-    def export(self):
-        # 实现导出为txt的逻辑
+    def begin(self, total):
         print(f"【开始导出 TXT {self.contact.remark}】")
-        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        os.makedirs(origin_path, exist_ok=True)
-        filename = os.path.join(origin_path, self.contact.remark+'.txt')
-        messages = msg_db.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
-        with open(filename, mode='w', newline='', encoding='utf-8') as f:
-            for index, message in enumerate(messages):
-                type_ = message[2]
-                sub_type = message[3]
-                self.progressSignal.emit(int((index + 1) / total_steps * 100))
-                if type_ == 1 and self.message_types.get(type_):
-                    self.text(f, message)
-                elif type_ == 3 and self.message_types.get(type_):
-                    self.image(f, message)
-                elif type_ == 34 and self.message_types.get(type_):
-                    self.audio(f, message)
-                elif type_ == 43 and self.message_types.get(type_):
-                    self.video(f, message)
-                elif type_ == 47 and self.message_types.get(type_):
-                    self.emoji(f, message)
-                elif type_ == 10000 and self.message_types.get(type_):
-                    self.system_msg(f, message)
-                elif type_ == 49 and sub_type == 57 and self.message_types.get(1):
-                    self.refermsg(f, message)
-                elif type_ == 49 and sub_type == 6 and self.message_types.get(4906):
-                    self.file(f, message)
-                elif type_ == 49 and sub_type == 3 and self.message_types.get(4903):
-                    self.music_share(f, message)
-                elif type_ == 49 and sub_type == 5 and self.message_types.get(4905):
-                    self.share_card(f, message)
+        super().begin(total)
+        self.total_num = max(total, 1)
+        os.makedirs(self.origin_path, exist_ok=True)
+        filename = os.path.join(self.origin_path, self.contact.remark + '.txt')
+        self.output_file = open(filename, mode='w', newline='', encoding='utf-8')
+
+    def write(self, message):
+        f = self.output_file
+        type_ = message[2]
+        sub_type = message[3]
+        self.num += 1
+        self.report_progress(int(self.num / self.total_num * 100))
+        if type_ == 1 and self.message_types.get(type_):
+            self.text(f, message)
+        elif type_ == 3 and self.message_types.get(type_):
+            self.image(f, message)
+        elif type_ == 34 and self.message_types.get(type_):
+            self.audio(f, message)
+        elif type_ == 43 and self.message_types.get(type_):
+            self.video(f, message)
+        elif type_ == 47 and self.message_types.get(type_):
+            self.emoji(f, message)
+        elif type_ == 10000 and self.message_types.get(type_):
+            self.system_msg(f, message)
+        elif type_ == 49 and sub_type == 57 and self.message_types.get(1):
+            self.refermsg(f, message)
+        elif type_ == 49 and sub_type == 6 and self.message_types.get(4906):
+            self.file(f, message)
+        elif type_ == 49 and sub_type == 3 and self.message_types.get(4903):
+            self.music_share(f, message)
+        elif type_ == 49 and sub_type == 5 and self.message_types.get(4905):
+            self.share_card(f, message)
+
+    def end(self):
+        self.output_file.close()
         print(f"【完成导出 TXT {self.contact.remark}】")
-        self.okSignal.emit(1)
\ No newline at end of file
+        super().end()
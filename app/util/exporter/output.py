@@ -1,32 +1,55 @@
 import csv
 import os
-import time
-import traceback
 from typing import List
 
-import docx
 from PyQt5.QtCore import pyqtSignal, QThread
 from PyQt5.QtWidgets import QFileDialog
-from docx.oxml.ns import qn
-from docxcompose.composer import Composer
 
+from app.util.exporter.export_job import CPU_BOUND_TYPES, EXPORTERS, export_contact
+from app.util.exporter.exporter import ExporterBase, export_stream
 from app.util.exporter.exporter_ai_txt import AiTxtExporter
 from app.util.exporter.exporter_csv import CSVExporter
-from app.util.exporter.exporter_docx import DocxExporter
-from app.util.exporter.exporter_html import HtmlExporter
+from app.util.exporter.exporter_docx import DocxExporter, DocxMerger
+from app.util.exporter.exporter_html import EmojiExporter, HtmlExporter, ImageExporter, MediaExporter
 from app.util.exporter.exporter_json import JsonExporter
 from app.util.exporter.exporter_txt import TxtExporter
+from app.util.exporter.scheduler import ExportScheduler
 from app.DataBase.hard_link import decodeExtraBuf
+from app.DataBase.pool import encrypted_mode
 from app.config import OUTPUT_DIR
 from app.DataBase.package_msg import PackageMsg
-from app.DataBase import media_msg_db, hard_link_db, micro_msg_db, msg_db
-from app.log import logger
+from app.DataBase import micro_msg_db, msg_db
 from app.person import Me
-from app.util.image import get_image
 
 os.makedirs(os.path.join(OUTPUT_DIR, '聊天记录'), exist_ok=True)
 
 
+class QtExporter(QThread):
+    """
+    把不依赖Qt的导出器包装成QThread，回调转成信号，供界面使用
+    传入多个导出器时共用一次消息查询（见exporter.export_stream），各导出器的回调都转成同一组信号
+    """
+    progressSignal = pyqtSignal(int)
+    rangeSignal = pyqtSignal(int)
+    okSignal = pyqtSignal(int)
+
+    def __init__(self, exporter: ExporterBase | List[ExporterBase], parent=None):
+        super().__init__(parent)
+        self.exporters = exporter if isinstance(exporter, list) else [exporter]
+        for exporter in self.exporters:
+            exporter.on_progress = self.progressSignal.emit
+            exporter.on_range = self.rangeSignal.emit
+            exporter.on_ok = self.okSignal.emit
+
+    def run(self):
+        export_stream(self.exporters)
+
+    def cancel(self):
+        for exporter in self.exporters:
+            exporter.cancel()
+        self.requestInterruption()
+
+
 class Output(QThread):
     """
     发送信息线程
@@ -99,7 +122,7 @@ class Output(QThread):
                    'StrTime', 'Remark', 'NickName', 'Sender']
 
         packagemsg = PackageMsg()
-        messages = packagemsg.get_package_message_all()
+        messages = packagemsg.iter_package_message_all()
         # 写入CSV文件
         with open(filename, mode='w', newline='', encoding='utf-8-sig') as file:
             writer = csv.writer(file)
@@ -144,150 +167,88 @@ class Output(QThread):
         self.okSignal.emit(1)
 
     def batch_export(self):
+        """
+        批量导出：每个联系人的所有格式作为一个任务排进ExportScheduler，最多EXPORT_WORKERS个同时导出
+        CPU密集的格式（CPU_BOUND_TYPES）放到进程池里，直接读加密数据库时子进程打不开数据库，全部用线程
+        progressSignal发送按消息数加权的总进度（百分比），nowContact发送刚完成的联系人和预计剩余时间
+        """
         print('开始批量导出')
         print(self.sub_type, self.message_types)
         print(len(self.contact))
-        print([contact.remark for contact in self.contact])
-        self.batch_num_total = len(self.contact) * len(self.sub_type)
-        self.batch_num = 0
-        self.rangeSignal.emit(self.batch_num_total)
+        use_process = not encrypted_mode()
+        scheduler = ExportScheduler(progress=self.batch_progress)
+        types = [type_ for type_ in self.sub_type if type_ in EXPORTERS]
+        # nowContact每个任务（联系人）发送一次，不是每种格式一次
+        self.rangeSignal.emit(len(self.contact) if types else 0)
         for contact in self.contact:
-            # print('联系人', contact.remark)
-            for type_ in self.sub_type:
-                # print('导出类型', type_)
-                if type_ == self.DOCX:
-                    self.to_docx(contact, self.message_types, True)
-                elif type_ == self.TXT:
-                    # print('批量导出txt')
-                    self.to_txt(contact, self.message_types, True)
-                elif type_ == self.AI_TXT:
-                    # print('批量导出txt')
-                    self.to_ai_txt(contact, self.message_types, True)
-                elif type_ == self.CSV:
-                    self.to_csv(contact, self.message_types, True)
-                elif type_ == self.HTML:
-                    self.to_html(contact, self.message_types, True)
-                elif type_ == self.JSON:
-                    self.to_json(contact,self.message_types,True)
-
-    def batch_finish_one(self, num):
-        self.nowContact.emit(self.contact[self.batch_num // len(self.sub_type)].remark)
-        self.batch_num += 1
-        if self.batch_num == self.batch_num_total:
-            self.okSignal.emit(1)
+            if not types:
+                break
+            # 一个联系人的所有格式放在一个任务里，消息只读一遍
+            # 没有消息的联系人也要建文件夹、写文件，至少算1，进度才能走到100%
+            weight = max(msg_db.get_messages_number(contact.wxid, time_range=self.time_range), 1) * len(types)
+            scheduler.add(
+                contact.remark,
+                export_contact,
+                (contact, types, self.message_types, self.time_range, Me()),
+                weight=weight,
+                process=use_process and any(type_ in CPU_BOUND_TYPES for type_ in types),
+            )
+        self.scheduler = scheduler
+        scheduler.run()
+        self.okSignal.emit(1)
+
+    def batch_progress(self, done, total, eta, job):
+        if self.isInterruptionRequested():
+            self.scheduler.cancel()
+        self.progressSignal.emit(int(done / total * 100))
+        self.nowContact.emit(f'{job.name} 预计剩余{int(eta)}s')
 
     def merge_docx(self, n):
-        conRemark = self.contact.remark
-        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', conRemark)
-        filename = f"{origin_path}/{conRemark}_{n}.docx"
         if n == 10086:
-            # self.document.append(self.document)
-            file = os.path.join(origin_path, f'{conRemark}.docx')
-            try:
-                self.document.save(file)
-            except PermissionError:
-                file = file[:-5] + f'{time.time()}' + '.docx'
-                self.document.save(file)
+            self.document.save()
             self.okSignal.emit(1)
             return
-        doc = docx.Document(filename)
-        self.document.append(doc)
-        os.remove(filename)
-        if n % 50 == 0:
-            # self.document.append(self.document)
-            file = os.path.join(origin_path, f'{conRemark}-{n // 50}.docx')
-            try:
-                self.document.save(file)
-            except PermissionError:
-                file = file[:-5] + f'{time.time()}' + '.docx'
-                self.document.save(file)
-            doc = docx.Document()
-            doc.styles["Normal"].font.name = "Cambria"
-            doc.styles["Normal"]._element.rPr.rFonts.set(qn("w:eastAsia"), "宋体")
-            self.document = Composer(doc)
-
-    def to_docx(self, contact, message_types, is_batch=False):
-        doc = docx.Document()
-        doc.styles["Normal"].font.name = "Cambria"
-        doc.styles["Normal"]._element.rPr.rFonts.set(qn("w:eastAsia"), "宋体")
-        self.document = Composer(doc)
-        Child = DocxExporter(contact, type_=self.DOCX, message_types=message_types, time_range=self.time_range)
-        self.children.append(Child)
-        Child.progressSignal.connect(self.progress)
-        if not is_batch:
-            Child.rangeSignal.connect(self.rangeSignal)
-        Child.okSignal.connect(self.merge_docx if not is_batch else self.batch_finish_one)
-        Child.start()
-
-    def to_json(self, contact, message_types, is_batch=False):
-        Child = JsonExporter(contact, type_=self.JSON, message_types=message_types, time_range=self.time_range)
-        self.children.append(Child)
-        Child.progressSignal.connect(self.progress)
-        if not is_batch:
-            Child.rangeSignal.connect(self.rangeSignal)
-        Child.okSignal.connect(self.okSignal if not is_batch else self.batch_finish_one)
-        Child.start()
-
-    def to_txt(self, contact, message_types, is_batch=False):
-        Child = TxtExporter(contact, type_=self.TXT, message_types=message_types, time_range=self.time_range)
-        self.children.append(Child)
-        Child.progressSignal.connect(self.progress)
-        if not is_batch:
-            Child.rangeSignal.connect(self.rangeSignal)
-        Child.okSignal.connect(self.okSignal if not is_batch else self.batch_finish_one)
-        Child.start()
+        self.document.append(n)
 
-    def to_ai_txt(self, contact, message_types, is_batch=False):
-        Child = AiTxtExporter(contact, type_=self.TXT, message_types=message_types, time_range=self.time_range)
-        self.children.append(Child)
-        Child.progressSignal.connect(self.progress)
-        if not is_batch:
-            Child.rangeSignal.connect(self.rangeSignal)
-        Child.okSignal.connect(self.okSignal if not is_batch else self.batch_finish_one)
-        Child.start()
-
-    def to_html(self, contact, message_types, is_batch=False):
-        Child = HtmlExporter(contact, type_=self.output_type, message_types=message_types, time_range=self.time_range)
-        self.children.append(Child)
-        Child.progressSignal.connect(self.progress)
-        if not is_batch:
-            Child.rangeSignal.connect(self.rangeSignal)
-        Child.okSignal.connect(self.count_finish_num)
-        Child.start()
-        self.total_num = 1
-        if message_types.get(34):
-            # 语音消息单独的线程
-            self.total_num += 1
-            output_media = OutputMedia(contact, time_range=self.time_range)
-            self.children.append(output_media)
-            output_media.okSingal.connect(self.count_finish_num)
-            output_media.progressSignal.connect(self.progressSignal)
-            output_media.start()
-        if message_types.get(47):
-            # emoji消息单独的线程
-            self.total_num += 1
-            output_emoji = OutputEmoji(contact, time_range=self.time_range)
-            self.children.append(output_emoji)
-            output_emoji.okSingal.connect(self.count_finish_num)
-            output_emoji.progressSignal.connect(self.progressSignal)
-            output_emoji.start()
-        if message_types.get(3):
-            # 图片消息单独的线程
-            self.total_num += 1
-            output_image = OutputImage(contact, time_range=self.time_range)
-            self.children.append(output_image)
-            output_image.okSingal.connect(self.count_finish_num)
-            output_image.progressSignal.connect(self.progressSignal)
-            output_image.start()
-
-    def to_csv(self, contact, message_types, is_batch=False):
-        Child = CSVExporter(contact, type_=self.CSV, message_types=message_types, time_range=self.time_range)
+    def start_exporter(self, exporter: ExporterBase | List[ExporterBase], on_ok) -> QtExporter:
+        Child = QtExporter(exporter)
         self.children.append(Child)
         Child.progressSignal.connect(self.progress)
-        if not is_batch:
-            Child.rangeSignal.connect(self.rangeSignal)
-        Child.okSignal.connect(self.okSignal if not is_batch else self.batch_finish_one)
+        Child.rangeSignal.connect(self.rangeSignal)
+        Child.okSignal.connect(on_ok)
         Child.start()
+        return Child
+
+    def to_docx(self, contact, message_types):
+        self.document = DocxMerger(contact)
+        exporter = DocxExporter(contact, type_=self.DOCX, message_types=message_types, time_range=self.time_range)
+        self.start_exporter(exporter, self.merge_docx)
+
+    def to_json(self, contact, message_types):
+        exporter = JsonExporter(contact, type_=self.JSON, message_types=message_types, time_range=self.time_range)
+        self.start_exporter(exporter, self.okSignal)
+
+    def to_txt(self, contact, message_types):
+        exporter = TxtExporter(contact, type_=self.TXT, message_types=message_types, time_range=self.time_range)
+        self.start_exporter(exporter, self.okSignal)
+
+    def to_ai_txt(self, contact, message_types):
+        exporter = AiTxtExporter(contact, type_=self.TXT, message_types=message_types, time_range=self.time_range)
+        self.start_exporter(exporter, self.okSignal)
+
+    def to_html(self, contact, message_types):
+        exporters = [HtmlExporter(contact, type_=self.output_type, message_types=message_types,
+                                  time_range=self.time_range)]
+        # 语音、表情包、图片和HTML共用一次查询，各自完成时发okSignal
+        for type_, exporter_class in ((34, MediaExporter), (47, EmojiExporter), (3, ImageExporter)):
+            if message_types.get(type_):
+                exporters.append(exporter_class(contact, message_types=message_types, time_range=self.time_range))
+        self.total_num = len(exporters)
+        self.start_exporter(exporters, self.count_finish_num)
+
+    def to_csv(self, contact, message_types):
+        exporter = CSVExporter(contact, type_=self.CSV, message_types=message_types, time_range=self.time_range)
+        self.start_exporter(exporter, self.okSignal)
 
     def run(self):
         if self.output_type == self.DOCX:
@@ -318,149 +279,14 @@ class Output(QThread):
         self.num += 1
         if self.num == self.total_num:
             # 所有子线程都完成之后就发送完成信号
-            if self.output_type == self.Batch:
-                self.batch_finish_one(1)
-            else:
-                self.okSignal.emit(1)
+            self.okSignal.emit(1)
             self.num = 0
 
     def cancel(self):
+        for child in self.children:
+            child.cancel()
         self.requestInterruption()
 
 
-class OutputMedia(QThread):
-    """
-    导出语音消息
-    """
-    okSingal = pyqtSignal(int)
-    progressSignal = pyqtSignal(int)
-
-    def __init__(self, contact, time_range=None):
-        super().__init__()
-        self.contact = contact
-        self.time_range = time_range
-
-    def run(self):
-        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        messages = msg_db.get_messages_by_type(self.contact.wxid, 34, time_range=self.time_range)
-        for message in messages:
-            is_send = message[4]
-            msgSvrId = message[9]
-            try:
-                audio_path = media_msg_db.get_audio(msgSvrId, output_path=origin_path + "/voice")
-            except:
-                logger.error(traceback.format_exc())
-            finally:
-                self.progressSignal.emit(1)
-        self.okSingal.emit(34)
-
-
-class OutputEmoji(QThread):
-    """
-    导出表情包
-    """
-    okSingal = pyqtSignal(int)
-    progressSignal = pyqtSignal(int)
-
-    def __init__(self, contact, time_range=None):
-        super().__init__()
-        self.contact = contact
-        self.time_range = time_range
-
-    def run(self):
-        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        messages = msg_db.get_messages_by_type(self.contact.wxid, 47, time_range=self.time_range)
-        for message in messages:
-            str_content = message[7]
-            try:
-                pass
-                # emoji_path = get_emoji(str_content, thumb=True, output_path=origin_path + '/emoji')
-            except:
-                logger.error(traceback.format_exc())
-            finally:
-                self.progressSignal.emit(1)
-        self.okSingal.emit(47)
-
-
-class OutputImage(QThread):
-    """
-    导出图片
-    """
-    okSingal = pyqtSignal(int)
-    progressSignal = pyqtSignal(int)
-
-    def __init__(self, contact, time_range):
-        super().__init__()
-        self.contact = contact
-        self.child_thread_num = 2
-        self.time_range = time_range
-        self.child_threads = [0] * (self.child_thread_num + 1)
-        self.num = 0
-
-    def count1(self, num):
-        self.num += 1
-        print('图片导出完成一个')
-        if self.num == self.child_thread_num:
-            self.okSingal.emit(47)
-            print('图片导出完成')
-
-    def run(self):
-        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        messages = msg_db.get_messages_by_type(self.contact.wxid, 3, time_range=self.time_range)
-        base_path = os.path.join(OUTPUT_DIR, '聊天记录', self.contact.remark, 'image')
-        for message in messages:
-            str_content = message[7]
-            BytesExtra = message[10]
-            timestamp = message[5]
-            try:
-                image_path = hard_link_db.get_image(str_content, BytesExtra, up_dir=Me().wx_dir, thumb=False)
-                image_path = get_image(image_path, base_path=base_path)
-                try:
-                    os.utime(origin_path + image_path[1:], (timestamp, timestamp))
-                except:
-                    pass
-            except:
-                logger.error(traceback.format_exc())
-            finally:
-                self.progressSignal.emit(1)
-        self.okSingal.emit(47)
-
-
-class OutputImageChild(QThread):
-    okSingal = pyqtSignal(int)
-    progressSignal = pyqtSignal(int)
-
-    def __init__(self, contact, messages, time_range):
-        super().__init__()
-        self.contact = contact
-        self.messages = messages
-        self.time_range = time_range
-
-    def run(self):
-        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        for message in self.messages:
-            str_content = message[7]
-            BytesExtra = message[10]
-            timestamp = message[5]
-            try:
-                image_path = hard_link_db.get_image(str_content, BytesExtra, thumb=False)
-                if not os.path.exists(os.path.join(Me().wx_dir, image_path)):
-                    image_thumb_path = hard_link_db.get_image(str_content, BytesExtra, thumb=True)
-                    if not os.path.exists(os.path.join(Me().wx_dir, image_thumb_path)):
-                        continue
-                    image_path = image_thumb_path
-                image_path = get_image(image_path, base_path=f'/data/聊天记录/{self.contact.remark}/image')
-                try:
-                    os.utime(origin_path + image_path[1:], (timestamp, timestamp))
-                except:
-                    pass
-            except:
-                logger.error(traceback.format_exc())
-            finally:
-                self.progressSignal.emit(1)
-        self.okSingal.emit(47)
-        print('图片子线程完成')
-
-
 if __name__ == "__main__":
     pass
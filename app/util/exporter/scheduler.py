@@ -0,0 +1,104 @@
+"""
+批量导出的任务调度
+所有任务排在一个队列里，最多workers个同时执行，不再是每个(联系人, 格式)一个线程同时启动
+任务按预估工作量（消息数）从大到小开始：最大的任务最先开始，最后只剩小任务收尾，整体结束得最早
+进度按工作量加权汇总，并根据已完成的工作量估算剩余时间
+"""
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from app.config import EXPORT_PROCESS_WORKERS, EXPORT_WORKERS
+from app.log import logger
+
+
+class ExportJob:
+    def __init__(self, name, func, args=(), weight=1, process=False):
+        """
+        @param name: 任务名，进度回调里显示
+        @param func: 任务函数，返回值放在result里
+        @param args: 任务参数
+        @param weight: 预估工作量（一般是消息数），决定执行顺序和进度占比
+        @param process: 是否放到进程池里执行（CPU密集的任务），func和args必须能pickle
+        """
+        self.name = name
+        self.func = func
+        self.args = args
+        self.weight = max(weight, 1)
+        self.process = process
+        self.result = None
+        self.error = None
+
+
+class ExportScheduler:
+    """
+    progress(已完成工作量, 总工作量, 预计剩余秒数, 刚完成的任务)在调用run的线程里回调
+    """
+
+    def __init__(self, workers=EXPORT_WORKERS, process_workers=EXPORT_PROCESS_WORKERS, progress=None):
+        self.workers = workers
+        self.process_workers = process_workers
+        self.progress = progress
+        self.jobs = []
+        self.cancelled = False
+
+    def add(self, name, func, args=(), weight=1, process=False) -> ExportJob:
+        job = ExportJob(name, func, args, weight, process)
+        self.jobs.append(job)
+        return job
+
+    def cancel(self):
+        """
+        不再开始新的任务，已经开始的任务会执行完
+        """
+        self.cancelled = True
+
+    def run(self) -> list:
+        """
+        执行所有任务，全部结束后返回
+        @return: 所有任务，出错的任务error为异常信息
+        """
+        jobs = sorted(self.jobs, key=lambda job: job.weight, reverse=True)
+        total = sum(job.weight for job in jobs)
+        done = 0
+        start = time.time()
+        thread_pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='Export')
+        process_pool = None
+        if any(job.process for job in jobs):
+            process_pool = ProcessPoolExecutor(max_workers=self.process_workers)
+        try:
+            # 执行器按提交顺序从队列里取任务，提交的只是任务描述，内存不随任务数增长
+            futures = {}
+            for job in jobs:
+                pool = process_pool if job.process else thread_pool
+                futures[pool.submit(job.func, *job.args)] = job
+            while futures:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job = futures.pop(future)
+                    if future.cancelled():
+                        continue
+                    try:
+                        job.result = future.result()
+                    except BrokenProcessPool:
+                        # 起不了子进程（例如打包后没有调用freeze_support），退回线程里执行
+                        if not self.cancelled:
+                            futures[thread_pool.submit(job.func, *job.args)] = job
+                        continue
+                    except Exception:
+                        job.error = traceback.format_exc()
+                        logger.error(f'导出出错 {job.name}:\n{job.error}')
+                    done += job.weight
+                    elapsed = time.time() - start
+                    eta = elapsed / done * (total - done)
+                    if self.progress:
+                        self.progress(done, total, eta, job)
+                if self.cancelled:
+                    for pending in futures:
+                        pending.cancel()
+        finally:
+            thread_pool.shutdown(wait=True)
+            if process_pool:
+                process_pool.shutdown(wait=True)
+        return jobs
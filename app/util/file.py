@@ -1,10 +1,10 @@
 import os
 import traceback
-import shutil
 
 import requests
 
 from app.log import log, logger
+from app.util import media_store
 from app.util.protocbuf.msg_pb2 import MessageBytesExtra
 from ..person import Me
 
@@ -49,7 +49,7 @@ def get_file(bytes_extra, file_name, output_path=root_path) -> str:
                     if real_path != "":
                         if os.path.exists(real_path):
                             print('开始获取文件' + real_path)
-                            shutil.copy2(real_path, file_path)
+                            media_store.copy(real_path, file_path)
                         else:
                             print('文件' + file_original_path + '已丢失')
                             file_path = ''
@@ -1,8 +1,11 @@
 import os
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from app.config import IMAGE_DECODE_WORKERS
 from app.log import logger
 from app.person import Me
+from app.util import media_store
 
 # 图片字节头信息，
 # [0][1]为jpg头信息，
@@ -11,6 +14,8 @@ from app.person import Me
 pic_head = [0xff, 0xd8, 0x89, 0x50, 0x47, 0x49]
 # 解密码
 decode_code = 0
+# 每个解密码对应一张异或查找表，bytes.translate整块解密，不再逐字节循环
+xor_tables = [bytes(byte ^ code for byte in range(256)) for code in range(256)]
 
 
 def get_code(dat_read) -> tuple[int, int]:
@@ -39,18 +44,20 @@ def get_code(dat_read) -> tuple[int, int]:
         return -1, -1
 
 
-def decode_dat(file_path, out_path) -> str:
+def decode_dat(file_path, out_path, timestamp=None) -> str:
     """
     解密文件，并生成图片
     :param file_path: dat文件路径
-    :return: 无
+    :param out_path: 输出文件夹
+    :param timestamp: 图片的修改时间，默认不修改
+    :return: 图片路径，不是图片返回空字符串，dat文件不存在返回None
     """
     if not os.path.exists(file_path):
         return None
     with open(file_path, 'rb') as file_in:
-        data = file_in.read()
+        head = file_in.read(2)
 
-    file_type, decode_code = get_code(data[:2])
+    file_type, decode_code = get_code(head)
     if decode_code == -1:
         return ''
 
@@ -64,16 +71,61 @@ def decode_dat(file_path, out_path) -> str:
     else:
         pic_name = filename[:-4] + ".jpg"
     file_outpath = os.path.join(out_path, pic_name)
-    if os.path.exists(file_outpath):
-        return file_outpath
 
-    # 对数据进行异或加密/解密
-    with open(file_outpath, 'wb') as file_out:
-        file_out.write(bytes([byte ^ decode_code for byte in data]))
-    print(file_path, '->', file_outpath)
+    def decode(path):
+        with open(file_path, 'rb') as file_in:
+            data = file_in.read()
+        # 对数据进行异或加密/解密
+        with open(path, 'wb') as file_out:
+            file_out.write(data.translate(xor_tables[decode_code]))
+
+    # 解密过的图片从媒体库链接过来，不用再解密
+    # 要改修改时间时拷贝一份，硬链接共用同一个inode，改了会影响库里和其他消息、其他导出的同一张图片
+    private = bool(timestamp)
+    media_store.fetch(media_store.source_key(file_path), file_outpath, decode, private=private)
+    if private and os.path.exists(file_outpath) and os.stat(file_outpath).st_nlink == 1:
+        os.utime(file_outpath, (timestamp, timestamp))
     return file_outpath
 
 
+def decode_dat_files(tasks, workers=IMAGE_DECODE_WORKERS, progress=None, is_cancelled=None) -> list:
+    """
+    批量解密图片，读写文件时线程不占GIL，多个线程同时解密，速度取决于磁盘
+    :param tasks: [(dat文件路径, 输出文件夹, 修改时间或None), ...]
+    :param workers: 线程数
+    :param progress: 进度回调 progress(已完成数, 总数)，在调用线程里执行
+    :param is_cancelled: 返回True时不再开始新的解密
+    :return: 和tasks一一对应的decode_dat返回值，出错的为None
+    """
+    results = [None] * len(tasks)
+    # 同一张图片只解密一次，相同的任务共用结果
+    unique = {}
+    for index, task in enumerate(tasks):
+        unique.setdefault((task[0], task[1]), []).append(index)
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ImageDecoder') as executor:
+        futures = {}
+        for (file_path, out_path), indexes in unique.items():
+            timestamp = max((tasks[index][2] or 0) for index in indexes) or None
+            futures[executor.submit(decode_dat, file_path, out_path, timestamp)] = indexes
+        for future in as_completed(futures):
+            indexes = futures[future]
+            try:
+                result = future.result()
+            except OSError:
+                logger.error(f'image解密发生了错误:\n\n{traceback.format_exc()}')
+                result = None
+            for index in indexes:
+                results[index] = result
+            done += len(indexes)
+            if progress:
+                progress(done, len(tasks))
+            if is_cancelled and is_cancelled():
+                executor.shutdown(wait=True, cancel_futures=True)
+                break
+    return results
+
+
 def decode_dat_path(file_path, out_path) -> str:
     """
     解密文件，并生成图片
@@ -0,0 +1,210 @@
+"""
+导出用的共享媒体库
+图片、表情包、头像、文件、语音按内容的md5存一份在MEDIA_STORE_DIR/objects里，各联系人的导出文件夹里只放指向它的硬链接
+（不支持硬链接时拷贝），同一个文件在多个联系人、多次导出里只解密、下载、拷贝一次
+清单（manifest.db）记录 来源 -> 内容，来源可以是源文件（路径、大小、修改时间）、消息里的md5等，重复导出时查到就直接链接
+硬链接和库里的文件是同一个文件，修改导出文件夹里的文件会影响其他导出，要单独修改（例如改修改时间）的文件用private拷贝
+"""
+import errno
+import filecmp
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+
+from app.config import MEDIA_STORE_DIR
+from app.log import logger
+
+_local = threading.local()
+_link_supported = True
+# 只有这些错误说明这个文件系统不能建硬链接，其他错误（磁盘满、权限、文件被占用）不影响之后的链接
+_LINK_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP}
+
+
+def _connect() -> sqlite3.Connection:
+    # 每个线程、每个进程各用一个连接，多个导出进程通过SQLite的文件锁共用清单
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        os.makedirs(os.path.join(MEDIA_STORE_DIR, 'objects'), exist_ok=True)
+        conn = sqlite3.connect(os.path.join(MEDIA_STORE_DIR, 'manifest.db'), timeout=30)
+        # 清单丢了只是要重新生成文件，不需要每次提交都等磁盘同步
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS media (key TEXT PRIMARY KEY, object TEXT NOT NULL)')
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+def file_digest(path) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def source_key(path) -> str:
+    """
+    源文件的清单key，文件变了（大小或修改时间不同）key也不同
+    """
+    stat = os.stat(path)
+    return f'file:{os.path.normcase(os.path.abspath(path))}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def link(src, dst):
+    """
+    在dst建立指向src的硬链接，不支持时拷贝
+    """
+    global _link_supported
+    if _link_supported:
+        try:
+            os.link(src, dst)
+            return
+        except FileExistsError:
+            raise
+        except OSError as e:
+            if e.errno not in _LINK_UNSUPPORTED:
+                raise
+            # 跨盘、FAT32等，之后都直接拷贝
+            _link_supported = False
+        except (NotImplementedError, AttributeError):
+            _link_supported = False
+    shutil.copy2(src, dst)
+
+
+def _copy_new(src, dst):
+    """
+    拷贝到dst，dst已经存在时抛出FileExistsError（先拷到临时文件，不会留下写了一半的dst）
+    """
+    tmp_path = f'{dst}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        shutil.copy2(src, tmp_path)
+        if os.path.exists(dst):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+        os.replace(tmp_path, dst)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get(key) -> str | None:
+    """
+    @param key: 来源
+    @return: 库里的文件路径，没有记录或文件已被删除返回None
+    """
+    row = _connect().execute('SELECT object FROM media WHERE key=?', (key,)).fetchone()
+    if not row:
+        return None
+    path = os.path.join(MEDIA_STORE_DIR, 'objects', row[0])
+    return path if os.path.exists(path) else None
+
+
+def add(key, path, private=False) -> str:
+    """
+    把已经生成好的文件放进库里并记录来源，path本身不动
+    @param key: 来源
+    @param path: 文件路径
+    @param private: path之后还要单独修改，库里放一份拷贝，也不把path换成链接
+    @return: 库里的文件路径
+    """
+    name = file_digest(path) + os.path.splitext(path)[1].lower()
+    obj = os.path.join(MEDIA_STORE_DIR, 'objects', name)
+    if not os.path.exists(obj):
+        try:
+            if private:
+                _copy_new(path, obj)
+            else:
+                link(path, obj)
+        except FileExistsError:
+            # 其他线程、进程刚放进来同样的内容
+            pass
+    elif not private and _link_supported and not os.path.samefile(obj, path):
+        # 内容相同的文件（例如转发的图片）换成指向库里同一个文件的链接，省磁盘空间
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.link(obj, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    conn = _connect()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO media (key, object) VALUES (?, ?)', (key, name))
+    return obj
+
+
+def fetch(key, dst, produce, private=False) -> bool:
+    """
+    库里有key就链接到dst，没有就调用produce(dst)生成，再放进库里
+    @param key: 来源
+    @param dst: 导出文件夹里的路径，已经存在时不处理
+    @param produce: produce(dst)，生成文件
+    @param private: dst之后还要单独修改（例如修改时间），拷贝而不是链接，不和库里、其他导出共用一个文件
+    @return: dst是否存在
+    """
+    if os.path.exists(dst):
+        return True
+    try:
+        obj = get(key)
+        if obj:
+            if private:
+                _copy_new(obj, dst)
+            else:
+                link(obj, dst)
+            return True
+    except FileExistsError:
+        return True
+    except (OSError, sqlite3.Error):
+        logger.error(f'媒体库读取失败 {key}', exc_info=True)
+    produce(dst)
+    if not os.path.exists(dst):
+        return False
+    try:
+        add(key, dst, private)
+    except (OSError, sqlite3.Error):
+        logger.error(f'媒体库写入失败 {key}', exc_info=True)
+    return True
+
+
+def copy(src, dst, private=False) -> bool:
+    """
+    代替shutil.copy2，同一个源文件只拷贝一次
+    @param src: 源文件
+    @param dst: 目标文件路径（不能是文件夹）
+    @param private: 同fetch，dst之后要单独修改时传True
+    @return: 是否成功
+    """
+    return fetch(source_key(src), dst, lambda path: shutil.copy2(src, path), private=private)
+
+
+def set_mtime(path, timestamp):
+    """
+    修改导出文件的修改时间；path是指向库里的硬链接时先换成单独的拷贝，不影响库里和其他导出的同一个文件
+    @param path: 导出文件夹里的文件
+    @param timestamp: 修改时间（秒）
+    """
+    if os.stat(path).st_nlink > 1:
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            shutil.copy2(path, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    os.utime(path, (timestamp, timestamp))
+
+
+def sync(src, dst) -> bool:
+    """
+    让dst和src内容一致，内容不同时替换（用于每次导出都要带上的资源文件）
+    @param src: 源文件
+    @param dst: 目标文件路径
+    """
+    if os.path.exists(dst):
+        # 硬链接或copy2得到的文件大小、修改时间和源文件相同，不用比较内容
+        if filecmp.cmp(src, dst):
+            return True
+        os.remove(dst)
+    return copy(src, dst)
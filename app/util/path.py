@@ -1,5 +1,9 @@
 import os
-import winreg
+
+try:
+    import winreg
+except ImportError:  # 非Windows系统，读注册表的地方都有兜底
+    winreg = None
 
 from app.person import Me
 from app.util import image
@@ -0,0 +1,205 @@
+"""
+MSG表BytesExtra字段的快速解析
+BytesExtra是MessageBytesExtra（见msg.proto），大部分地方只需要message2里field1为1（发送人wxid）、
+3（缩略图路径）、4（原图/文件路径）的field2，这里直接扫描protobuf的wire format，不构造完整的消息对象
+解析失败时退回到MessageBytesExtra().ParseFromString()
+"""
+from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+
+SENDER = 1  # 群聊消息发送人wxid
+THUMB = 3  # 缩略图路径（音视频通话里是通话类型）
+ORIGINAL = 4  # 原图/视频/文件路径（音视频通话里是通话时长）
+
+_MESSAGE2_TAG = (3 << 3) | 2  # message2: field 3, length-delimited
+# 出现多次时取最后一个的field1，和原来遍历message2时不断覆盖发送人的结果一致
+_LAST_WINS = frozenset((SENDER,))
+
+
+def _varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise ValueError('varint too long')
+
+
+def _keep(result, key, value):
+    if key in _LAST_WINS or key not in result:
+        result[key] = value
+
+
+def _scan(data, fields):
+    result = {}
+    # 要的字段里有取最后一个的，就得扫到末尾
+    stop_early = fields is not None and not _LAST_WINS.intersection(fields)
+    pos = 0
+    end = len(data)
+    while pos < end:
+        tag = data[pos]
+        if tag & 0x80:
+            tag, pos = _varint(data, pos)
+        else:
+            pos += 1
+        wire_type = tag & 7
+        if wire_type == 2:
+            length = data[pos]
+            if length & 0x80:
+                length, pos = _varint(data, pos)
+            else:
+                pos += 1
+            next_pos = pos + length
+            if next_pos > end:
+                raise ValueError('truncated field')
+            if tag == _MESSAGE2_TAG:
+                key, value = _scan_message2(data, pos, next_pos)
+                if fields is None or key in fields:
+                    _keep(result, key, value)
+                    if stop_early and len(result) == len(fields):
+                        return result
+            pos = next_pos
+        elif wire_type == 0:
+            _, pos = _varint(data, pos)
+        elif wire_type == 5:
+            pos += 4
+        elif wire_type == 1:
+            pos += 8
+        else:
+            raise ValueError(f'unsupported wire type {wire_type}')
+    if pos != end:
+        raise ValueError('truncated field')
+    return result
+
+
+def _scan_message2(data, pos, end):
+    key = 0
+    value = ''
+    while pos < end:
+        tag = data[pos]
+        if tag & 0x80:
+            tag, pos = _varint(data, pos)
+        else:
+            pos += 1
+        wire_type = tag & 7
+        if tag == 0x08:  # field1 int32
+            key, pos = _varint(data, pos)
+            if key >= 1 << 63:
+                key -= 1 << 64
+        elif wire_type == 2:
+            length, pos = _varint(data, pos)
+            if pos + length > end:
+                raise ValueError('truncated field')
+            if tag == 0x12:  # field2 string
+                value = data[pos:pos + length].decode('utf-8')
+            pos += length
+        elif wire_type == 0:
+            _, pos = _varint(data, pos)
+        elif wire_type == 5:
+            pos += 4
+        elif wire_type == 1:
+            pos += 8
+        else:
+            raise ValueError(f'unsupported wire type {wire_type}')
+    if pos != end:
+        raise ValueError('truncated field')
+    return key, value
+
+
+def _parse_protobuf(data, fields):
+    msg_bytes = MessageBytesExtra()
+    msg_bytes.ParseFromString(data)
+    result = {}
+    for tmp in msg_bytes.message2:
+        if fields is None or tmp.field1 in fields:
+            _keep(result, tmp.field1, tmp.field2)
+    return result
+
+
+def decode_bytes_extra(data, fields=(SENDER, THUMB, ORIGINAL)) -> dict:
+    """
+    解析BytesExtra里message2的内容
+    @param data: BytesExtra
+    @param fields: 需要的field1，None表示全部；不包括发送人时全部找到后就停止扫描
+    @return: {field1: field2}，同一个field1出现多次时发送人取最后一个，其他取第一个
+    """
+    if not data:
+        return {}
+    try:
+        return _scan(data, fields)
+    except (IndexError, ValueError):
+        # 格式不对（包括utf-8解码失败）就交给protobuf处理，由它决定是否报错
+        return _parse_protobuf(data, fields)
+
+
+def decode_bytes_extra_batch(blobs, fields=(SENDER, THUMB, ORIGINAL)) -> list:
+    """
+    批量解析BytesExtra
+    @param blobs: BytesExtra列表，可以包含None
+    @param fields: 同decode_bytes_extra
+    @return: 和blobs一一对应的dict列表
+    """
+    return [decode_bytes_extra(data, fields) for data in blobs]
+
+
+def get_sender_wxid(data) -> str:
+    """
+    群聊消息发送人的wxid，没有返回空字符串
+    """
+    return decode_bytes_extra(data, (SENDER,)).get(SENDER, '')
+
+
+def get_sender_wxids(blobs) -> list:
+    """
+    批量获取群聊消息发送人的wxid
+    """
+    return [get_sender_wxid(data) for data in blobs]
+
+
+def benchmark(blobs, repeat=5):
+    """
+    和MessageBytesExtra().ParseFromString()对比解析发送人的耗时
+    @param blobs: BytesExtra列表
+    @param repeat: 重复次数，取最快的一次
+    @return: {'protobuf': 秒, 'fast': 秒, 'num': 条数}
+    """
+    import timeit
+
+    def protobuf_sender():
+        for data in blobs:
+            msg_bytes = MessageBytesExtra()
+            msg_bytes.ParseFromString(data)
+            wxid = ''
+            for tmp in msg_bytes.message2:
+                if tmp.field1 != 1:
+                    continue
+                wxid = tmp.field2
+
+    def fast_sender():
+        get_sender_wxids(blobs)
+
+    return {
+        'protobuf': min(timeit.repeat(protobuf_sender, number=1, repeat=repeat)),
+        'fast': min(timeit.repeat(fast_sender, number=1, repeat=repeat)),
+        'num': len(blobs),
+    }
+
+
+if __name__ == '__main__':
+    import sqlite3
+    import sys
+
+    db_path = sys.argv[1] if len(sys.argv) > 1 else './app/Database/Msg/MSG.db'
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute(
+        "SELECT BytesExtra FROM MSG WHERE StrTalker LIKE '%@chatroom' AND IsSender=0 AND BytesExtra IS NOT NULL LIMIT 200000"
+    ).fetchall()
+    conn.close()
+    blobs = [row[0] for row in rows]
+    mismatch = sum(1 for data in blobs if get_sender_wxid(data) != _parse_protobuf(data, (SENDER,)).get(SENDER, ''))
+    res = benchmark(blobs)
+    print(f"{res['num']}条 protobuf: {res['protobuf']:.3f}s fast: {res['fast']:.3f}s 不一致: {mismatch}")
@@ -0,0 +1,44 @@
+"""
+用Windows DPAPI保护要保存到磁盘上的密钥
+加密结果只能由同一台电脑上的同一个Windows用户解开，拷走info.json也拿不到数据库密钥
+不是Windows或者没有pywin32时不保存，调用方每次重新获取密钥
+"""
+import base64
+
+from app.log import logger
+
+_DESCRIPTION = 'MemoTrace database key'
+
+
+def protect(text: str) -> str | None:
+    """
+    @param text: 要保存的密钥
+    @return: base64编码的DPAPI密文，不支持时返回None
+    """
+    try:
+        import win32crypt
+    except ImportError:
+        return None
+    try:
+        blob = win32crypt.CryptProtectData(text.encode('utf-8'), _DESCRIPTION, None, None, None, 0)
+    except Exception:
+        logger.error('DPAPI加密失败', exc_info=True)
+        return None
+    return base64.b64encode(blob).decode('ascii')
+
+
+def unprotect(data: str) -> str | None:
+    """
+    @param data: protect的返回值
+    @return: 密钥，解不开（换了电脑、换了用户、不是Windows）时返回None
+    """
+    try:
+        import win32crypt
+    except ImportError:
+        return None
+    try:
+        _, text = win32crypt.CryptUnprotectData(base64.b64decode(data), None, None, None, 0)
+    except Exception:
+        logger.error('DPAPI解密失败', exc_info=True)
+        return None
+    return text.decode('utf-8')
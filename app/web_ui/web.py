@@ -259,6 +259,27 @@ def get_wordcloud():
     return jsonify(world_cloud_data)
 
 
+@app.route('/search', methods=['POST'])
+def search():
+    wxid = request.json.get('wxid')
+    query = request.json.get('query', '')
+    time_range = request.json.get('time_range') or None
+    offset = request.json.get('offset', 0)
+    messages = msg_db.search_messages(query, talker=wxid, time_range=time_range, offset=offset)
+    return jsonify([
+        {
+            'localId': message[0],
+            'talker': message[1],
+            'is_send': message[4],
+            'timestamp': message[5],
+            'str_time': message[6],
+            'text': message[7],
+            'snippet': message[8],
+        }
+        for message in messages
+    ])
+
+
 @app.route('/charts/<wxid>')
 def charts(wxid):
     # 渲染模板，并传递图表的 HTML 到模板中
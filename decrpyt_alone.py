@@ -1,7 +1,7 @@
 import os
 import json
-from app.decrypt import get_wx_info, decrypt
-from app.DataBase.merge import merge_databases, merge_MediaMSG_databases
+from app.decrypt import get_wx_info
+from app.decrypt.ingest import collect_decrypt_tasks, ingest
 from app.config import DB_DIR
 
 def load_version_list():
@@ -63,66 +63,39 @@ def decrypt_database():
         print(f"微信数据目录不存在: {wx_dir}")
         return
         
-    # 2. 解密数据库文件
+    # 2. 找出要解密的数据库文件
     os.makedirs(DB_DIR, exist_ok=True)
-    tasks = []
-    
-    for root, dirs, files in os.walk(os.path.join(wx_dir, 'Msg')):
-        for file in files:
-            if file.endswith('.db'):
-                if file == 'xInfo.db':
-                    continue
-                inpath = os.path.join(root, file)
-                output_path = os.path.join(DB_DIR, file)
-                tasks.append([key, inpath, output_path])
-            else:
-                try:
-                    name, suffix = file.split('.')
-                    if suffix.startswith('db_SQLITE'):
-                        inpath = os.path.join(root, file)
-                        output_path = os.path.join(DB_DIR, name + '.db')
-                        tasks.append([key, inpath, output_path])
-                except:
-                    continue
+    tasks = collect_decrypt_tasks(key, os.path.join(wx_dir, 'Msg'), DB_DIR)
+
+    # 3. 解密并合并数据库，MSG分库解密完一个就合并一个
+    def progress(fraction, message):
+        print(f"\r{fraction:.0%} {message}".ljust(60), end='', flush=True)
 
-    # 3. 执行解密
+    try:
+        result = ingest(tasks, DB_DIR, progress=progress)
+    except Exception as e:
+        print(f"\n处理数据库时出错: {str(e)}")
+        return
+    print()
     success_count = 0
-    for task in tasks:
-        success, msg = decrypt.decrypt(*task)
+    for task, (success, msg) in zip(tasks, result['decrypt']):
         if success:
             success_count += 1
             print(f"解密成功: {os.path.basename(task[1])}")
         else:
             print(f"解密失败: {os.path.basename(task[1])} - {msg}")
-    
+
     if success_count == 0:
         print("没有成功解密任何文件")
         return
-        
-    # 4. 合并数据库
-    try:
-        target_database = os.path.join(DB_DIR, 'MSG.db')
-        source_databases = [os.path.join(DB_DIR, f"MSG{i}.db") for i in range(1, 50)]
-        
-        if os.path.exists(target_database):
-            os.remove(target_database)
-            
-        import shutil
-        shutil.copy2(os.path.join(DB_DIR, 'MSG0.db'), target_database)
-        merge_databases(source_databases, target_database)
-        
-        # 5. 合并语音消息数据库
-        target_database = os.path.join(DB_DIR, 'MediaMSG.db')
-        if os.path.exists(target_database):
-            os.remove(target_database)
-            
-        source_databases = [os.path.join(DB_DIR, f"MediaMSG{i}.db") for i in range(1, 50)]
-        shutil.copy2(os.path.join(DB_DIR, 'MediaMSG0.db'), target_database)
-        merge_MediaMSG_databases(source_databases, target_database)
-        
-        print("数据库合并完成!")
-    except Exception as e:
-        print(f"合并数据库时出错: {str(e)}")
+    if result['error']:
+        print(f"合并数据库时出错: {result['error']}")
+        return
+    print("数据库合并完成!")
+
 
 if __name__ == "__main__":
+    import multiprocessing
+
+    multiprocessing.freeze_support()
     decrypt_database()
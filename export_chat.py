@@ -1,10 +1,9 @@
 import os
 from app.DataBase import msg_db, micro_msg_db
-from app.person_lite import Contact
-from app.util.exporter.exporter_txt import TxtExporter
-from app.util.exporter.exporter_json import JsonExporter
-from app.util.exporter.exporter_html import HtmlExporter
-from app.util.exporter.exporter_csv import CSVExporter
+from app.person import Contact
+from app.util.protocbuf.bytes_extra import get_sender_wxid
+from app.util.exporter.exporter import ExporterBase
+from app.util.exporter.export_job import export_contact
 from app.util.exporter.simple_txt_exporter import SimpleTxtExporter
 import json
 
@@ -54,8 +53,9 @@ def get_chatroom_list():
             WHERE ChatRoomName IS NOT NULL 
             ORDER BY ChatRoomName
         '''
-        micro_msg_db.cursor.execute(sql)
-        chatrooms = micro_msg_db.cursor.fetchall()
+        with micro_msg_db.pool.cursor() as cursor:
+            cursor.execute(sql)
+            chatrooms = cursor.fetchall()
     except Exception as e:
         print(f"Error querying database: {e}")
         return []
@@ -81,7 +81,7 @@ def export_chat_history(chatroom_id: str, export_path: str, export_format: str =
     导出指定群组的聊天记录
     :param chatroom_id: 群组ID
     :param export_path: 导出路径
-    :param export_format: 导出格式(txt/json/html/csv)
+    :param export_format: 导出格式(txt/json/html/csv/docx)
     :param message_types: 要导出的消息类型，默认只导出文本和系统消息
     :param time_range: 时间范围元组 (start_time, end_time)，支持时间戳、'YYYY-MM-DD HH:MM:SS'格式字符串、date对象
     """
@@ -122,19 +122,23 @@ def export_chat_history(chatroom_id: str, export_path: str, export_format: str =
     export_dir = os.path.join(export_path, '聊天记录', contact.remark)
     os.makedirs(export_dir, exist_ok=True)
 
-    # 5. 根据格式选择导出器
+    # 5. 根据格式选择导出器，txt用下面带群昵称的SimpleTxtExporter，其他格式和界面用同一套导出器
     exporters = {
-        "txt": TxtExporter,
-        "json": JsonExporter,
-        "html": HtmlExporter,
-        "csv": CSVExporter
+        "txt": ExporterBase.TXT,
+        "json": ExporterBase.JSON,
+        "html": ExporterBase.HTML,
+        "csv": ExporterBase.CSV,
+        "docx": ExporterBase.DOCX,
     }
     
     if export_format not in exporters:
         raise ValueError(f"Unsupported format: {export_format}")
-        
-    exporter_class = exporters[export_format]
-    exporter = exporter_class(contact, message_types=message_types)
+
+    if export_format != "txt":
+        print(f"开始导出 {export_format.upper()} 格式聊天记录: {contact.remark}")
+        export_dir = export_contact(contact, exporters[export_format], message_types, time_range=time_range)
+        print(f"导出完成，文件保存在: {export_dir}")
+        return export_dir
 
     # 6. 构建SQL查询获取消息
     sql_messages = '''
@@ -176,63 +180,42 @@ def export_chat_history(chatroom_id: str, export_path: str, export_format: str =
     
     # 7. 执行查询获取消息
     try:
-        msg_db.cursor.execute(sql_messages, params)
-        messages = msg_db.cursor.fetchall()
+        with msg_db.pool.cursor() as cursor:
+            cursor.execute(sql_messages, params)
+            messages = cursor.fetchall()
         
         # 8. 处理发送者信息
+        # 群昵称在RoomData里，整个群只解析一次
+        room_display_names = {}
+        if chatroom_info[1]:
+            try:
+                from app.util.protocbuf.roomdata_pb2 import ChatRoomData
+                room_data = ChatRoomData()
+                room_data.ParseFromString(chatroom_info[1])
+                for member in room_data.members:
+                    room_display_names.setdefault(member.wxID, member.displayName if member.displayName else '')
+            except Exception as e:
+                print(f"Error decoding room data: {e}")
+
         processed_messages = []
         for msg in messages:
             if not msg[4] and msg[10]:  # 如果不是自己发送的且有BytesExtra
                 try:
                     # 从BytesExtra中解析发送者wxid
-                    from app.util.protocbuf.msg_pb2 import MessageBytesExtra
-                    msgbytes = MessageBytesExtra()
-                    msgbytes.ParseFromString(msg[10])
-                    sender_wxid = None
-                    for tmp in msgbytes.message2:
-                        if tmp.field1 == 1:
-                            sender_wxid = tmp.field2
-                            break
+                    sender_wxid = get_sender_wxid(msg[10])
                     
                     if sender_wxid:
-                        # 从ChatRoom表获取群成员信息
-                        sql_room = '''
-                            SELECT RoomData
-                            FROM ChatRoom 
-                            WHERE ChatRoomName=?
-                        '''
-                        micro_msg_db.cursor.execute(sql_room, [chatroom_id])
-                        room_info = micro_msg_db.cursor.fetchone()
-                        
-                        room_display_name = ''
-                        if room_info and room_info[0]:
-                            try:
-                                from app.util.protocbuf.roomdata_pb2 import ChatRoomData
-                                room_data = ChatRoomData()
-                                room_data.ParseFromString(room_info[0])
-                                # 在members中查找对应wxid的群昵称
-                                for member in room_data.members:
-                                    if member.wxID == sender_wxid:
-                                        room_display_name = member.displayName if member.displayName else ''
-                                        break
-                            except Exception as e:
-                                print(f"Error decoding room data: {e}")
-                        
-                        # 从Contact表获取用户基本信息
-                        sql_contact = '''
-                            SELECT UserName, Remark, NickName, Alias
-                            FROM Contact 
-                            WHERE UserName=?
-                        '''
-                        micro_msg_db.cursor.execute(sql_contact, [sender_wxid])
-                        contact_info = micro_msg_db.cursor.fetchone()
-                        
+                        room_display_name = room_display_names.get(sender_wxid, '')
+
+                        # 从联系人目录获取用户基本信息
+                        contact_info = micro_msg_db.get_contact_by_username(sender_wxid)
+
                         if contact_info:
                             sender_info = {
                                 'wxid': contact_info[0],
-                                'remark': contact_info[1] or '',
-                                'nickname': contact_info[2] or '',
-                                'alias': contact_info[3] or '',
+                                'remark': contact_info[3] or '',
+                                'nickname': contact_info[4] or '',
+                                'alias': contact_info[1] or '',
                                 'room_display_name': room_display_name
                             }
                             # 将消息元组转换为列表以便修改
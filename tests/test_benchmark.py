@@ -0,0 +1,35 @@
+import random
+import unittest
+
+from app.decrypt.benchmark import BASE_TIME, _contacts, _msg_rows
+from app.util.compress_content import decompress_CompressContent, parser_reply, share_card
+from app.util.protocbuf.bytes_extra import get_sender_wxid
+
+
+class SyntheticMessageTest(unittest.TestCase):
+    def test_rows_parse_like_real_messages(self):
+        """
+        合成的CompressContent能解压、解析，群聊里别人发的消息能取到发送人
+        """
+        contacts = _contacts(100)
+        rows = list(_msg_rows(random.Random(0), contacts, 2000, BASE_TIME, []))
+        chatroom_rows = 0
+        for svr_id, type_, sub_type, is_sender, _, _, talker, _, _, compress_content, bytes_extra in rows:
+            sender = get_sender_wxid(bytes_extra)
+            if talker.endswith('@chatroom') and not is_sender:
+                chatroom_rows += 1
+                self.assertIn(sender, contacts)
+            else:
+                self.assertEqual(sender, '')
+            if type_ != 49:
+                continue
+            self.assertTrue(decompress_CompressContent(compress_content).startswith('<?xml'))
+            if sub_type == 57:
+                self.assertFalse(parser_reply(compress_content)['is_error'])
+            elif sub_type == 5:
+                self.assertTrue(share_card(bytes_extra, compress_content)['title'])
+        self.assertGreater(chatroom_rows, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+from app.util.protocbuf.bytes_extra import ORIGINAL, SENDER, THUMB, _parse_protobuf, decode_bytes_extra, \
+    get_sender_wxid
+from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+
+
+def _bytes_extra(entries) -> bytes:
+    msg_bytes = MessageBytesExtra()
+    msg_bytes.message1.field1 = 1
+    for field1, field2 in entries:
+        tmp = msg_bytes.message2.add()
+        tmp.field1 = field1
+        tmp.field2 = field2
+    return msg_bytes.SerializeToString()
+
+
+class BytesExtraTest(unittest.TestCase):
+    def test_last_sender_wins(self):
+        """
+        message2里有两个发送人时取最后一个，和原来的protobuf循环一致
+        """
+        data = _bytes_extra([(SENDER, 'wxid_first'), (THUMB, 'thumb1'), (SENDER, 'wxid_second')])
+        self.assertEqual(get_sender_wxid(data), 'wxid_second')
+        self.assertEqual(_parse_protobuf(data, (SENDER,)), {SENDER: 'wxid_second'})
+
+    def test_first_path_wins(self):
+        data = _bytes_extra([(THUMB, 'thumb1'), (ORIGINAL, 'image1'), (THUMB, 'thumb2'), (ORIGINAL, 'image2'),
+                             (SENDER, 'wxid_a'), (SENDER, 'wxid_b')])
+        expected = {SENDER: 'wxid_b', THUMB: 'thumb1', ORIGINAL: 'image1'}
+        self.assertEqual(decode_bytes_extra(data), expected)
+        self.assertEqual(_parse_protobuf(data, (SENDER, THUMB, ORIGINAL)), expected)
+        self.assertEqual(decode_bytes_extra(data, (THUMB,)), {THUMB: 'thumb1'})
+
+
+if __name__ == '__main__':
+    unittest.main()
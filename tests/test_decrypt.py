@@ -0,0 +1,81 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from app.decrypt.benchmark import DEFAULT_KEY, MSG_SCHEMA, _create_plain_db
+from app.decrypt.decrypt import DEFAULT_PAGESIZE, decrypt_files, encrypt
+
+
+class IncrementalDecryptTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        self.plain_path = os.path.join(self.root.name, 'plain.db')
+        conn = _create_plain_db(self.plain_path, MSG_SCHEMA)
+        conn.executemany('INSERT INTO MSG(Type,CreateTime,StrTalker,StrContent) VALUES (1,?,?,?)',
+                         [(i, 'wxid_a', f'消息{i:05d}' * 20) for i in range(2000)])
+        conn.commit()
+        conn.close()
+        self.db_path = os.path.join(self.root.name, 'MSG0.db')
+        self.out_path = os.path.join(self.root.name, 'out', 'MSG0.db')
+        os.makedirs(os.path.dirname(self.out_path))
+        self._encrypt(self.plain_path)
+        self._decrypt()
+
+    def _encrypt(self, plain_path):
+        # 固定盐值和IV，没改的页加密出来完全一样，和微信原地改写几页的效果相同
+        with mock.patch('os.urandom', side_effect=lambda n: bytes(n)):
+            encrypt(DEFAULT_KEY, plain_path, self.db_path)
+
+    def _decrypt(self):
+        results = decrypt_files([[DEFAULT_KEY, self.db_path, self.out_path]], workers=1)
+        self.assertTrue(results[0][0])
+
+    def _rewrite_middle_page(self, old, new):
+        """
+        改写中间某一页里的一条消息，文件大小和第一页都不变
+        """
+        with open(self.plain_path, 'rb') as f:
+            data = bytearray(f.read())
+        offset = data.index(old.encode(), len(data) // 2)
+        self.assertGreater(offset, DEFAULT_PAGESIZE)
+        data[offset:offset + len(old.encode())] = new.encode()
+        plain_path = os.path.join(self.root.name, 'plain2.db')
+        with open(plain_path, 'wb') as f:
+            f.write(data)
+        stat = os.stat(self.db_path)
+        self._encrypt(plain_path)
+        self.assertEqual(os.path.getsize(self.db_path), stat.st_size)
+        return stat
+
+    def _contents(self) -> set:
+        conn = sqlite3.connect(self.out_path)
+        try:
+            return {row[0] for row in conn.execute('SELECT StrContent FROM MSG')}
+        finally:
+            conn.close()
+
+    def test_same_size_rewrite_is_decrypted(self):
+        self._rewrite_middle_page('消息01500', '改写01500')
+        self._decrypt()
+        self.assertIn('改写01500' + '消息01500' * 19, self._contents())
+
+    def test_checkpoint_with_wal_is_decrypted(self):
+        stat = self._rewrite_middle_page('消息01600', '改写01600')
+        # 修改时间也没变，只有-wal文件
+        os.utime(self.db_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        with open(self.db_path + '-wal', 'wb') as f:
+            f.write(b'\0' * 32)
+        self._decrypt()
+        self.assertIn('改写01600' + '消息01600' * 19, self._contents())
+
+    def test_unchanged_file_is_skipped(self):
+        with mock.patch('app.decrypt.decrypt._page_digests') as page_digests:
+            self._decrypt()
+        page_digests.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
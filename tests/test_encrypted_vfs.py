@@ -0,0 +1,53 @@
+import os
+import random
+import tempfile
+import unittest
+
+try:
+    from app.decrypt import encrypted_vfs
+except ImportError:
+    encrypted_vfs = None
+from app.decrypt.benchmark import BASE_TIME, DEFAULT_KEY, MSG_SCHEMA, _contacts, _create_plain_db, _msg_rows
+from app.decrypt.decrypt import encrypt
+
+
+@unittest.skipIf(encrypted_vfs is None, 'apsw is not installed')
+class EncryptedVfsTest(unittest.TestCase):
+    def test_shard_local_ids_are_unique(self):
+        rng = random.Random(0)
+        contacts = _contacts(10)
+        with tempfile.TemporaryDirectory() as root:
+            paths = []
+            start_time = BASE_TIME
+            for i, rows in enumerate((30, 50, 20)):
+                plain_path = os.path.join(root, f'plain{i}.db')
+                conn = _create_plain_db(plain_path, MSG_SCHEMA)
+                conn.executemany(
+                    'INSERT INTO MSG(MsgSvrID,Type,SubType,IsSender,CreateTime,Sequence,StrTalker,StrContent,'
+                    'DisplayContent,CompressContent,BytesExtra) VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                    _msg_rows(rng, contacts, rows, start_time, [])
+                )
+                start_time = conn.execute('SELECT MAX(CreateTime) FROM MSG').fetchone()[0]
+                conn.commit()
+                conn.close()
+                paths.append(os.path.join(root, f'MSG{i}.db'))
+                encrypt(DEFAULT_KEY, plain_path, paths[-1])
+
+            encrypted_vfs.enable(DEFAULT_KEY)
+            conn = encrypted_vfs.connect(paths)
+            try:
+                rows = conn.execute('SELECT localId,CreateTime FROM MSG ORDER BY localId').fetchall()
+                self.assertEqual(len(rows), 100)
+                self.assertEqual(len({row[0] for row in rows}), 100)
+                # 和合并后的库一样，localId的顺序就是分库的顺序
+                times = [row[1] for row in rows]
+                self.assertEqual(times, sorted(times))
+                local_id = rows[40][0]
+                self.assertEqual(conn.execute('SELECT CreateTime FROM MSG WHERE localId=?', [local_id]).fetchone()[0],
+                                 rows[40][1])
+            finally:
+                conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from app.util.exporter import exporter
+from app.util.exporter.exporter import ExporterBase, export_stream
+
+
+class RecordingExporter(ExporterBase):
+    fail_at = None
+
+    def begin(self, total):
+        super().begin(total)
+        self.written = []
+        self.ended = False
+
+    def write(self, message):
+        if len(self.written) == self.fail_at:
+            raise ValueError('broken message')
+        self.written.append(message)
+
+    def end(self):
+        self.ended = True
+        super().end()
+
+
+class ExportStreamTest(unittest.TestCase):
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(root.name)
+        self.contact = SimpleNamespace(wxid='wxid_a', remark='a')
+        self.messages = [(i, 1, 1) for i in range(5)]
+        msg_db = mock.Mock()
+        msg_db.get_messages_number.return_value = len(self.messages)
+        msg_db.iter_messages.side_effect = lambda *args, **kwargs: iter(self.messages)
+        patcher = mock.patch.object(exporter, 'msg_db', msg_db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _exporter(self, fail_at=None):
+        oks = []
+        item = RecordingExporter(self.contact, me=object(), on_ok=oks.append)
+        item.fail_at = fail_at
+        return item, oks
+
+    def test_failed_exporter_does_not_stop_others(self):
+        broken, broken_oks = self._exporter(fail_at=2)
+        good, good_oks = self._exporter()
+        export_stream([broken, good])
+        self.assertEqual(good.written, self.messages)
+        self.assertEqual(broken.written, self.messages[:2])
+        self.assertIn('broken message', broken.error)
+        self.assertIsNone(good.error)
+        self.assertTrue(broken.ended and good.ended)
+        self.assertEqual((broken_oks, good_oks), ([1], [1]))
+
+    def test_end_called_when_query_fails(self):
+        exporter.msg_db.iter_messages.side_effect = OSError('disk I/O error')
+        item, oks = self._exporter()
+        with self.assertRaises(OSError):
+            export_stream([item])
+        self.assertTrue(item.ended)
+        self.assertEqual(oks, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import random
+import sqlite3
+import tempfile
+import unittest
+
+from app.decrypt.benchmark import BASE_TIME, DEFAULT_KEY, MSG_SCHEMA, _contacts, _create_plain_db, _msg_rows
+from app.decrypt.decrypt import encrypt
+from app.decrypt.ingest import collect_decrypt_tasks, ingest
+
+
+class IngestOrderTest(unittest.TestCase):
+    def test_local_id_follows_create_time(self):
+        """
+        分库大小不同，解密完成的顺序和编号不同，合并后localId的顺序仍然和CreateTime一致
+        """
+        rng = random.Random(0)
+        contacts = _contacts(20)
+        with tempfile.TemporaryDirectory() as root:
+            msg_dir = os.path.join(root, 'Msg', 'Multi')
+            out_dir = os.path.join(root, 'out')
+            os.makedirs(msg_dir)
+            os.makedirs(out_dir)
+            start_time = BASE_TIME
+            # MSG0最小、MSG1最大，解密按大小调度，先完成的是MSG1
+            for i, rows in enumerate((50, 3000, 600)):
+                plain_path = os.path.join(root, f'plain{i}.db')
+                conn = _create_plain_db(plain_path, MSG_SCHEMA)
+                conn.executemany(
+                    'INSERT INTO MSG(MsgSvrID,Type,SubType,IsSender,CreateTime,Sequence,StrTalker,StrContent,'
+                    'DisplayContent,CompressContent,BytesExtra) VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                    _msg_rows(rng, contacts, rows, start_time, [])
+                )
+                start_time = conn.execute('SELECT MAX(CreateTime) FROM MSG').fetchone()[0]
+                conn.commit()
+                conn.close()
+                encrypt(DEFAULT_KEY, plain_path, os.path.join(msg_dir, f'MSG{i}.db'))
+
+            merged = []
+            tasks = collect_decrypt_tasks(DEFAULT_KEY, os.path.join(root, 'Msg'), out_dir)
+            result = ingest(tasks, out_dir, workers=1,
+                            progress=lambda fraction, message: merged.append(message) if '合并 ' in message else None)
+            self.assertIsNone(result['error'])
+            self.assertEqual([os.path.basename(stat[0]) for stat in result['merge']], ['MSG0.db', 'MSG1.db', 'MSG2.db'])
+
+            conn = sqlite3.connect(os.path.join(out_dir, 'MSG.db'))
+            try:
+                times = [row[0] for row in conn.execute('SELECT CreateTime FROM MSG ORDER BY localId')]
+            finally:
+                conn.close()
+            self.assertEqual(len(times), 3650)
+            self.assertEqual(times, sorted(times))
+
+
+if __name__ == '__main__':
+    unittest.main()
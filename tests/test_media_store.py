@@ -0,0 +1,83 @@
+import errno
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from app.util import image, media_store
+
+
+class MediaStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(media_store, 'MEDIA_STORE_DIR', os.path.join(self.root.name, 'store'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.root.cleanup)
+        media_store._local.conn = None
+        self.addCleanup(setattr, media_store._local, 'conn', None)
+        media_store._link_supported = True
+        self.addCleanup(setattr, media_store, '_link_supported', True)
+
+    def _write_dat(self, name, data):
+        code = 0x5a
+        path = os.path.join(self.root.name, name)
+        with open(path, 'wb') as f:
+            f.write(data.translate(image.xor_tables[code]))
+        return path
+
+    def test_timestamp_does_not_touch_shared_file(self):
+        """
+        同一张图片（以及内容相同的转发图片）出现在不同时间的消息里，各自的修改时间互不影响
+        """
+        data = b'\xff\xd8' + os.urandom(4096)
+        first = self._write_dat('a.dat', data)
+        forwarded = self._write_dat('b.dat', data)
+        out_dirs = [os.path.join(self.root.name, name) for name in ('out1', 'out2', 'out3')]
+        for out_dir in out_dirs:
+            os.makedirs(out_dir)
+        path1 = image.decode_dat(first, out_dirs[0], 1600000000)
+        path2 = image.decode_dat(first, out_dirs[1], 1700000000)
+        path3 = image.decode_dat(forwarded, out_dirs[2], 1650000000)
+        self.assertEqual(int(os.stat(path1).st_mtime), 1600000000)
+        self.assertEqual(int(os.stat(path2).st_mtime), 1700000000)
+        self.assertEqual(int(os.stat(path3).st_mtime), 1650000000)
+        obj = media_store.get(media_store.source_key(first))
+        self.assertNotIn(int(os.stat(obj).st_mtime), (1600000000, 1700000000, 1650000000))
+        with open(path3, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_set_mtime_on_copied_media(self):
+        """
+        视频、视频缩略图从库里链接过来之后再改修改时间，不影响库里和其他导出的同一个文件
+        """
+        src = os.path.join(self.root.name, 'video.mp4')
+        with open(src, 'wb') as f:
+            f.write(os.urandom(1024))
+        paths = []
+        for i, (private, timestamp) in enumerate(((True, 1600000000), (False, 1700000000), (True, 1650000000))):
+            dst = os.path.join(self.root.name, f'v{i}.mp4')
+            self.assertTrue(media_store.copy(src, dst, private=private))
+            media_store.set_mtime(dst, timestamp)
+            paths.append((dst, timestamp))
+        for dst, timestamp in paths:
+            self.assertEqual(int(os.stat(dst).st_mtime), timestamp)
+        obj = media_store.get(media_store.source_key(src))
+        self.assertNotIn(int(os.stat(obj).st_mtime), [timestamp for _, timestamp in paths])
+
+    def test_link_fallback_only_when_unsupported(self):
+        src = os.path.join(self.root.name, 'src')
+        with open(src, 'wb') as f:
+            f.write(b'data')
+        with mock.patch('os.link', side_effect=OSError(errno.ENOSPC, 'No space left on device')):
+            with self.assertRaises(OSError):
+                media_store.link(src, os.path.join(self.root.name, 'dst1'))
+        self.assertTrue(media_store._link_supported)
+        with mock.patch('os.link', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link')):
+            media_store.link(src, os.path.join(self.root.name, 'dst2'))
+        self.assertFalse(media_store._link_supported)
+        self.assertTrue(os.path.exists(os.path.join(self.root.name, 'dst2')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import random
+import sqlite3
+import tempfile
+import unittest
+
+from app.DataBase.merge import MsgMerger, merge_databases
+from app.DataBase.msg_rollup import ensure_msg_rollup
+from app.decrypt.benchmark import BASE_TIME, MSG_SCHEMA, _contacts, _create_plain_db, _msg_rows
+
+
+def _indexes(path) -> set:
+    conn = sqlite3.connect(path)
+    try:
+        return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL")}
+    finally:
+        conn.close()
+
+
+class ShardMergerTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        rng = random.Random(0)
+        contacts = _contacts(10)
+        self.shards = []
+        for i in range(2):
+            path = os.path.join(self.root.name, f'MSG{i}.db')
+            conn = _create_plain_db(path, MSG_SCHEMA)
+            conn.executemany(
+                'INSERT INTO MSG(MsgSvrID,Type,SubType,IsSender,CreateTime,Sequence,StrTalker,StrContent,'
+                'DisplayContent,CompressContent,BytesExtra) VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                _msg_rows(rng, contacts, 200, BASE_TIME + i * 100000, [])
+            )
+            conn.commit()
+            conn.close()
+            self.shards.append(path)
+        self.target = os.path.join(self.root.name, 'MSG.db')
+
+    def test_indexes_rebuilt_after_abort(self):
+        merger = MsgMerger(self.target)
+        merger.merge_shard(self.shards[0])
+        self.assertNotIn('MSG_CREATETIME', _indexes(self.target))
+        merger.close(finalize=False)
+        self.assertIn('MSG_CREATETIME', _indexes(self.target))
+
+    def test_indexes_restored_after_kill(self):
+        merger = MsgMerger(self.target)
+        merger.merge_shard(self.shards[0])
+        # 进程被杀掉：没有执行close
+        merger.conn.close()
+        self.assertNotIn('MSG_CREATETIME', _indexes(self.target))
+
+        merger = MsgMerger(self.target)
+        merger.merge_shard(self.shards[1])
+        merger.close()
+        self.assertTrue({'MSG_CREATETIME', 'MSG_MSGSVRID', 'MSG_SEQUENCE', 'MSG_TALKER'} <= _indexes(self.target))
+        conn = sqlite3.connect(self.target)
+        try:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM MSG').fetchone()[0], 400)
+        finally:
+            conn.close()
+
+    def _count(self, sql='SELECT COUNT(*) FROM MSG') -> int:
+        conn = sqlite3.connect(self.target)
+        try:
+            return conn.execute(sql).fetchone()[0]
+        finally:
+            conn.close()
+
+    def _make_local(self, path, keep=None):
+        """
+        把分库里的消息都改成MsgSvrID=0的本地消息；keep不为None时只保留前keep条，模拟分库被重建
+        """
+        conn = sqlite3.connect(path)
+        conn.execute('UPDATE MSG SET MsgSvrID=0')
+        if keep is not None:
+            conn.execute('DELETE FROM MSG WHERE localId>?', [keep])
+        conn.commit()
+        conn.close()
+
+    def test_local_messages_not_duplicated_after_shard_rebuilt(self):
+        self._make_local(self.shards[0])
+        merge_databases(self.shards, self.target)
+        self.assertEqual(self._count(), 400)
+        # 分库重建后localId变小，合并进度从头开始
+        self._make_local(self.shards[0], keep=150)
+        merge_databases(self.shards, self.target)
+        self.assertEqual(self._count(), 400)
+
+    def test_old_target_duplicates_removed(self):
+        self._make_local(self.shards[0])
+        merge_databases(self.shards, self.target)
+        # 旧版本合并出来的目标库：没有本地消息的去重索引，重复插入过一遍
+        conn = sqlite3.connect(self.target)
+        conn.execute('DROP INDEX IDX_MSG_LOCAL_UNIQUE')
+        conn.execute('INSERT INTO MSG(MsgSvrID,Type,CreateTime,Sequence,StrTalker) '
+                     'SELECT MsgSvrID,Type,CreateTime,Sequence,StrTalker FROM MSG WHERE MsgSvrID=0')
+        conn.commit()
+        conn.close()
+        ensure_msg_rollup(self.target)
+        self.assertEqual(self._count(), 600)
+
+        merge_databases(self.shards, self.target)
+        self.assertEqual(self._count(), 400)
+        self.assertIn('IDX_MSG_LOCAL_UNIQUE', _indexes(self.target))
+        self.assertEqual(self._count('SELECT SUM(Num) FROM MSG_ROLLUP'), 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from app.DataBase.msg import Msg
+from app.DataBase.msg_rollup import ensure_msg_rollup, rollup_is_current
+from app.decrypt.benchmark import BASE_TIME, MSG_SCHEMA, _contacts, _msg_rows
+
+
+class MsgOpenTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        self.db_path = os.path.join(self.root.name, 'MSG.db')
+        conn = sqlite3.connect(self.db_path)
+        for sql in MSG_SCHEMA:
+            conn.execute(sql)
+        conn.executemany(
+            'INSERT INTO MSG(MsgSvrID,Type,SubType,IsSender,CreateTime,Sequence,StrTalker,StrContent,'
+            'DisplayContent,CompressContent,BytesExtra) VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+            _msg_rows(random.Random(0), _contacts(10), 300, BASE_TIME, [])
+        )
+        conn.commit()
+        conn.close()
+
+    def _tables(self) -> set:
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+        finally:
+            conn.close()
+
+    def test_open_is_read_only(self):
+        """
+        导出子进程导入msg_db时只读打开，不建索引、汇总表、全文索引
+        """
+        before = self._tables()
+        msg = Msg()
+        msg.init_database(self.db_path)
+        self.addCleanup(msg.close)
+        self.assertTrue(msg.open_flag)
+        self.assertFalse(msg.rollup_ready)
+        self.assertEqual(self._tables(), before)
+
+    def test_rollup_used_only_when_current(self):
+        ensure_msg_rollup(self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        try:
+            self.assertTrue(rollup_is_current(conn))
+            conn.execute("INSERT INTO MSG(MsgSvrID,Type,CreateTime,StrTalker) VALUES (1,1,?,'wxid_a')", [BASE_TIME])
+            conn.commit()
+            self.assertFalse(rollup_is_current(conn))
+        finally:
+            conn.close()
+
+    def test_maintenance_runs_in_background(self):
+        msg = Msg()
+        msg.init_database(self.db_path)
+        self.addCleanup(msg.close)
+        msg.start_maintenance()
+        for _ in range(100):
+            if msg.rollup_ready and msg.fts_ready:
+                break
+            time.sleep(0.1)
+        self.assertTrue(msg.rollup_ready)
+        self.assertTrue(msg.fts_ready)
+
+
+if __name__ == '__main__':
+    unittest.main()
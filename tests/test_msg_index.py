@@ -0,0 +1,47 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from app.DataBase.msg_index import MSG_INDEXES, ensure_msg_indexes, missing_msg_indexes
+from app.decrypt.benchmark import MSG_SCHEMA
+
+
+class MsgIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        self.db_path = os.path.join(self.root.name, 'MSG.db')
+        conn = sqlite3.connect(self.db_path)
+        for sql in MSG_SCHEMA:
+            conn.execute(sql)
+        conn.commit()
+        conn.close()
+
+    def _indexes(self) -> set:
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+        finally:
+            conn.close()
+
+    def test_builtin_create_time_index_is_reused(self):
+        ensure_msg_indexes(self.db_path)
+        indexes = self._indexes()
+        self.assertIn('MSG_CREATETIME', indexes)
+        self.assertNotIn('IDX_MSG_TIME', indexes)
+        self.assertTrue({name for name, _ in MSG_INDEXES} <= indexes)
+        self.assertEqual(missing_msg_indexes(self.db_path), [])
+
+    def test_legacy_duplicate_index_is_dropped(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE INDEX IDX_MSG_TIME ON MSG (CreateTime)')
+        conn.commit()
+        conn.close()
+        ensure_msg_indexes(self.db_path)
+        self.assertNotIn('IDX_MSG_TIME', self._indexes())
+        self.assertIn('MSG_CREATETIME', self._indexes())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from app.DataBase.pool import ConnectionPool
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        db_path = os.path.join(self.root.name, 'test.db')
+        conn = sqlite3.connect(db_path)
+        conn.execute('CREATE TABLE t(x INTEGER)')
+        conn.executemany('INSERT INTO t VALUES (?)', [(i,) for i in range(10)])
+        conn.commit()
+        conn.close()
+        self.pool = ConnectionPool(db_path, size=2)
+        self.addCleanup(self.pool.close)
+
+    def _rows(self):
+        with self.pool.cursor() as cursor:
+            cursor.execute('SELECT x FROM t')
+            yield from cursor
+
+    def test_generator_closed_on_another_thread(self):
+        """
+        生成器在别的线程里结束时归还的是借出时的连接，借出的线程之后还能正常查询
+        """
+        rows = self._rows()
+        self.assertEqual(next(rows), (0,))
+        borrowed = self.pool._holders[threading.get_ident()][0]
+
+        thread = threading.Thread(target=rows.close)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(self.pool._holders, {})
+        self.assertEqual(self.pool._idle, [borrowed])
+        with self.pool.cursor() as cursor:
+            self.assertEqual(cursor.execute('SELECT count(*) FROM t').fetchone()[0], 10)
+        self.assertEqual(self.pool._opened, 1)
+
+    def test_nested_queries_share_connection(self):
+        with self.pool.connection() as outer:
+            with self.pool.connection() as inner:
+                self.assertIs(outer, inner)
+        self.assertEqual(self.pool._idle, [outer])
+
+
+if __name__ == '__main__':
+    unittest.main()